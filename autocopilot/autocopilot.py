@@ -1,71 +1,159 @@
-from time import sleep
-from json import JSONDecoder, JSONEncoder
-from queue import Queue
+import asyncio
+from time import sleep, perf_counter
 
 import zmq
+import zmq.asyncio
 
-from drone import DJIDrone
-from zmq_threads import TCPThread
+from drone import DJIDrone, AsyncDJIDrone
+from fleet import FleetManager
+from command_server import CommandRegistry, CommandReceiver, AsyncCommandReceiver
+from metrics import Metrics, MetricsServer
 from logger import Log
 import configure as config
 config_manager = config.ConfigManager()
 
 
-class CommandReceiver(TCPThread):
-	def __init__(self, zmq_context, message_callback, port, rate=10/1000):
-		super().__init__(zmq_context, zmq.REP, "127.0.0.1", port, rate=rate)
-
-		self._message_callback = message_callback
-		self._request_queue = Queue()
-		self._reply_queue = Queue()
-		self._json_decoder = JSONDecoder()
-		self._json_encoder = JSONEncoder()
-
-	def _thread_action(self):
-		self._request_queue.put(self._socket.recv_string())
-		self._socket.send_string(self._reply_queue.get())
-		super()._thread_action()
-
-	def update(self):
-		while not self._request_queue.empty():
-			msg = self._json_decoder.decode(self._request_queue.get())
-			success, return_kwargs = self._message_callback(msg["request"], msg["args"])
-			response = {"success": success}
-			if return_kwargs is not None:
-				response["args"] = return_kwargs
-			self._reply_queue.put(self._json_encoder.encode(response))
-
-
 class AutoCopilot:
+	COMMAND_PORT = 5536
+
 	def __init__(self):
 		self.zmq_context = zmq.Context()
-		self.drone = DJIDrone(self.zmq_context, rate=1 / config.UPDATE_HZ)
-		self.cmd_receiver = CommandReceiver(self.zmq_context, self.process_request, port=5536, rate=1 / config.UPDATE_HZ)
+		self.commands = CommandRegistry(default_timeout=config.COMMAND_TIMEOUT)
+		self.register_commands()
+		# A fleet replaces the single drone on the default feeds
+		if config.FLEET_VEHICLES.strip() == "":
+			self.drone = DJIDrone(self.zmq_context, rate=1 / config.UPDATE_HZ, event_driven=config.EVENT_DRIVEN)
+			self.fleet = None
+		else:
+			self.drone = None
+			self.fleet = start_fleet(self.zmq_context)
+		self.cmd_receiver = CommandReceiver(self.zmq_context, self.commands, port=self.COMMAND_PORT, workers=config.COMMAND_WORKERS)
+		self.cmd_receiver.start()
+		self._last_tick = None
+		self._tick_jitter = Metrics.histogram("loop_tick_jitter_seconds", "How far each main loop tick was from 1 / UPDATE_HZ")
+		self._update_time = Metrics.histogram("loop_update_seconds", "Time spent in one main loop update")
+		self.subscribe_to_config()
 
 	def update(self):
-		self.drone.update()
-		if self.cmd_receiver.is_alive():
-			self.cmd_receiver.update()
+		tick = perf_counter()
+		if self._last_tick is not None:
+			self._tick_jitter.record(abs(tick - self._last_tick - 1 / config.UPDATE_HZ))
+		self._last_tick = tick
+		if self.fleet is not None:
+			self.fleet.update()
+		else:
+			self.drone.update()
+		self._update_time.record(perf_counter() - tick)
 		sleep(1 / config.UPDATE_HZ)
 
-	def process_request(self, request, arguments):
-		Log.add("Received request: " + request)
-
-		try:
-			success, return_kwargs = self.run_command(request, arguments)
-		except TypeError:
-			return_kwargs = {"error": "Unexpected error occurred while executing the command."}
-			success = False
-
-		return success, return_kwargs
-
-	def run_command(self, request, arguments):
-		# --- PING
-		if request == "ping":
-			return True, None
+	# Applies changes to these options while running. INTERFACE_TIMEOUT needs nothing here since it's read for every
+	# request, and the main loop reads UPDATE_HZ every tick.
+	def subscribe_to_config(self):
+		config.subscribe("UPDATE_HZ", self._update_hz_changed)
+		config.subscribe("HEARTBEAT_TIMEOUT", self._heartbeat_timeout_changed)
+		config.subscribe("COMMAND_TIMEOUT", self._command_timeout_changed)
+
+	def _update_hz_changed(self, option, value):
+		# Fleet vehicles run on the event driven reactor, so only the single drone has a rate
+		if self.drone is not None:
+			self.drone.set_update_rate(1 / value)
+
+	def _heartbeat_timeout_changed(self, option, value):
+		(self.fleet if self.fleet is not None else self.drone).heartbeat_timeout_changed()
+
+	def _command_timeout_changed(self, option, value):
+		self.commands.default_timeout = value
+
+	def register_commands(self):
+		self.commands.register("ping", self._ping, inline=True)
+		self.commands.register("stats", self._stats, inline=True)
+		self.commands.register("get_config", self._get_config, inline=True)
+		self.commands.register("set_config", self._set_config)
+		self.commands.register("fleet", self._fleet, inline=True)
+
+	# --- PING
+	def _ping(self, arguments):
+		return True, None
+
+	# --- STATS
+	def _stats(self, arguments):
+		return True, Metrics.snapshot()
+
+	# --- FLEET
+	def _fleet(self, arguments):
+		if self.fleet is None:
+			return False, {"error": "No fleet is configured. Set FLEET_VEHICLES to manage more than one vehicle."}
+		return True, {"vehicles": self.fleet.interface_status()}
+
+	# --- CONFIG
+	def _get_config(self, arguments):
+		return True, {"configuration": config_manager.make_configuration_msg()}
+
+	# Takes {"id": entry id, "value": new value}, or {"id": entry id, "default": true} to restore the default
+	def _set_config(self, arguments):
+		if not isinstance(arguments, dict) or "id" not in arguments:
+			return False, {"error": "set_config needs the id of the entry to set."}
+		if arguments.get("default", False):
+			msg, success = config_manager.load_default(arguments["id"])
+		elif "value" in arguments:
+			msg, success = config_manager.set_entry(arguments["id"], str(arguments["value"]))
+		else:
+			return False, {"error": "set_config needs a value, or default set to true."}
+		Log.add(msg, not success)
+		return success, {"message": msg}
+
+
+# Runs the drone interface, the command receiver and the interface timeout checks as coroutines on one event loop.
+# The threaded AutoCopilot is still used unless ASYNCIO is enabled in the config.
+class AsyncAutoCopilot(AutoCopilot):
+	def __init__(self):
+		self.zmq_context = zmq.asyncio.Context()
+		self.commands = CommandRegistry(default_timeout=config.COMMAND_TIMEOUT)
+		self.register_commands()
+		self.drone = None
+		self.fleet = None
+		self.cmd_receiver = None
+
+	async def run(self):
+		if config.FLEET_VEHICLES.strip() != "":
+			Log.add("FLEET_VEHICLES is ignored with ASYNCIO enabled, only the vehicle on the default feeds is used.", warn=True)
+		self.drone = AsyncDJIDrone(self.zmq_context)
+		self.cmd_receiver = AsyncCommandReceiver(self.zmq_context, self.commands, port=self.COMMAND_PORT, workers=config.COMMAND_WORKERS)
+		self.subscribe_to_config()
+		await asyncio.gather(self.drone.run(), self.cmd_receiver.run())
+
+
+def start_logging():
+	if config.LOG_FILE != "":
+		Log.open_logfile(config.LOG_FILE)
+	if config.LOG_BACKGROUND:
+		# A max size of 0 turns off rotation
+		Log.start_background(
+			fsync_interval=config.LOG_FSYNC_INTERVAL, max_bytes=config.LOG_MAX_BYTES if config.LOG_MAX_BYTES > 0 else None,
+			backup_count=config.LOG_BACKUP_COUNT)
+
+
+# Adds the vehicles listed in FLEET_VEHICLES. With FLEET_MANAGED each one's interface is started with INTERFACE_COMMAND.
+def start_fleet(zmq_context):
+	fleet = FleetManager(zmq_context)
+	for vehicle_id in config.FLEET_VEHICLES.split(","):
+		if vehicle_id.strip() != "":
+			fleet.add_vehicle(vehicle_id.strip(), command=config.INTERFACE_COMMAND if config.FLEET_MANAGED else None)
+	return fleet
+
+
+def start_metrics_server():
+	if config.METRICS_PORT > 0:
+		MetricsServer(Metrics, config.METRICS_PORT).start()
+		Log.add(f"Serving Prometheus metrics on http://127.0.0.1:{config.METRICS_PORT}/metrics")
 
 
 if __name__ == "__main__":
-	acp = AutoCopilot()
-	while True:
-		acp.update()
+	start_logging()
+	start_metrics_server()
+	if config.ASYNCIO:
+		asyncio.run(AsyncAutoCopilot().run())
+	else:
+		acp = AutoCopilot()
+		while True:
+			acp.update()
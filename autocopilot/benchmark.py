@@ -0,0 +1,314 @@
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+from json import JSONEncoder
+
+import numpy as np
+import zmq
+
+import configure as config
+import wire_format
+from wire_format import WireFormat
+from zmq_threads import IPCRequestThread
+from drone import DJIInterfaceThread, TelemetrySubscriberThread, DJIMessageTopic
+from telemetry_buffer import TelemetryBuffer
+from command_server import CommandRegistry, CommandReceiver
+from supervisor import ProcessSupervisor
+from simulator import TelemetrySynthesizer
+from logger import Log
+
+
+# Version of the layout of the JSON results, bumped whenever a field changes meaning
+RESULTS_VERSION = 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+# Summary of a list of durations in seconds, reported in milliseconds
+def summarize_latencies(durations):
+	samples = np.asarray(durations, dtype=np.float64) * 1000
+	if len(samples) == 0:
+		return {"count": 0}
+	summary = {"count": len(samples), "mean_ms": float(samples.mean()), "min_ms": float(samples.min()),
+				"max_ms": float(samples.max())}
+	for percentile, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+		summary["p{:g}_ms".format(percentile)] = float(value)
+	return summary
+
+
+def _git_revision():
+	try:
+		return subprocess.run(
+			["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)), capture_output=True, text=True,
+			timeout=5).stdout.strip() or None
+	except (OSError, subprocess.SubprocessError):
+		return None
+
+
+# Measures how fast DJIInterfaceThread._process_reply decodes a retrieve_data reply, without any sockets involved
+def benchmark_decode(wire, duration):
+	synthesizer = TelemetrySynthesizer()
+	messages = [synthesizer.flight_status(0), synthesizer.control_device(0), synthesizer.telemetry(0)]
+	if wire is WireFormat.BINARY:
+		payloads = [wire_format.encode(message) for message in messages]
+	else:
+		payloads = [JSONEncoder().encode(message).encode("utf-8") for message in messages]
+	frames = [zmq.Frame(payload) for payload in payloads]
+
+	interface = DJIInterfaceThread(zmq.Context.instance(), lambda topic, message, last_msg: None, None, wire_format=wire)
+	decoded = 0
+	start = time.perf_counter()
+	end = start + duration
+	while True:
+		for _ in range(100):
+			interface._process_reply(frames)
+		decoded += 100 * len(frames)
+		now = time.perf_counter()
+		if now >= end:
+			break
+
+	elapsed = now - start
+	return {"wire_format": wire.value, "messages": decoded, "seconds": elapsed, "messages_per_second": decoded / elapsed,
+			"message_bytes": sum(len(payload) for payload in payloads) / len(payloads)}
+
+
+# The pieces of AutoCopilot that sit on the control loop's path, wired to a simulated interface on a private feed:
+# a DJIInterfaceThread, a TelemetrySubscriberThread and a CommandReceiver, all at one update rate. A raw
+# IPCRequestThread talks to the same simulated interface, to separate the transport from the protocol on top of it.
+# A control loop thread stands in for AutoCopilot.update and polls the interface once every 1 / update_hz seconds.
+class BenchmarkStack:
+	def __init__(self, zmq_context, supervisor, feed_directory, update_hz, event_driven, wire, command_port, workers):
+		self.update_hz = update_hz
+		self.event_driven = event_driven
+		self.telemetry = TelemetryBuffer.for_duration(10, 50)
+		self.received = 0
+		self.status = None
+
+		rate = 1 / update_hz
+		feed_prefix = os.path.basename(feed_directory)
+		self.interface = DJIInterfaceThread(
+			zmq_context, self._process_drone_update, supervisor, rate=rate, event_driven=event_driven, wire_format=wire,
+			feed_name=feed_prefix + "/drone")
+		self.raw_client = IPCRequestThread(
+			zmq_context, lambda message: None, feed_prefix + "/drone", rate=rate, event_driven=event_driven)
+		self.subscriber = TelemetrySubscriberThread(
+			zmq_context, self._process_drone_update, conflate=True, rate=rate, event_driven=event_driven,
+			feed_name=feed_prefix + "/telemetry", wire_format=wire)
+
+		self.commands = CommandRegistry(default_timeout=10)
+		self.commands.register("ping", lambda arguments: (True, None), inline=True)
+		self.commands.register("echo", lambda arguments: (True, arguments))
+		self.cmd_receiver = CommandReceiver(zmq_context, self.commands, port=command_port, workers=workers)
+
+		self._halt_event = threading.Event()
+		self._control_loop = threading.Thread(target=self._run_control_loop, name="control-loop")
+		self._control_loop.daemon = True
+
+	def _process_drone_update(self, topic, message, last_msg):
+		self.received += 1
+		if topic == DJIMessageTopic.Telemetry:
+			self.telemetry.append_message(time.monotonic(), message)
+
+	def _run_control_loop(self):
+		while not self._halt_event.is_set():
+			self.status = self.interface.status
+			time.sleep(1 / self.update_hz)
+
+	def start(self):
+		self.interface.start()
+		self.interface.start_update_async()
+		self.raw_client.start()
+		self.raw_client.start_update_async()
+		self.subscriber.start()
+		self.cmd_receiver.start()
+		self._control_loop.start()
+
+	def stop(self):
+		self._halt_event.set()
+		self._control_loop.join()
+		self.interface.stop()
+		self.raw_client.stop()
+		self.subscriber.stop()
+		self.cmd_receiver.stop()
+		for thread in (self.interface, self.raw_client, self.subscriber, self.cmd_receiver):
+			thread.join(5)
+
+
+# Sends one request at a time and times each one from send_request until its future resolves.
+# Stops early once max_seconds have passed, since at low fixed rates every request takes a couple of update periods.
+def measure_request_latency(client, request, count, max_seconds, timeout=5):
+	durations = []
+	end = time.perf_counter() + max_seconds
+	for _ in range(count):
+		start = time.perf_counter()
+		client.send_request(request, timeout=timeout).result(timeout)
+		durations.append(time.perf_counter() - start)
+		if start >= end:
+			break
+	return durations
+
+
+# Sends one command at a time from a REQ client, like the ground station does
+def measure_command_round_trip(zmq_context, port, request, count, max_seconds, timeout=5):
+	socket = zmq_context.socket(zmq.REQ)
+	socket.RCVTIMEO = int(timeout * 1000)
+	socket.connect("tcp://127.0.0.1:{}".format(port))
+	command = JSONEncoder().encode({"request": request, "args": {"sequence": 0}}).encode("utf-8")
+	durations = []
+	end = time.perf_counter() + max_seconds
+	try:
+		for _ in range(count):
+			start = time.perf_counter()
+			socket.send(command)
+			socket.recv()
+			durations.append(time.perf_counter() - start)
+			if start >= end:
+				break
+	finally:
+		socket.close(linger=0)
+	return durations
+
+
+# CPU time used by this process over duration seconds of wall time, as a percentage of one core
+def measure_cpu_usage(duration):
+	start_cpu = time.process_time()
+	start = time.perf_counter()
+	time.sleep(duration)
+	used = time.process_time() - start_cpu
+	elapsed = time.perf_counter() - start
+	return {"seconds": elapsed, "cpu_seconds": used, "cpu_percent": 100 * used / elapsed}
+
+
+# Runs the whole stack at one update rate, then measures idle CPU first and request and command latencies after
+def benchmark_update_rate(zmq_context, supervisor, feed_directory, update_hz, event_driven, wire, args):
+	stack = BenchmarkStack(
+		zmq_context, supervisor, feed_directory, update_hz, event_driven, wire, args.command_port, args.workers)
+	stack.start()
+	try:
+		# Waits until the simulated interface answers, so connecting isn't counted
+		stack.interface.send_request("check_interface", timeout=10).result(10)
+		stack.raw_client.send_request("check_interface", timeout=10).result(10)
+		measure_command_round_trip(zmq_context, args.command_port, "ping", 10, args.max_seconds)
+
+		idle = measure_cpu_usage(args.idle_seconds)
+
+		request = "check_interface"
+		measure_request_latency(stack.interface, request, args.warmup, args.max_seconds)
+		interface_latency = measure_request_latency(stack.interface, request, args.requests, args.max_seconds)
+		measure_request_latency(stack.raw_client, request, args.warmup, args.max_seconds)
+		raw_latency = measure_request_latency(stack.raw_client, request, args.requests, args.max_seconds)
+
+		inline_round_trip = measure_command_round_trip(zmq_context, args.command_port, "ping", args.requests, args.max_seconds)
+		pooled_round_trip = measure_command_round_trip(zmq_context, args.command_port, "echo", args.requests, args.max_seconds)
+	finally:
+		stack.stop()
+
+	return {
+		"update_hz": update_hz,
+		"event_driven": event_driven,
+		"idle_cpu": idle,
+		"request_latency": {
+			"request": request,
+			"dji_interface_thread": summarize_latencies(interface_latency),
+			"ipc_request_thread": summarize_latencies(raw_latency)},
+		"command_round_trip": {
+			"inline": summarize_latencies(inline_round_trip),
+			"worker_pool": summarize_latencies(pooled_round_trip)},
+		"telemetry_received": stack.received}
+
+
+def run_benchmarks(args):
+	wire = WireFormat.BINARY if args.binary else WireFormat.JSON
+	results = {
+		"version": RESULTS_VERSION,
+		"timestamp": time.time(),
+		"git_revision": _git_revision(),
+		"host": {"python": platform.python_version(), "pyzmq": zmq.__version__, "libzmq": zmq.zmq_version(),
+				"platform": platform.platform(), "cpu_count": os.cpu_count()},
+		"parameters": {"update_hz": args.update_hz, "modes": args.modes, "wire_format": wire.value,
+						"requests": args.requests, "max_seconds": args.max_seconds, "idle_seconds": args.idle_seconds,
+						"decode_seconds": args.decode_seconds, "telemetry_hz": args.telemetry_hz, "workers": args.workers},
+		"decode": [benchmark_decode(format, args.decode_seconds) for format in (WireFormat.JSON, WireFormat.BINARY)],
+		"sweep": []}
+
+	# The simulated interface runs in its own process like the real one, so its CPU time isn't counted as ours
+	os.makedirs("/tmp/feeds", exist_ok=True)
+	feed_directory = tempfile.mkdtemp(prefix="benchmark-", dir="/tmp/feeds")
+	simulator = os.path.join(os.path.dirname(os.path.realpath(__file__)), "simulator.py")
+	command = [sys.executable, simulator, "--feeds", feed_directory]
+	if args.telemetry_hz > 0:
+		command += ["--online", "--hz", str(args.telemetry_hz)]
+	supervisor = ProcessSupervisor(
+		"simulator", command, os.path.join(feed_directory, "simulator.pid"), restart_on_exit=False)
+
+	zmq_context = zmq.Context()
+	try:
+		for update_hz in args.update_hz:
+			for mode in args.modes:
+				event_driven = mode == "event"
+				Log.add(f"Benchmarking at {update_hz} Hz, {'event driven' if event_driven else 'fixed rate'}")
+				results["sweep"].append(benchmark_update_rate(
+					zmq_context, supervisor, feed_directory, update_hz, event_driven, wire, args))
+	finally:
+		supervisor.stop()
+		zmq_context.term()
+		shutil.rmtree(feed_directory, ignore_errors=True)
+	return results
+
+
+def _comma_separated(cast):
+	return lambda value: [cast(item) for item in value.split(",") if item != ""]
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(
+		description="Benchmarks the interface request path, reply decoding, the command server and idle CPU usage "
+					"across a sweep of update rates, against the simulated interface. Results are written as JSON.")
+	parser.add_argument("--output", help="File to write the JSON results to, instead of stdout.")
+	parser.add_argument("--update-hz", type=_comma_separated(int), default=[8, 32, 128, 512],
+						help="Comma separated UPDATE_HZ values to sweep.")
+	parser.add_argument("--modes", type=_comma_separated(str), default=["fixed", "event"],
+						help="Comma separated threading modes to run at every rate, 'fixed' and/or 'event'.")
+	parser.add_argument("--requests", type=int, default=1000, help="Requests and commands timed per rate.")
+	parser.add_argument("--max-seconds", type=float, default=5.0,
+						help="Longest time spent timing one kind of request at one rate, however few were sent.")
+	parser.add_argument("--warmup", type=int, default=20, help="Untimed requests sent before timing.")
+	parser.add_argument("--idle-seconds", type=float, default=3.0, help="Seconds to measure idle CPU usage over.")
+	parser.add_argument("--decode-seconds", type=float, default=2.0, help="Seconds to run each decode benchmark.")
+	parser.add_argument("--telemetry-hz", type=float, default=0,
+						help="Telemetry rate of the simulated interface, or 0 to leave it offline.")
+	parser.add_argument("--binary", action="store_true", help="Ask the interface for the binary wire format.")
+	parser.add_argument("--command-port", type=int, default=5546, help="Port for the benchmark's command server.")
+	parser.add_argument("--workers", type=int, default=4, help="Command server worker threads.")
+	args = parser.parse_args(argv)
+	for mode in args.modes:
+		if mode not in ("fixed", "event"):
+			parser.error(f"Unknown mode '{mode}'.")
+
+	config.ConfigManager()
+	# Keeps the log and anything else printed along the way out of the results. The log is written in the background
+	# like it is in flight, so the command server's logging doesn't hold up its replies.
+	with contextlib.redirect_stdout(sys.stderr):
+		Log.start_background()
+		try:
+			results = run_benchmarks(args)
+		finally:
+			Log.stop_background()
+
+	output = json.dumps(results, indent=2)
+	if args.output is None:
+		print(output)
+	else:
+		with open(args.output, "w") as f:
+			f.write(output + "\n")
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,479 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError
+from itertools import count
+from json import JSONDecoder, JSONEncoder
+
+import zmq
+
+from zmq_threads import TCPThread, WakeupSignal, bind_or_connect_tcp
+from metrics import Metrics
+from logger import Log
+
+
+_json_decoder = JSONDecoder()
+_json_encoder = JSONEncoder()
+
+
+class CommandError(Exception):
+	pass
+
+
+# Commands are JSON objects of the form {"request": ..., "args": ...}
+def decode_command(command_string):
+	try:
+		msg = _json_decoder.decode(command_string)
+		return msg["request"], msg.get("args")
+	except (ValueError, TypeError, KeyError):
+		raise CommandError("Commands must be JSON objects with a 'request' field.")
+
+
+def encode_response(success, return_kwargs):
+	response = {"success": success}
+	if return_kwargs is not None:
+		response["args"] = return_kwargs
+	return _json_encoder.encode(response)
+
+
+def error_response(error):
+	return encode_response(False, {"error": error})
+
+
+# A batch is the command {"request": "batch", "args": {"commands": [commands...], "ordered": true, "stop_on_failure": false}}
+# and is answered with {"success": ..., "args": {"results": [responses...]}}, one response per command in the order
+# they were sent, so a client needs one round trip for many commands. Ordered batches run their commands one after the
+# other, unordered ones let them run at the same time. With stop_on_failure, commands that haven't started once one
+# fails aren't run, and answer with an error. The batch only succeeds if every command ran and succeeded.
+BATCH_REQUEST = "batch"
+MAX_BATCH_COMMANDS = 64
+
+
+class CommandBatch:
+	__slots__ = ("commands", "ordered", "stop_on_failure")
+
+	def __init__(self, commands, ordered, stop_on_failure):
+		self.commands = commands
+		self.ordered = ordered
+		self.stop_on_failure = stop_on_failure
+
+	@classmethod
+	def decode(cls, arguments):
+		if not isinstance(arguments, dict) or not isinstance(arguments.get("commands"), list):
+			raise CommandError("A batch needs a list of commands.")
+		commands = arguments["commands"]
+		if len(commands) > MAX_BATCH_COMMANDS:
+			raise CommandError(f"A batch can't hold more than {MAX_BATCH_COMMANDS} commands.")
+		if not all(isinstance(command, dict) and isinstance(command.get("request"), str) for command in commands):
+			raise CommandError("Every command of a batch must be a JSON object with a 'request' field.")
+		return cls([(command["request"], command.get("args")) for command in commands], arguments.get("ordered", True),
+				arguments.get("stop_on_failure", False))
+
+	def not_run(self):
+		return False, {"error": "Not run, another command of the batch failed."}
+
+	# (success, return_kwargs) of the whole batch from the results of its commands, None for those that didn't run
+	def result(self, results):
+		results = [self.not_run() if result is None else result for result in results]
+		responses = []
+		for success, return_kwargs in results:
+			response = {"success": success}
+			if return_kwargs is not None:
+				response["args"] = return_kwargs
+			responses.append(response)
+		return all(success for success, _ in results), {"results": responses}
+
+
+class CommandHandler:
+	__slots__ = ("name", "function", "timeout", "inline", "duration")
+
+	def __init__(self, name, function, timeout, inline):
+		self.name = name
+		self.function = function
+		self.timeout = timeout
+		self.inline = inline
+		self.duration = Metrics.histogram("command_seconds", "Time spent running a command", command=name)
+
+
+# Maps request names to their handlers. A handler takes the command's arguments and returns (success, return_kwargs).
+# Handlers run on the command server's worker pool, so they must be thread safe. Inline handlers run directly on the
+# server's socket thread instead, which keeps them answering while every worker is busy. Only mark trivial
+# handlers as inline, since a slow one stalls the whole server. Unknown commands are always answered inline.
+class CommandRegistry:
+	def __init__(self, default_timeout=None):
+		self.default_timeout = default_timeout
+		self._handlers = dict()
+
+	def register(self, name, function, timeout=None, inline=False):
+		self._handlers[name] = CommandHandler(name, function, timeout, inline)
+
+	def unregister(self, name):
+		self._handlers.pop(name, None)
+
+	def get(self, name):
+		return self._handlers.get(name)
+
+	# Handlers registered without a timeout follow default_timeout, even when it changes after they were registered
+	def timeout_for(self, handler):
+		return self.default_timeout if handler.timeout is None else handler.timeout
+
+	def __contains__(self, name):
+		return name in self._handlers
+
+	def names(self):
+		return list(self._handlers.keys())
+
+	def execute(self, request, arguments):
+		Log.add("Received request: " + request)
+
+		handler = self._handlers.get(request)
+		if handler is None:
+			return False, {"error": f"Unknown command '{request}'."}
+
+		start = time.perf_counter()
+		try:
+			return handler.function(arguments)
+		except Exception as e:
+			Log.add(f"Command '{request}' raised {type(e).__name__}: {e}", warn=True)
+			return False, {"error": "Unexpected error occurred while executing the command."}
+		finally:
+			handler.duration.record(time.perf_counter() - start)
+
+	def respond(self, request, arguments):
+		return encode_response(*self.execute(request, arguments))
+
+	# Batches can't be nested, since a handler of a batch's command is looked up like any other
+	def execute_ordered(self, batch):
+		results = [None] * len(batch.commands)
+		for index, (request, arguments) in enumerate(batch.commands):
+			results[index] = self.execute(request, arguments)
+			if batch.stop_on_failure and not results[index][0]:
+				break
+		return batch.result(results)
+
+	def respond_ordered(self, batch):
+		return encode_response(*self.execute_ordered(batch))
+
+	# Whether every command of a batch has an inline handler, or none at all, so the batch can be answered inline too
+	def is_inline(self, batch):
+		return all(self._handlers.get(request) is None or self._handlers[request].inline for request, _ in batch.commands)
+
+	# An ordered batch can take as long as its commands together, an unordered one as long as the slowest of them
+	def batch_timeout(self, batch):
+		handlers = [self._handlers.get(request) for request, _ in batch.commands]
+		timeouts = [self.timeout_for(handler) for handler in handlers if handler is not None and not handler.inline]
+		if len(timeouts) == 0 or None in timeouts:
+			return None
+		return sum(timeouts) if batch.ordered else max(timeouts)
+
+
+class PendingCommand:
+	__slots__ = ("envelope", "request", "future", "deadline")
+
+	def __init__(self, envelope, request, future, timeout):
+		self.envelope = envelope
+		self.request = request
+		self.future = future
+		self.deadline = None if timeout is None else time.time() + timeout
+
+
+# Serves commands to any number of TCP clients over a ROUTER socket. REQ clients work as before, and DEALER clients
+# can pipeline several commands as long as they tag them, since every frame before the command is echoed back as
+# the reply's envelope. Commands run on a bounded worker pool and replies go out in the order they finish.
+# A command that runs past its timeout is answered with an error, though its worker can't be interrupted and
+# keeps running to completion. Once max_pending commands are waiting, new ones are refused until some finish.
+class CommandReceiver(TCPThread):
+	def __init__(self, zmq_context, registry, port, address="127.0.0.1", workers=4, max_pending=64):
+		super().__init__(zmq_context, zmq.ROUTER, address, port)
+
+		self.max_pending = max_pending
+		self._registry = registry
+		self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+		self._wakeup = WakeupSignal()
+		self._tokens = count()
+		# Owned by the socket thread
+		self._pending = dict()
+		# Tokens of commands finished by the workers, waiting for the socket thread to send their replies
+		self._finished = deque()
+		self._finished_lock = threading.Lock()
+		Metrics.gauge("commands_pending", "Commands waiting on or running in the worker pool", port=self._port) \
+			.set_function(lambda: len(self._pending))
+
+	@property
+	def pending_count(self):
+		return len(self._pending)
+
+	def run(self):
+		self._thread_init()
+
+		poller = zmq.Poller()
+		poller.register(self._socket, zmq.POLLIN)
+		poller.register(self._wakeup, zmq.POLLIN)
+		while not self._event.is_set():
+			events = dict(poller.poll(self._poll_timeout()))
+			# The poller reports file descriptors by number, not by the object that was registered
+			if self._wakeup.fileno() in events:
+				self._wakeup.clear()
+			if self._socket in events:
+				self._receive_commands()
+			self._send_finished()
+			self._expire_commands()
+
+		self._thread_complete()
+
+	def _poll_timeout(self):
+		deadlines = [pending.deadline for pending in self._pending.values() if pending.deadline is not None]
+		if len(deadlines) == 0:
+			return None
+		return max(0, (min(deadlines) - time.time()) * 1000)
+
+	def _receive_commands(self):
+		while True:
+			try:
+				frames = self._socket.recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				return
+
+			envelope = frames[:-1]
+			try:
+				request, arguments = decode_command(str(frames[-1], "utf-8"))
+				batch = CommandBatch.decode(arguments) if request == BATCH_REQUEST else None
+			except (CommandError, UnicodeDecodeError) as e:
+				self._reply(envelope, error_response(str(e)))
+				continue
+
+			if batch is not None:
+				self._receive_batch(envelope, batch)
+				continue
+			handler = self._registry.get(request)
+			if handler is None or handler.inline:
+				self._reply(envelope, self._registry.respond(request, arguments))
+			elif len(self._pending) >= self.max_pending:
+				self._reply(envelope, error_response(f"The command server is busy, '{request}' was not run."))
+			else:
+				self._submit(envelope, request, arguments, self._registry.timeout_for(handler))
+
+	def _submit(self, envelope, request, arguments, timeout):
+		self._track(envelope, request, self._executor.submit(self._registry.respond, request, arguments), timeout)
+
+	def _track(self, envelope, request, future, timeout):
+		token = next(self._tokens)
+		self._pending[token] = PendingCommand(envelope, request, future, timeout)
+		future.add_done_callback(lambda _: self._command_finished(token))
+
+	# A batch takes up a single pending slot. Ordered batches run on one worker, or inline when all of their commands
+	# are inline, and unordered ones spread their commands over the pool.
+	def _receive_batch(self, envelope, batch):
+		if batch.ordered and self._registry.is_inline(batch):
+			self._reply(envelope, self._registry.respond_ordered(batch))
+		elif len(self._pending) >= self.max_pending:
+			self._reply(envelope, error_response("The command server is busy, the batch was not run."))
+		elif batch.ordered:
+			self._track(envelope, BATCH_REQUEST, self._executor.submit(self._registry.respond_ordered, batch),
+						self._registry.batch_timeout(batch))
+		else:
+			self._track(envelope, BATCH_REQUEST, UnorderedBatch(self._registry, self._executor, batch).start(),
+						self._registry.batch_timeout(batch))
+
+	# Called on the worker thread that finished the command
+	def _command_finished(self, token):
+		with self._finished_lock:
+			self._finished.append(token)
+		self._wakeup.set()
+
+	def _send_finished(self):
+		with self._finished_lock:
+			tokens = list(self._finished)
+			self._finished.clear()
+
+		for token in tokens:
+			# Commands that already timed out were answered
+			pending = self._pending.pop(token, None)
+			if pending is None or pending.future.cancelled():
+				continue
+			self._reply(pending.envelope, pending.future.result())
+
+	def _expire_commands(self):
+		now = time.time()
+		expired = [token for token, pending in self._pending.items() if pending.deadline is not None and pending.deadline <= now]
+		for token in expired:
+			pending = self._pending.pop(token)
+			# Commands that never left the queue don't run at all
+			pending.future.cancel()
+			Log.add(f"Command '{pending.request}' timed out.", warn=True)
+			self._reply(pending.envelope, error_response(f"Command '{pending.request}' timed out."))
+
+	def _reply(self, envelope, response):
+		self._socket.send_multipart(envelope + [response.encode("utf-8")])
+
+	def _thread_complete(self):
+		self._executor.shutdown(wait=False, cancel_futures=True)
+		self._pending.clear()
+		self._socket.close(linger=0)
+		super()._thread_complete()
+
+	def stop(self):
+		super().stop()
+		self._wakeup.set()
+
+
+# Runs the commands of an unordered batch at the same time without tying up a worker to wait for them. Inline commands
+# run straight away on the calling thread, the rest on the pool, and the future returned by start() gets the encoded
+# response once the last of them finishes. Cancelling that future cancels the commands that haven't started.
+class UnorderedBatch:
+	def __init__(self, registry, executor, batch):
+		self._registry = registry
+		self._executor = executor
+		self._batch = batch
+		self._results = [None] * len(batch.commands)
+		self._futures = []
+		self._remaining = len(batch.commands)
+		self._failed = False
+		# Reentrant, since a future that is already done or gets cancelled runs its callbacks on the spot
+		self._lock = threading.RLock()
+		self.future = Future()
+
+	def start(self):
+		self.future.add_done_callback(self._cancel_if_cancelled)
+		with self._lock:
+			for index, (request, arguments) in enumerate(self._batch.commands):
+				if self._failed and self._batch.stop_on_failure:
+					self._remaining -= 1
+					continue
+				handler = self._registry.get(request)
+				if handler is None or handler.inline:
+					self._record(index, self._registry.execute(request, arguments))
+					if self._failed and self._batch.stop_on_failure:
+						self._cancel_submitted()
+				else:
+					future = self._executor.submit(self._registry.execute, request, arguments)
+					self._futures.append(future)
+					future.add_done_callback(lambda done, index=index: self._command_done(index, done))
+			self._finish_if_done()
+		return self.future
+
+	# Only call these with _lock held, except from the done callbacks, which take it
+	def _record(self, index, result):
+		self._results[index] = result
+		self._remaining -= 1
+		if not result[0]:
+			self._failed = True
+
+	def _finish_if_done(self):
+		if self._remaining == 0:
+			try:
+				self.future.set_result(encode_response(*self._batch.result(self._results)))
+			except InvalidStateError:
+				# The batch timed out and was already answered
+				pass
+
+	def _command_done(self, index, future):
+		with self._lock:
+			if future.cancelled():
+				self._remaining -= 1
+			else:
+				self._record(index, future.result())
+				if self._failed and self._batch.stop_on_failure:
+					self._cancel_submitted()
+			self._finish_if_done()
+
+	def _cancel_if_cancelled(self, future):
+		if future.cancelled():
+			self._cancel_submitted()
+
+	# Commands that are already running carry on, the rest are dropped
+	def _cancel_submitted(self):
+		for other in self._futures:
+			other.cancel()
+
+
+# Coroutine counterpart of CommandReceiver. Inline handlers run on the event loop, and every other handler runs on
+# the worker pool through run_in_executor, so the loop keeps serving clients while they work.
+class AsyncCommandReceiver:
+	def __init__(self, zmq_context, registry, port, address="127.0.0.1", workers=4, max_pending=64):
+		self.max_pending = max_pending
+		self._zmq_context = zmq_context
+		self._registry = registry
+		self._address = address
+		self._port = str(port)
+		self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+		self._socket = None
+		self._tasks = set()
+
+	@property
+	def pending_count(self):
+		return len(self._tasks)
+
+	async def run(self):
+		self._socket = self._zmq_context.socket(zmq.ROUTER)
+		bind_or_connect_tcp(self._socket, self._address, self._port)
+		try:
+			while True:
+				frames = await self._socket.recv_multipart()
+				await self._receive_command(frames[:-1], frames[-1])
+		finally:
+			for task in self._tasks:
+				task.cancel()
+			self._executor.shutdown(wait=False, cancel_futures=True)
+			self._socket.close(linger=0)
+
+	async def _receive_command(self, envelope, command_bytes):
+		try:
+			request, arguments = decode_command(str(command_bytes, "utf-8"))
+			batch = CommandBatch.decode(arguments) if request == BATCH_REQUEST else None
+		except (CommandError, UnicodeDecodeError) as e:
+			await self._reply(envelope, error_response(str(e)))
+			return
+
+		if batch is not None:
+			await self._receive_batch(envelope, batch)
+			return
+		handler = self._registry.get(request)
+		if handler is None or handler.inline:
+			await self._reply(envelope, self._registry.respond(request, arguments))
+		elif len(self._tasks) >= self.max_pending:
+			await self._reply(envelope, error_response(f"The command server is busy, '{request}' was not run."))
+		else:
+			task = asyncio.get_running_loop().create_task(
+				self._run_command(envelope, request, arguments, self._registry.timeout_for(handler)))
+			self._tasks.add(task)
+			task.add_done_callback(self._tasks.discard)
+
+	async def _receive_batch(self, envelope, batch):
+		if batch.ordered and self._registry.is_inline(batch):
+			await self._reply(envelope, self._registry.respond_ordered(batch))
+		elif len(self._tasks) >= self.max_pending:
+			await self._reply(envelope, error_response("The command server is busy, the batch was not run."))
+		else:
+			task = asyncio.get_running_loop().create_task(self._run_batch(envelope, batch))
+			self._tasks.add(task)
+			task.add_done_callback(self._tasks.discard)
+
+	async def _run_batch(self, envelope, batch):
+		if batch.ordered:
+			work = asyncio.get_running_loop().run_in_executor(self._executor, self._registry.respond_ordered, batch)
+		else:
+			work = asyncio.wrap_future(UnorderedBatch(self._registry, self._executor, batch).start())
+		try:
+			response = await asyncio.wait_for(work, self._registry.batch_timeout(batch))
+		except asyncio.TimeoutError:
+			Log.add("A command batch timed out.", warn=True)
+			response = error_response("The batch timed out.")
+		await self._reply(envelope, response)
+
+	async def _run_command(self, envelope, request, arguments, timeout):
+		work = asyncio.get_running_loop().run_in_executor(self._executor, self._registry.respond, request, arguments)
+		try:
+			response = await asyncio.wait_for(work, timeout)
+		except asyncio.TimeoutError:
+			Log.add(f"Command '{request}' timed out.", warn=True)
+			response = error_response(f"Command '{request}' timed out.")
+		await self._reply(envelope, response)
+
+	async def _reply(self, envelope, response):
+		# ROUTER sockets never block on send, they drop messages to unreachable clients instead
+		try:
+			await self._socket.send_multipart(envelope + [response.encode("utf-8")])
+		except zmq.ZMQError as e:
+			Log.add(f"Could not send a command reply: {e}", warn=True)
@@ -1,8 +1,42 @@
 import sys
 import os
+import io
+import atexit
+import threading
 from shutil import copyfile
 from configparser import ConfigParser
 
+from logger import Log
+
+
+# Callbacks by option name, called with the option and its new value whenever an entry changes
+_subscribers = dict()
+_subscribers_lock = threading.Lock()
+
+
+# Calls callback(option, value) every time the option changes, on the thread that changed it. That can be a command
+# worker or the thread watching Config.ini, so callbacks must be quick and thread safe.
+def subscribe(option, callback):
+	with _subscribers_lock:
+		_subscribers.setdefault(option, []).append(callback)
+
+
+def unsubscribe(option, callback):
+	with _subscribers_lock:
+		callbacks = _subscribers.get(option, [])
+		if callback in callbacks:
+			callbacks.remove(callback)
+
+
+def _notify(option, value):
+	with _subscribers_lock:
+		callbacks = list(_subscribers.get(option, []))
+	for callback in callbacks:
+		try:
+			callback(option, value)
+		except Exception as e:
+			Log.add(f"A subscriber to {option} raised {type(e).__name__}: {e}", warn=True)
+
 
 class ConfigEntry:
 	def __init__(self, entry_id, section, option, type, value):
@@ -41,8 +75,12 @@ class ConfigEntry:
 				pass
 
 		if parsed_value is not None:
+			module = sys.modules[__name__]
+			changed = not hasattr(module, self.option) or getattr(module, self.option) != parsed_value
 			self.value = value
-			setattr(sys.modules[__name__], self.option, parsed_value)
+			setattr(module, self.option, parsed_value)
+			if changed:
+				_notify(self.option, parsed_value)
 			return f"Set configuration entry {self.option} to {value}", True
 		else:
 			try:
@@ -59,8 +97,16 @@ class ConfigEntry:
 		return msg
 
 
+# Loads Config.ini, restoring anything missing from ConfigDefaults.ini, and keeps it in sync with the entries.
+# Changes are written by a background thread, which waits WRITE_DELAY for further changes so a burst of them is
+# written once, and replaces the file atomically so a crash never leaves it half written. Unless watch is False, the
+# same thread checks the file's modification time every WATCH_INTERVAL seconds and applies edits made outside
+# AutoCopilot to the entries, which notifies their subscribers.
 class ConfigManager:
-	def __init__(self):
+	WRITE_DELAY = 0.2
+	WATCH_INTERVAL = 1.0
+
+	def __init__(self, watch=True):
 		self.exception_raised = False
 		self.exception = None
 
@@ -75,16 +121,61 @@ class ConfigManager:
 		self.config.read(self.config_path)
 
 		self.entries = dict()
+		# Guards the entries and the parsed config, which commands and the writer thread both use
+		self._lock = threading.RLock()
+		# Only one thread writes the file at a time
+		self._write_lock = threading.Lock()
+		self._known_mtime = self._file_mtime()
+		self._writer = ConfigWriter(self, self.WATCH_INTERVAL if watch else None)
 
 		self.add_entry("Main", "UPDATE_HZ", "int")
+		self.add_entry("Main", "EVENT_DRIVEN", "bool")
+		self.add_entry("Main", "ASYNCIO", "bool")
+		self.add_entry("Main", "COMMAND_WORKERS", "int")
+		self.add_entry("Main", "COMMAND_TIMEOUT", "int")
 		self.add_entry("Drone", "INTERFACE_TIMEOUT", "int")
+		self.add_entry("Drone", "TELEMETRY_STREAM", "bool")
+		self.add_entry("Drone", "TELEMETRY_CONFLATE", "bool")
+		self.add_entry("Drone", "BINARY_WIRE_FORMAT", "bool")
+		self.add_entry("Drone", "TELEMETRY_HISTORY_SECONDS", "int")
+		self.add_entry("Drone", "HEARTBEAT_TIMEOUT", "int")
+		self.add_entry("Drone", "RESTART_ON_CRASH", "bool")
+		self.add_entry("Drone", "INTERFACE_COMMAND", "string")
+		self.add_entry("Drone", "TELEMETRY_BATCH", "bool")
+		self.add_entry("Drone", "TELEMETRY_BATCH_INTERVAL", "float")
+		self.add_entry("Rates", "ADAPTIVE_RATES", "bool")
+		self.add_entry("Rates", "GROUND_HZ", "int")
+		self.add_entry("Rates", "GROUND_VELOCITY_HZ", "int")
+		self.add_entry("Rates", "AIR_HZ", "int")
+		self.add_entry("Rates", "AIR_VELOCITY_HZ", "int")
+		self.add_entry("Rates", "SDK_CONTROL_HZ", "int")
+		self.add_entry("Rates", "SDK_CONTROL_VELOCITY_HZ", "int")
+		self.add_entry("Shared", "SHARED_TELEMETRY", "bool")
+		self.add_entry("Shared", "SHARED_TELEMETRY_SECONDS", "int")
+		self.add_entry("Recorder", "RECORDER_ENABLED", "bool")
+		self.add_entry("Recorder", "RECORDER_DIRECTORY", "string")
+		self.add_entry("Recorder", "RECORDER_SEGMENT_MB", "int")
+		self.add_entry("Log", "LOG_FILE", "string")
+		self.add_entry("Log", "LOG_BACKGROUND", "bool")
+		self.add_entry("Log", "LOG_FSYNC_INTERVAL", "float")
+		self.add_entry("Log", "LOG_MAX_BYTES", "int")
+		self.add_entry("Log", "LOG_BACKUP_COUNT", "int")
+		self.add_entry("Log", "INTERFACE_OUTPUT_MAX_BYTES", "int")
+		self.add_entry("Log", "INTERFACE_OUTPUT_BACKUP_COUNT", "int")
+		self.add_entry("Metrics", "METRICS_PORT", "int")
+		self.add_entry("Fleet", "FLEET_VEHICLES", "string")
+		self.add_entry("Fleet", "FLEET_MANAGED", "bool")
+
+		self._writer.start()
+		atexit.register(self.stop)
 
 	def add_entry(self, section, option, type):
-		self._validate_and_restore_section(section)
-		self._validate_and_restore_option(section, option)
+		with self._lock:
+			self._validate_and_restore_section(section)
+			self._validate_and_restore_option(section, option)
 
-		new_id = len(self.entries)
-		self.entries[new_id] = ConfigEntry(new_id, section, option, type, self.config[section][option])
+			new_id = len(self.entries)
+			self.entries[new_id] = ConfigEntry(new_id, section, option, type, self.config[section][option])
 
 	def _validate_and_restore_section(self, section):
 		if not self.config.has_section(section):
@@ -92,7 +183,7 @@ class ConfigManager:
 				raise LookupError(f"The section '{section}' does not exist in the  config.")
 
 			self.config.add_section(section)
-			self.config.write(open(self.config_path, 'w'))
+			self._save()
 
 	def _validate_and_restore_option(self, section, option):
 		if not self.config.has_option(section, option):
@@ -100,16 +191,17 @@ class ConfigManager:
 				raise LookupError(f"The option '{option}' does not exist under section '{section}' in the  config.")
 
 			self.config.set(section, option, self.default_config[section][option])
-			self.config.write(open(self.config_path, 'w'))
+			self._save()
 
 	def load_all_defaults(self):
-		self.default_config.write(open(self.config_path, 'w'))
-		self.config = ConfigParser()
-		self.config.read(self.config_path)
+		with self._lock:
+			self.config = ConfigParser()
+			self.config.read_dict(self.default_config)
+			self._save()
 
-		for entry in self.entries.values():
-			if self.config.has_option(entry.section, entry.value):
-				entry.set_value(self.config[entry.section][entry.option])
+			for entry in self.entries.values():
+				if self.config.has_option(entry.section, entry.option):
+					entry.set_value(self.config[entry.section][entry.option])
 
 		return "Set all config options to their defaults.", True
 
@@ -130,19 +222,124 @@ class ConfigManager:
 			return f"There is not config entry with the id '{entry_id}'", False
 		entry = self.entries[entry_id]
 
-		try:
-			self._validate_and_restore_section(entry.section)
-		except LookupError as e:
-			return str(e), False
+		with self._lock:
+			try:
+				self._validate_and_restore_section(entry.section)
+			except LookupError as e:
+				return str(e), False
 
-		msg, success = entry.set_value(value)
-		if success:
-			self.config.set(entry.section, entry.option, value)
-			self.config.write(open(self.config_path, 'w'))
+			msg, success = entry.set_value(value)
+			if success:
+				self.config.set(entry.section, entry.option, value)
+				self._save()
 		return msg, success
 
 	def make_configuration_msg(self):
-		configuration = list()
-		configuration.extend([entry.make_config_msg() for entry in self.entries.values()])
-		return configuration
-		
\ No newline at end of file
+		with self._lock:
+			configuration = list()
+			configuration.extend([entry.make_config_msg() for entry in self.entries.values()])
+			return configuration
+
+	# Queues the config to be written by the writer thread
+	def _save(self):
+		self._writer.request_write()
+
+	# Writes any change still queued, on the caller's thread
+	def flush(self):
+		if self._writer.take_write_request():
+			self._write_file()
+
+	# Writes any change still queued and stops the writer thread
+	def stop(self):
+		self._writer.stop()
+		self._writer.join()
+		self.flush()
+
+	def _file_mtime(self):
+		try:
+			return os.stat(self.config_path).st_mtime_ns
+		except FileNotFoundError:
+			return None
+
+	# Writes to a temporary file next to Config.ini and renames it over it, so readers only ever see a whole file
+	def _write_file(self):
+		with self._lock:
+			text = io.StringIO()
+			self.config.write(text)
+
+		with self._write_lock:
+			temp_path = self.config_path + ".tmp"
+			with open(temp_path, "w") as f:
+				f.write(text.getvalue())
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(temp_path, self.config_path)
+			self._known_mtime = self._file_mtime()
+
+	# Applies Config.ini to the entries if something else changed it since it was last read or written
+	def check_for_edits(self):
+		with self._write_lock:
+			mtime = self._file_mtime()
+			if mtime is None or mtime == self._known_mtime:
+				return
+			self._known_mtime = mtime
+			edited = ConfigParser()
+			edited.read(self.config_path)
+
+		with self._lock:
+			for entry in self.entries.values():
+				if not edited.has_option(entry.section, entry.option):
+					continue
+				value = edited[entry.section][entry.option]
+				if value == entry.value:
+					continue
+				msg, success = entry.set_value(value)
+				if success:
+					self.config.set(entry.section, entry.option, value)
+				Log.add(f"Config.ini was edited. {msg}", warn=not success)
+
+
+class ConfigWriter(threading.Thread):
+	def __init__(self, manager, watch_interval):
+		super().__init__(name="config-writer")
+		self._manager = manager
+		self._watch_interval = watch_interval
+		self._write_requested = False
+		self._request_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._halt_event = threading.Event()
+
+		self.daemon = True
+
+	def request_write(self):
+		with self._request_lock:
+			self._write_requested = True
+		self._wakeup.set()
+
+	# Returns True if a write was requested, and clears the request
+	def take_write_request(self):
+		with self._request_lock:
+			requested = self._write_requested
+			self._write_requested = False
+			return requested
+
+	def stop(self):
+		self._halt_event.set()
+		self._wakeup.set()
+
+	def run(self):
+		while not self._halt_event.is_set():
+			self._wakeup.wait(self._watch_interval)
+			self._wakeup.clear()
+			if self._halt_event.is_set():
+				break
+
+			if self._write_requested:
+				# Gives any further changes a moment to arrive, so they're all written at once
+				self._halt_event.wait(self._manager.WRITE_DELAY)
+				self._manager.flush()
+			elif self._watch_interval is not None:
+				try:
+					self._manager.check_for_edits()
+				except Exception as e:
+					Log.add(f"Could not read the edited Config.ini: {e}", warn=True)
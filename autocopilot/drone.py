@@ -1,13 +1,28 @@
 import time
 import os
+import shlex
 from enum import Enum
-from json import JSONDecoder
 from abc import ABC, abstractmethod
 from threading import Lock
 
+import asyncio
+
+import zmq
+
 import configure as config
-from zmq_threads import IPCRequestThread
-from utility import activate_feed, open_process_detached, kill_process, process_count
+from zmq_threads import IPCThread, IPCRequestThread, RequestQueueFullError, RequestLane
+from zmq_async import AsyncIPCRequestClient
+from reactor import ReactorRequestClient
+from wire_format import MessageDecoder, WireFormat, BINARY_TOPIC_SUFFIX, feed_topic
+from telemetry_buffer import TelemetryBuffer
+from shared_telemetry import SharedTelemetryWriter
+from time_alignment import ClockEstimator, align_telemetry
+from rate_policy import rate_mode, subscription_rates
+from log_tailer import LogTailer
+from supervisor import ProcessSupervisor
+from recorder import FlightRecorder, RecordTopic, RecordSource
+from utility import activate_feed, Snapshot
+from metrics import Metrics
 from logger import Log
 
 
@@ -23,6 +38,11 @@ class InterfaceFailState(str, Enum):
 	THREAD_TIMEOUT = "THREAD_TIMEOUT"
 
 
+class RecoveryTier(str, Enum):
+	RECONNECT = "RECONNECT"
+	RESTART = "RESTART"
+
+
 class FlightState(str, Enum):
 	STOPPED = "STOPPED"
 	ON_GROUND = "ON_GROUND"
@@ -34,166 +54,404 @@ class DJIMessageTopic(str, Enum):
 	FlightStatus = "FlightStatus"
 	ControlDevice = "ControlDevice"
 	Telemetry = "Telemetry"
-
-
-class DJIInterfaceThread(IPCRequestThread):
-	def __init__(self, zmq_context, message_callback, rate=10/1000):
-		super().__init__(zmq_context, message_callback, "drone", auto_feed_activation=False, rate=rate)
-
-		self._status = InterfaceState.OFFLINE
-		self._status_is_set = False
+	CommandResult = "CommandResult"
+	Heartbeat = "Heartbeat"
+	TelemetryBatch = "TelemetryBatch"
+
+
+# The interface's status as of its last reply or change of state. Replaced whole, never changed.
+class InterfaceSnapshot(Snapshot):
+	__slots__ = ("status", "fail_state", "fail_output", "status_is_set")
+
+
+# Everything known about the vehicle at one moment: the interface's snapshot, the flight state, the control device and
+# the newest telemetry sample as a read-only TELEMETRY_DTYPE record. Fields are None until their first message arrives.
+# updated is the time.monotonic() it was published at.
+class DroneState(Snapshot):
+	__slots__ = ("interface", "flight_state", "auto_mode", "return_to_home", "telemetry", "updated")
+
+
+# Message rate meters by topic and the decode time histogram for messages received through path, "reply" or "stream"
+def message_metrics(path):
+	meters = {topic: Metrics.meter("messages_total", "Messages received from the DJI interface", topic=topic.value, path=path)
+			for topic in DJIMessageTopic}
+	return meters, Metrics.histogram("decode_seconds", "Time spent decoding one message", path=path)
+
+
+# Request and reply handling shared by every client of the DJI interface, whether it runs on threads or coroutines.
+# Clients call _init_interface_state from their constructor and provide send_request, stop, initialized and
+# oldest_request. The interface process itself belongs to the supervisor, which outlives the clients.
+class DJIInterfaceProtocol:
+	# How often the interface is checked for timeouts while nothing else is happening
+	ERROR_CHECK_INTERVAL = 0.25
+	# Requests the interface answers straight from its receive loop. If one of these goes unanswered for longer than
+	# INTERFACE_TIMEOUT the interface is considered stuck.
+	PROMPT_REQUESTS = ("check_interface", "retrieve_data", "retrieve_batch")
+	# Requests the interface runs off its receive loop, which can legitimately take a while to be answered
+	LONG_RUNNING_REQUESTS = ("start_interface", "return_home", "set_rates")
+	LONG_RUNNING_TIMEOUT = 30
+	# Requests that only read the interface's state, so one outstanding copy can answer every caller
+	COALESCED_REQUESTS = ("check_interface", "retrieve_data", "retrieve_batch")
+	# Most requests that can be outstanding before send_request raises RequestQueueFullError
+	MAX_PENDING_REQUESTS = 16
+	# Requests outside the safety lane are held back while this many are in flight
+	MAX_IN_FLIGHT = 4
+	# Lanes of the requests that aren't sent in the CONTROL lane
+	REQUEST_LANES = {"return_home": RequestLane.SAFETY, "retrieve_data": RequestLane.TELEMETRY, "retrieve_batch": RequestLane.TELEMETRY}
+	# How long requests may wait to be sent before they're dropped, since data that arrives late is worthless
+	SEND_DEADLINES = {"retrieve_data": 0.5}
+
+	def _init_interface_state(self, wire_format, supervisor, recorder=None):
+		self._supervisor = supervisor
+		self._recorder = recorder
+		# Read without locking, replaced under _status_lock
+		self.snapshot = InterfaceSnapshot(status=InterfaceState.OFFLINE, status_is_set=False)
 		self._status_lock = Lock()
-		self._current_request = None
-		self._fail_state = None
-		self._fail_output = None
-		self._json_decoder = JSONDecoder()
+		self._stalled_request = None
+		# The wire format is requested with every check_interface. Replies are decoded based on their content,
+		# so an interface that doesn't support the requested format just keeps replying in JSON.
+		self._wire_format = wire_format
+		self._decoder = MessageDecoder()
+		self._message_meters, self._decode_time = message_metrics("reply")
 
 	@property
 	def status(self):
-		with self._status_lock:
-			return self._status
+		return self.snapshot.status
 
 	@property
 	def status_is_set(self):
-		with self._status_lock:
-			return self._status_is_set
+		return self.snapshot.status_is_set
 
 	@property
 	def current_request(self):
-		with self._request_state_lock:
-			return self._current_request
+		pending = self.oldest_request
+		return None if pending is None else pending.request.split(" ")[0]
 
 	@property
 	def request_in_progress(self):
-		with self._request_state_lock:
-			return self._request_in_progress
+		return self.waiting_on_reply
 
 	@property
 	def fail_state(self):
-		with self._status_lock:
-			return self._fail_state
+		return self.snapshot.fail_state
 
 	@property
 	def fail_output(self):
-		with self._status_lock:
-			return self._fail_output
+		return self.snapshot.fail_output
 
-	@staticmethod
-	def is_process_running():
-		return process_count("dji-interface") > 0
+	# Swaps in a copy of the snapshot with changes. Only call with _status_lock held.
+	def _update_snapshot(self, **changes):
+		self.snapshot = self.snapshot.replace(**changes)
 
-	def start(self):
-		super().start()
+	def is_process_running(self):
+		return self._supervisor.is_running
 
-	def update(self):
-		while True:
-			if not self._reply_queue.empty():
-				with self._request_state_lock:
-					self._request_in_progress = False
-
-				reply = self._reply_queue.get()
-				self._process_reply(reply)
-
-				with self._request_state_lock:
-					self.last_reply_time = time.time() - self._request_time
-			else:
-				self._check_for_errors()
-			time.sleep(self.rate)
+	def _request_expired(self, pending):
+		if pending.request.split(" ")[0] in self.PROMPT_REQUESTS:
+			with self._status_lock:
+				self._stalled_request = pending.request
 
 	def _check_for_errors(self):
 		if not self.initialized:
 			return
 
-		if self.waiting_on_reply and self.current_request == "retrieve_data":
-			if self.get_reply_time() > config.INTERFACE_TIMEOUT:
-				with self._status_lock:
-					self._fail_state = InterfaceFailState.THREAD_TIMEOUT
-					self._fail_output = "Drone interface timed out while waiting for a reply."
-				self.stop()
+		with self._status_lock:
+			stalled = self._stalled_request is not None
+
+		if stalled:
+			with self._status_lock:
+				self._update_snapshot(
+					fail_state=InterfaceFailState.THREAD_TIMEOUT, fail_output="Drone interface timed out while waiting for a reply.")
+			self.stop()
 
 	def _process_reply(self, replies):
+		messages = []
 		num_replies = len(replies)
 		for i in range(num_replies):
-			message = self._json_decoder.decode(str(replies[i], "utf-8"))
+			start = time.perf_counter()
+			message = self._decoder.decode(replies[i].buffer)
+			self._decode_time.record(time.perf_counter() - start)
+			if self._recorder is not None:
+				self._recorder.record(RecordTopic.from_name(message.get("topic")), RecordSource.REPLY, replies[i].buffer)
 			if "topic" not in message.keys():
 				Log.add("Skipping a message from the DJI interface without a topic.")
-				return
+				continue
 
 			topic = DJIMessageTopic(message["topic"])
+			self._message_meters[topic].inc()
 			# Parse interface status out to keep track of
 			if topic == DJIMessageTopic.InterfaceStatus:
 				with self._status_lock:
-					self._status = InterfaceState(message["state"])
-					self._fail_state = InterfaceFailState(message["fail_state"])
-					self._fail_output = message["fail_output"]
-					self._status_is_set = True
+					self._update_snapshot(
+						status=InterfaceState(message["state"]), fail_state=InterfaceFailState(message["fail_state"]),
+						fail_output=message["fail_output"], status_is_set=True)
 
 			last_msg = i == (num_replies - 1)
 			self._message_callback(topic, message, last_msg)
+			messages.append(message)
+		return messages
 
-	def _thread_init(self):
-		if activate_feed(self._feed_name, bound_process_name="dji-interface") is True:
+	# Starts a new interface process, or asks the one already bound to the feed for its status
+	def _launch_or_connect(self):
+		if self._supervisor.ensure_running():
 			Log.add("Starting up a new drone interface process")
-			current_folder = os.path.dirname(os.path.realpath(__file__))
-			parent_folder = current_folder[:current_folder.rindex("/")]
-			open_process_detached(parent_folder + "/bin/dji-interface")
 			with self._status_lock:
-				self._status_is_set = True
+				self._update_snapshot(status_is_set=True)
 		else:
 			Log.add("Connecting to the existing drone interface process")
 			self.send_request("check_interface")
-		super()._thread_init()	
 
-	def _thread_action(self):	
-		while not self._request_queue.empty():
-			with self._request_state_lock:
-				if self._request_in_progress:
-					continue
+	def _set_offline(self):
+		with self._status_lock:
+			self._update_snapshot(status=InterfaceState.OFFLINE)
+
+	def send_request(self, request, timeout=None):
+		request_type = request.split(" ")[0]
+		attempting = False
+		with self._status_lock:
+			if request == "start_interface" and self.snapshot.status is InterfaceState.OFFLINE:
+				self._update_snapshot(status=InterfaceState.ATTEMPTING)
+				attempting = True
+		# Prompt requests time out after INTERFACE_TIMEOUT, which also flags the interface as stuck
+		if timeout is None:
+			timeout = self.LONG_RUNNING_TIMEOUT if request_type in self.LONG_RUNNING_REQUESTS else config.INTERFACE_TIMEOUT
+		if request == "check_interface" and self._wire_format is not WireFormat.JSON:
+			request = request + " " + self._wire_format.value
+		try:
+			return super().send_request(
+				request, timeout, lane=self.REQUEST_LANES.get(request_type, RequestLane.CONTROL),
+				send_deadline=self.SEND_DEADLINES.get(request_type))
+		except RequestQueueFullError:
+			if attempting:
+				self._set_offline()
+			raise
+
+	def stop(self):
+		self._set_offline()
+		super().stop()
+
+class DJIInterfaceThread(DJIInterfaceProtocol, IPCRequestThread):
+	def __init__(self, zmq_context, message_callback, supervisor, rate=10/1000, event_driven=False, wire_format=WireFormat.JSON,
+				recorder=None, feed_name="drone"):
+		super().__init__(
+			zmq_context, message_callback, feed_name, auto_feed_activation=False, rate=rate, event_driven=event_driven,
+			max_pending=self.MAX_PENDING_REQUESTS, coalesced_requests=self.COALESCED_REQUESTS, max_in_flight=self.MAX_IN_FLIGHT)
+		self._init_interface_state(wire_format, supervisor, recorder)
 
-			request = self._request_queue.get()
+	def start(self):
+		super().start()
 
-			with self._request_state_lock:
-				self._current_request = request
-				self._request_in_progress = True
+	def _update_timeout(self):
+		return self.ERROR_CHECK_INTERVAL if self.event_driven else self.rate
 
-			self._socket.send_string(request)
-			self._reply_queue.put(self._socket.recv_multipart())
+	def _update_idle(self):
+		self._check_for_errors()
 
-			with self._request_state_lock:
-				self._current_request = None
+	def _thread_init(self):
+		self._launch_or_connect()
+		super()._thread_init()
 
 	def _thread_complete(self):
-		with self._status_lock:
-			self._status = InterfaceState.OFFLINE
+		self._set_offline()
 		super()._thread_complete()
 
-	def send_request(self, request):
-		with self._status_lock:
-			if request == "start_interface" and self.status is InterfaceState.OFFLINE:
-				self._status = InterfaceState.ATTEMPTING
-		super().send_request(request)
+
+# Subscription to the telemetry feed shared by the threaded and asyncio subscribers.
+class TelemetrySubscription:
+	STREAMED_TOPICS = (DJIMessageTopic.Telemetry, DJIMessageTopic.ControlDevice, DJIMessageTopic.FlightStatus, DJIMessageTopic.Heartbeat)
+	MAX_TOPIC_PREFIX = 32
+
+	def _init_subscription(self, message_callback, conflate, recorder=None, wire_format=WireFormat.JSON):
+		self._message_callback = message_callback
+		self._conflate = conflate
+		self._wire_format = wire_format
+		self._recorder = recorder
+		self._subscriptions = []
+		self._latest = dict()
+		self._latest_lock = Lock()
+		self._decoder = MessageDecoder()
+		self._message_meters, self._decode_time = message_metrics("stream")
+
+	def latest(self, topic):
+		with self._latest_lock:
+			return self._latest.get(topic)
+
+	# Heartbeats are only ever published as JSON
+	def _subscription_prefix(self, topic):
+		name = topic.value if topic is DJIMessageTopic.Heartbeat else feed_topic(topic.value, self._wire_format)
+		return name.encode("utf-8") + b" "
+
+	def _create_subscriptions(self, zmq_context, feed_name):
+		address = "ipc:///tmp/feeds/{}.ipc".format(feed_name)
+		if self._conflate:
+			# A conflating socket only keeps its newest message, so every topic needs its own socket
+			# to avoid a Telemetry sample overwriting a FlightStatus sample that hasn't been read yet
+			for topic in self.STREAMED_TOPICS:
+				socket = zmq_context.socket(zmq.SUB)
+				socket.setsockopt(zmq.CONFLATE, 1)
+				socket.setsockopt(zmq.SUBSCRIBE, self._subscription_prefix(topic))
+				socket.connect(address)
+				self._subscriptions.append(socket)
+		else:
+			socket = zmq_context.socket(zmq.SUB)
+			for topic in self.STREAMED_TOPICS:
+				socket.setsockopt(zmq.SUBSCRIBE, self._subscription_prefix(topic))
+			socket.connect(address)
+			self._subscriptions.append(socket)
+
+	def _process_message(self, buffer):
+		# Published frames are "<topic> <payload>". Only the short topic prefix is copied to find the separator,
+		# the payload is decoded straight out of the frame.
+		separator = bytes(buffer[:self.MAX_TOPIC_PREFIX]).index(b" ")
+		name = str(buffer[:separator], "utf-8")
+		if name.endswith(BINARY_TOPIC_SUFFIX):
+			name = name[:-len(BINARY_TOPIC_SUFFIX)]
+		topic = DJIMessageTopic(name)
+		payload = buffer[separator + 1:]
+		if self._recorder is not None:
+			self._recorder.record(RecordTopic.from_name(topic.value), RecordSource.STREAM, payload)
+		start = time.perf_counter()
+		message = self._decoder.decode(payload)
+		self._decode_time.record(time.perf_counter() - start)
+		self._message_meters[topic].inc()
+
+		with self._latest_lock:
+			self._latest[topic] = message
+		self._message_callback(topic, message, True)
+
+	# Processes every message waiting on socket without blocking
+	def _drain(self, socket):
+		while True:
+			try:
+				frame = socket.recv(zmq.NOBLOCK, copy=False)
+			except zmq.Again:
+				return
+			self._process_message(frame.buffer)
+
+
+class TelemetrySubscriberThread(TelemetrySubscription, IPCThread):
+	def __init__(self, zmq_context, message_callback, conflate=False, rate=10/1000, event_driven=False, recorder=None,
+				feed_name="telemetry", wire_format=WireFormat.JSON):
+		super().__init__(zmq_context, zmq.SUB, feed_name, auto_feed_activation=False, rate=rate, event_driven=event_driven)
+		self._init_subscription(message_callback, conflate, recorder, wire_format)
+
+	def _thread_init(self):
+		self._create_subscriptions(self._zmq_context, self._feed_name)
+		self._socket = self._subscriptions[0]
+
+	def _thread_action(self):
+		for socket in self._subscriptions:
+			self._drain(socket)
+
+	def _thread_event(self, events):
+		for socket in events:
+			self._drain(socket)
+
+	def _poll_items(self):
+		return [(socket, zmq.POLLIN) for socket in self._subscriptions]
+
+	def _thread_complete(self):
+		for socket in self._subscriptions:
+			socket.close(linger=0)
+		super()._thread_complete()
+
+
+class AsyncDJIInterface(DJIInterfaceProtocol, AsyncIPCRequestClient):
+	def __init__(self, zmq_context, message_callback, supervisor, wire_format=WireFormat.JSON, recorder=None):
+		super().__init__(
+			zmq_context, message_callback, "drone", max_pending=self.MAX_PENDING_REQUESTS, coalesced_requests=self.COALESCED_REQUESTS,
+			max_in_flight=self.MAX_IN_FLIGHT)
+		self._init_interface_state(wire_format, supervisor, recorder)
+
+	def _client_init(self):
+		self._launch_or_connect()
+		super()._client_init()
+
+	def _client_complete(self):
+		self._set_offline()
+		super()._client_complete()
+
+
+class AsyncTelemetrySubscriber(TelemetrySubscription):
+	def __init__(self, zmq_context, message_callback, conflate=False, recorder=None, wire_format=WireFormat.JSON):
+		self._zmq_context = zmq_context
+		self._task = None
+		self._init_subscription(message_callback, conflate, recorder, wire_format)
+
+	def start(self):
+		self._task = asyncio.get_running_loop().create_task(self.run())
+
+	def is_alive(self):
+		return self._task is not None and not self._task.done()
 
 	def stop(self):
-		with self._status_lock:
-			self._status = InterfaceState.OFFLINE
-		kill_process("dji-interface")
-		super().stop()
+		if self._task is not None:
+			self._task.cancel()
+
+	async def run(self):
+		self._create_subscriptions(self._zmq_context, "telemetry")
+		try:
+			await asyncio.gather(*[self._receive(socket) for socket in self._subscriptions])
+		finally:
+			for socket in self._subscriptions:
+				socket.close(linger=0)
+
+	async def _receive(self, socket):
+		while True:
+			frame = await socket.recv(copy=False)
+			self._process_message(frame.buffer)
 
-	@staticmethod
-	def read_error_log():
-		output_file = os.path.dirname(os.path.realpath(__file__)) + "/nohup.out"
-		error_string = None
-
-		if os.path.isfile(output_file):
-			f = open(output_file)
-			for line in f:
-				if "ERRORLOG" in line:
-					if error_string is not None:
-						error_string = error_string + "\n" + line
-					else:
-						error_string = line
 
-		return error_string
+# Interface client that runs on a shared IOReactor, so it costs a socket rather than two threads.
+# Replies are processed and handed to message_callback on the reactor thread.
+class ReactorDJIInterface(DJIInterfaceProtocol, ReactorRequestClient):
+	def __init__(self, reactor, message_callback, supervisor, wire_format=WireFormat.JSON, recorder=None, feed_name="drone"):
+		super().__init__(
+			reactor, message_callback, feed_name, max_pending=self.MAX_PENDING_REQUESTS, coalesced_requests=self.COALESCED_REQUESTS,
+			max_in_flight=self.MAX_IN_FLIGHT)
+		self._init_interface_state(wire_format, supervisor, recorder)
+
+	def _client_init(self):
+		self._launch_or_connect()
+		super()._client_init()
+
+	def _client_complete(self):
+		self._set_offline()
+		super()._client_complete()
+
+
+class ReactorTelemetrySubscriber(TelemetrySubscription):
+	def __init__(self, reactor, message_callback, conflate=False, recorder=None, feed_name="telemetry", wire_format=WireFormat.JSON):
+		self._reactor = reactor
+		self._feed_name = feed_name
+		self._started = False
+		self._stopped = False
+		self._init_subscription(message_callback, conflate, recorder, wire_format)
+
+	def start(self):
+		self._started = True
+		self._reactor.call_soon(self._attach)
+
+	def is_alive(self):
+		return self._started and not self._stopped
+
+	def stop(self):
+		if self._started and not self._stopped:
+			self._stopped = True
+			self._reactor.call_soon(self._detach)
+
+	def _attach(self):
+		if self._stopped:
+			return
+		self._create_subscriptions(self._reactor.zmq_context, self._feed_name)
+		for socket in self._subscriptions:
+			self._reactor.register(socket, lambda socket=socket: self._drain(socket))
+
+	def _detach(self):
+		for socket in self._subscriptions:
+			self._reactor.unregister(socket)
+			socket.close(linger=0)
+		self._subscriptions = []
 
 
 class Drone(ABC):
@@ -221,37 +479,299 @@ class Drone(ABC):
 
 
 class DJIDrone(Drone):
-	def __init__(self, zmq_context, rate=10/1000):
+	# The telemetry history is sized for this many samples per second
+	TELEMETRY_HISTORY_HZ = 50
+	# FlightStatus states by their OSDK value
+	FLIGHT_STATES = (FlightState.STOPPED, FlightState.ON_GROUND, FlightState.IN_AIR)
+	# How long to wait before asking again after the interface failed to change its subscription rates
+	RATE_RETRY_INTERVAL = 5
+
+	def __init__(self, zmq_context, rate=10/1000, event_driven=False):
 		super().__init__()
 		self._update_rate = rate
+		self._event_driven = event_driven
+		# Written only by the thread delivering telemetry, read without locking
+		self.telemetry = TelemetryBuffer.for_duration(config.TELEMETRY_HISTORY_SECONDS, self.TELEMETRY_HISTORY_HZ)
+		# Fitted to the telemetry's flight controller times as it arrives
+		self.clock = ClockEstimator()
 		self._zmq_context = zmq_context
 		self._interface = None
+		self._telemetry_subscriber = None
+		self.supervisor = self._make_supervisor()
+		self._known_restart_count = 0
+		self._next_batch_time = 0
+		# Readers load state once and use that copy, writers publish through _publish_state
+		self.state = DroneState()
+		self._state_lock = Lock()
+		# The (fast, velocity) rates last asked of the interface, and the set_rates request while it's outstanding
+		self._requested_rates = None
+		self._rates_request = None
+		self._next_rates_time = 0
+		# (tier, detection time) of the recovery in progress, and (tier, seconds taken) of the last one that finished
+		self._recovery = None
+		self.last_recovery = None
+		self._recovery_attempts = {tier: Metrics.counter(
+			"interface_recovery_attempts_total", "Recoveries from a stalled interface started at each tier",
+			feed=self.drone_feed, tier=tier.value) for tier in RecoveryTier}
+		self._recovery_time = {tier: Metrics.histogram(
+			"interface_recovery_seconds", "Time from a stalled request being detected to the interface answering again",
+			feed=self.drone_feed, tier=tier.value) for tier in RecoveryTier}
+		self.recorder = self._start_recorder() if config.RECORDER_ENABLED else None
+		# Telemetry for other processes on this computer, see shared_telemetry
+		self.shared_telemetry = self._start_shared_telemetry() if config.SHARED_TELEMETRY else None
+		# ERRORLOG lines the interface printed, followed from its output as it grows
+		output_path = getattr(self.supervisor, "output_path", None)
+		self.error_log = None if output_path is None else LogTailer(output_path)
 		self._reinitialize_interface()
+		self._publish_state()
+
+	@property
+	def drone_feed(self):
+		return "drone"
+
+	# Name of the shared memory region the telemetry is published to, /dev/shm/<name> on Linux
+	@property
+	def shared_telemetry_name(self):
+		return "autocopilot-telemetry"
+
+	def _start_shared_telemetry(self):
+		capacity = max(1, int(config.SHARED_TELEMETRY_SECONDS * self.TELEMETRY_HISTORY_HZ))
+		return SharedTelemetryWriter(self.shared_telemetry_name, capacity)
+
+	@staticmethod
+	def _start_recorder():
+		recorder = FlightRecorder(DJIDrone._recording_directory(), segment_bytes=config.RECORDER_SEGMENT_MB * 1024 * 1024)
+		recorder.start()
+		return recorder
+
+	@staticmethod
+	def _recording_directory():
+		directory = config.RECORDER_DIRECTORY
+		if directory == "":
+			directory = os.path.dirname(os.path.realpath(__file__)) + "/recordings"
+		return directory
+
+	@staticmethod
+	def _make_supervisor():
+		current_folder = os.path.dirname(os.path.realpath(__file__))
+		parent_folder = current_folder[:current_folder.rindex("/")]
+		# INTERFACE_COMMAND can swap in a stand-in such as "python3 autocopilot/simulator.py", run from the repository root
+		command = shlex.split(config.INTERFACE_COMMAND)
+		if len(command) == 0:
+			command = [parent_folder + "/bin/dji-interface"]
+		return ProcessSupervisor(
+			"dji-interface", command, "/tmp/feeds/dji-interface.pid", output_path=current_folder + "/nohup.out",
+			heartbeat_timeout=DJIDrone._heartbeat_timeout(), restart_on_exit=config.RESTART_ON_CRASH,
+			before_start=lambda: activate_feed("drone"), cwd=parent_folder, **DJIDrone._output_rotation())
+
+	@staticmethod
+	def _output_rotation():
+		max_bytes = config.INTERFACE_OUTPUT_MAX_BYTES
+		return {"output_max_bytes": max_bytes if max_bytes > 0 else None,
+				"output_backup_count": config.INTERFACE_OUTPUT_BACKUP_COUNT}
+
+	@staticmethod
+	def _heartbeat_timeout():
+		# Heartbeats arrive on the telemetry feed, so without it only exits can be detected
+		return config.HEARTBEAT_TIMEOUT if config.TELEMETRY_STREAM else None
+
+	def heartbeat_timeout_changed(self):
+		self.supervisor.set_heartbeat_timeout(self._heartbeat_timeout())
 
 	@property
 	def interface_status(self):
 		return self._interface.status
 
+	# Changes the period of the interface and telemetry threads while they run
+	def set_update_rate(self, rate):
+		self._update_rate = rate
+		for thread in (self._interface, self._telemetry_subscriber):
+			if thread is not None:
+				thread.rate = rate
+
 	def update(self):
-		if self._interface.fail_state is InterfaceFailState.THREAD_TIMEOUT:
-			Log.add(self._interface.fail_output)
+		if self.supervisor.restart_count != self._known_restart_count:
+			# The supervisor replaced a crashed or hung process, so requests in flight to the old one will never be answered
+			self._known_restart_count = self.supervisor.restart_count
 			self._reinitialize_interface()
+		elif self._interface.fail_state is InterfaceFailState.THREAD_TIMEOUT:
+			Log.add(self._interface.fail_output)
+			self._recover_interface(self._interface.fail_output)
 		else:
-			if self._interface.status == InterfaceState.ATTEMPTING:
-				if self._interface.current_request is None:
+			status = self._interface.status
+			if status == InterfaceState.ONLINE:
+				if config.TELEMETRY_BATCH:
+					self._retrieve_batch()
+				if config.ADAPTIVE_RATES:
+					self._apply_rate_policy()
+			else:
+				# A vehicle connected later starts out subscribed at the interface's default rates
+				self._requested_rates = None
+				if status == InterfaceState.ATTEMPTING and self._interface.current_request is None:
 					self.check_interface()
 
+		# Interface changes that didn't come with a message, like a client stopping or being replaced
+		if self.state.interface is not self._interface.snapshot:
+			self._publish_state()
+
+	# Publishes a copy of the state with changes and the interface's current snapshot. Messages are delivered on the
+	# reply and telemetry threads at once, so writers take _state_lock, while readers only ever load self.state.
+	def _publish_state(self, **changes):
+		with self._state_lock:
+			interface = self._interface
+			self.state = self.state.replace(
+				interface=None if interface is None else interface.snapshot, updated=time.monotonic(), **changes)
+
+	# Drains the samples the interface buffered since the last batch, once every TELEMETRY_BATCH_INTERVAL
+	def _retrieve_batch(self):
+		now = time.monotonic()
+		if now < self._next_batch_time:
+			return
+		self._next_batch_time = now + config.TELEMETRY_BATCH_INTERVAL
+		try:
+			self._interface.send_request("retrieve_batch")
+		except RequestQueueFullError:
+			# The samples stay buffered in the interface until the next batch
+			pass
+
+	# The ERRORLOG lines the interface printed most recently, one per line, or None if there are none
+	def read_error_log(self):
+		if self.error_log is None:
+			return None
+		self.error_log.poll()
+		return "\n".join(self.error_log.entries) if len(self.error_log.entries) > 0 else None
+
+	@property
+	def recovering(self):
+		return self._recovery is not None
+
+	# Recovers from a stalled request in tiers. The first stall only replaces the client and its socket, which keeps the
+	# interface process and its link to the vehicle, and the new client's check_interface verifies the process still
+	# answers. When that stalls as well, or the process isn't running, the process is killed and started again.
+	def _recover_interface(self, reason):
+		now = time.monotonic()
+		recovery = self._recovery
+		if recovery is None and self.supervisor.is_running:
+			tier, detected = RecoveryTier.RECONNECT, now
+		else:
+			tier, detected = RecoveryTier.RESTART, now if recovery is None else recovery[1]
+			if self.error_log is not None:
+				for entry in self.error_log.poll():
+					Log.add(f"The drone interface logged: {entry}", warn=True)
+			if self.supervisor.is_running:
+				self.supervisor.restart(reason)
+				self._known_restart_count = self.supervisor.restart_count
+		Log.add(f"Recovering the drone interface, tier {tier.value}", warn=True)
+		self._recovery = (tier, detected)
+		self._recovery_attempts[tier].inc()
+		self._reinitialize_interface()
+
+	# Called for every InterfaceStatus, which only ever arrives as a reply
+	def _interface_answered(self):
+		recovery = self._recovery
+		if recovery is None:
+			return
+		self._recovery = None
+		tier, detected = recovery
+		seconds = time.monotonic() - detected
+		self._recovery_time[tier].record(seconds)
+		self.last_recovery = (tier, seconds)
+		Log.add(f"The drone interface recovered {seconds:.2f} seconds after stalling, tier {tier.value}")
+
+	# Asks the interface to resubscribe at the rates of the current flight state and control mode whenever they change.
+	# Only one set_rates is outstanding at a time, since the interface refuses another while it's resubscribing.
+	def _apply_rate_policy(self):
+		state = self.state
+		if state.flight_state is None or (self._rates_request is not None and not self._rates_request.done()):
+			return
+		rates = subscription_rates(rate_mode(state.flight_state is FlightState.IN_AIR, bool(state.auto_mode)))
+		if rates == self._requested_rates or time.monotonic() < self._next_rates_time:
+			return
+		try:
+			self._rates_request = self._interface.send_request(f"set_rates {rates[0]} {rates[1]}")
+		except RequestQueueFullError:
+			return
+		self._requested_rates = rates
+		self._rates_request.add_done_callback(lambda future: self._rates_changed(future, rates))
+
+	def _rates_changed(self, future, rates):
+		if future.cancelled():
+			error = "the request was cancelled"
+		elif future.exception() is not None:
+			error = str(future.exception())
+		else:
+			replies = future.result()
+			result = replies[0] if len(replies) > 0 else {}
+			error = None if result.get("success", False) else result.get("message", "")
+
+		if error is None:
+			Log.add(f"Telemetry subscribed at {rates[0]} Hz, with velocity at {rates[1]} Hz")
+		else:
+			Log.add(f"The drone interface couldn't change its telemetry rates: {error}", warn=True)
+			self._next_rates_time = time.monotonic() + self.RATE_RETRY_INTERVAL
+			self._requested_rates = None
+
 	def _reinitialize_interface(self):
 		if self._interface is not None and self._interface.is_alive():
 			self._interface.stop()
-		self._interface = DJIInterfaceThread(self._zmq_context, self._process_drone_update, rate=self._update_rate)
-		self._interface.start()
-		self._interface.start_update_async()
+		wire_format = WireFormat.BINARY if config.BINARY_WIRE_FORMAT else WireFormat.JSON
+		self._interface = self._start_interface_client(wire_format)
+
+		if config.TELEMETRY_STREAM:
+			if self._telemetry_subscriber is not None and self._telemetry_subscriber.is_alive():
+				self._telemetry_subscriber.stop()
+			self._telemetry_subscriber = self._start_telemetry_subscriber(wire_format)
+
+	def _start_interface_client(self, wire_format):
+		interface = DJIInterfaceThread(
+			self._zmq_context, self._process_drone_update, self.supervisor, rate=self._update_rate,
+			event_driven=self._event_driven, wire_format=wire_format, recorder=self.recorder)
+		interface.start()
+		interface.start_update_async()
+		return interface
+
+	def _start_telemetry_subscriber(self, wire_format):
+		subscriber = TelemetrySubscriberThread(
+			self._zmq_context, self._process_drone_update, conflate=config.TELEMETRY_CONFLATE,
+			rate=self._update_rate, event_driven=self._event_driven, recorder=self.recorder, wire_format=wire_format)
+		subscriber.start()
+		return subscriber
 
 	def _process_drone_update(self, topic, message, last_msg):
-		if topic == DJIMessageTopic.InterfaceStatus:
+		# With batches every sample reaches the history through them, so single samples would be duplicates
+		if topic == DJIMessageTopic.Telemetry and not config.TELEMETRY_BATCH:
+			self.telemetry.append_message(time.monotonic(), message)
+			self._telemetry_added(1)
+		elif topic == DJIMessageTopic.TelemetryBatch:
+			if message["dropped"] > 0:
+				Log.add(f"The drone interface dropped {message['dropped']} telemetry samples between batches.", warn=True)
+			if len(message["samples"]) > 0:
+				self.telemetry.extend(message["samples"])
+				self._telemetry_added(len(message["samples"]))
+		elif topic == DJIMessageTopic.FlightStatus:
+			state = message["state"]
+			self._publish_state(flight_state=self.FLIGHT_STATES[state] if state < len(self.FLIGHT_STATES) else None)
+		elif topic == DJIMessageTopic.ControlDevice:
+			self._publish_state(auto_mode=message["auto_mode"], return_to_home=message["return_to_home"])
+		elif topic == DJIMessageTopic.Heartbeat:
+			self.supervisor.heartbeat()
+		elif topic == DJIMessageTopic.InterfaceStatus:
+			self._interface_answered()
+			self._publish_state()
 			Log.add("Received drone connection status from the interface " + self.interface_status)
 
+	def _telemetry_added(self, count):
+		samples = self.telemetry.last(count)
+		self.clock.add(samples["fc_time"], samples["received"])
+		if self.shared_telemetry is not None:
+			self.shared_telemetry.write(samples)
+		self._publish_state(telemetry=self.telemetry.latest_copy())
+
+	# The last seconds of telemetry on a uniform grid at hz, as an array of ALIGNED_DTYPE. Samples are placed at when
+	# the flight controller sent them once the clock has pairs to go on, and at when they arrived until then.
+	def aligned_telemetry(self, seconds, hz):
+		return align_telemetry(self.telemetry.since(time.monotonic() - seconds).copy(), hz, self.clock)
+
 	def start_interface(self):
 		with self.drone_status_lock:
 			if self._interface.status == InterfaceState.ONLINE:
@@ -266,9 +786,12 @@ class DJIDrone(Drone):
 						self._interface.stop()
 					else:
 						# Then start the interface
-						self._interface.send_request("start_interface")
-						self._interface.send_request("check_interface")
-						msg, result = "Attempting to start the drone interface.", True
+						try:
+							self._interface.send_request("start_interface")
+							self._interface.send_request("check_interface")
+							msg, result = "Attempting to start the drone interface.", True
+						except RequestQueueFullError as e:
+							msg, result = f"Couldn't start the drone interface, it isn't keeping up with requests. {e}", False
 				else:
 					msg, result = "Tried to start the interface before it was initialized.", False
 
@@ -281,6 +804,8 @@ class DJIDrone(Drone):
 			msg, result = "Tried to stop the drone interface but it is not running.", False
 		else:
 			Log.add("Rebooting the drone interface process.")
+			self.supervisor.restart()
+			self._known_restart_count = self.supervisor.restart_count
 			self._reinitialize_interface()
 			msg, result = "Stopping the drone interface and reinitializing the process.", True
 
@@ -292,5 +817,38 @@ class DJIDrone(Drone):
 		if not self._interface.is_alive():
 			return "Interface Status: " + self.interface_status, True
 
-		self._interface.send_request("check_interface")
+		try:
+			self._interface.send_request("check_interface")
+		except RequestQueueFullError as e:
+			return f"The drone interface isn't keeping up with requests. {e}", False
 		return "Requesting an interface status update.", True
+
+
+# Runs the interface client and telemetry subscriber as coroutines on the running event loop, instead of threads.
+# It must be created from a coroutine, and run() takes the place of the interface's update thread.
+class AsyncDJIDrone(DJIDrone):
+	def __init__(self, zmq_context):
+		super().__init__(zmq_context, event_driven=True)
+
+	def set_update_rate(self, rate):
+		# The coroutines are event driven, so there's no period to change
+		self._update_rate = rate
+
+	def _start_interface_client(self, wire_format):
+		interface = AsyncDJIInterface(
+			self._zmq_context, self._process_drone_update, self.supervisor, wire_format=wire_format, recorder=self.recorder)
+		interface.start()
+		return interface
+
+	def _start_telemetry_subscriber(self, wire_format):
+		subscriber = AsyncTelemetrySubscriber(
+			self._zmq_context, self._process_drone_update, conflate=config.TELEMETRY_CONFLATE, recorder=self.recorder,
+			wire_format=wire_format)
+		subscriber.start()
+		return subscriber
+
+	async def run(self):
+		while True:
+			self._interface._check_for_errors()
+			self.update()
+			await asyncio.sleep(DJIInterfaceProtocol.ERROR_CHECK_INTERVAL)
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+
+import zmq
+
+import configure as config
+from benchmark import summarize_latencies, _git_revision
+from drone import InterfaceState
+from fleet import FleetManager
+from simulator import SimulatedFault
+from logger import Log
+
+
+# Version of the layout of the JSON results, bumped whenever a field changes meaning
+RESULTS_VERSION = 1
+
+
+# Injects faults into a simulated interface run as a supervised process, like the real one, and times how long the
+# drone takes to recover from each. A fault is injected through the interface's own request socket, then a
+# check_interface runs into it. A trial ends when the drone reports a finished recovery, so time_to_recover is
+# measured by the drone from detecting the stall, and outage from injecting the fault, which also covers detection.
+class FaultInjector:
+	def __init__(self, zmq_context, update_hz, telemetry_hz):
+		self.zmq_context = zmq_context
+		self.update_hz = update_hz
+		self.vehicle_id = f"faults-{os.getpid()}"
+		self.fleet = FleetManager(zmq_context)
+		simulator = os.path.join(os.path.dirname(os.path.realpath(__file__)), "simulator.py")
+		self.drone = self.fleet.add_vehicle(
+			self.vehicle_id, command=[sys.executable, simulator, "--online", "--hz", str(telemetry_hz)])
+
+	def stop(self):
+		self.fleet.stop()
+		shutil.rmtree(self.fleet.feed_directory(self.vehicle_id), ignore_errors=True)
+
+	# Runs the drone's update loop until condition holds, returning False if that takes longer than timeout
+	def _update_until(self, condition, timeout):
+		deadline = time.monotonic() + timeout
+		while not condition():
+			if time.monotonic() > deadline:
+				return False
+			self.fleet.update()
+			time.sleep(1 / self.update_hz)
+		return True
+
+	def _inject(self, fault):
+		socket = self.zmq_context.socket(zmq.DEALER)
+		socket.RCVTIMEO = 2000
+		try:
+			socket.connect("ipc://{}/drone.ipc".format(self.fleet.feed_directory(self.vehicle_id)))
+			socket.send_multipart([b"fault", f"inject_fault {fault.value}".encode("utf-8")])
+			socket.recv_multipart()
+		finally:
+			socket.close(linger=0)
+
+	# A newly started interface only reports its state when asked
+	def _healthy(self):
+		if self.drone.recovering:
+			return False
+		if self.drone.interface_status == InterfaceState.ONLINE:
+			return True
+		if self.drone._interface.initialized:
+			self.drone.check_interface()
+		return False
+
+	def run_trial(self, fault, timeout):
+		if not self._update_until(self._healthy, timeout):
+			return {"fault": fault.value, "recovered": False, "error": "The interface never came online."}
+
+		previous = self.drone.last_recovery
+		self._inject(fault)
+		start = time.monotonic()
+		self.drone.check_interface()
+		if not self._update_until(lambda: self.drone.last_recovery is not previous, timeout):
+			return {"fault": fault.value, "recovered": False, "error": f"No recovery after {timeout} seconds."}
+
+		tier, seconds = self.drone.last_recovery
+		return {"fault": fault.value, "recovered": True, "tier": tier.value, "time_to_recover": seconds,
+				"outage": time.monotonic() - start}
+
+
+def run_trials(args):
+	faults = [SimulatedFault(fault) for fault in args.faults]
+	results = {
+		"version": RESULTS_VERSION,
+		"timestamp": time.time(),
+		"git_revision": _git_revision(),
+		"parameters": {"faults": args.faults, "trials": args.trials, "interface_timeout": config.INTERFACE_TIMEOUT,
+						"update_hz": args.update_hz, "telemetry_hz": args.telemetry_hz},
+		"trials": [],
+		"tiers": {}}
+
+	injector = FaultInjector(zmq.Context(), args.update_hz, args.telemetry_hz)
+	try:
+		for fault in faults:
+			for trial in range(args.trials):
+				Log.add(f"Injecting {fault.value}, trial {trial + 1} of {args.trials}")
+				results["trials"].append(injector.run_trial(fault, args.trial_timeout))
+	finally:
+		injector.stop()
+		injector.zmq_context.term()
+
+	recovered = [trial for trial in results["trials"] if trial["recovered"]]
+	for tier in sorted(set(trial["tier"] for trial in recovered)):
+		trials = [trial for trial in recovered if trial["tier"] == tier]
+		results["tiers"][tier] = {"time_to_recover": summarize_latencies([trial["time_to_recover"] for trial in trials]),
+								"outage": summarize_latencies([trial["outage"] for trial in trials])}
+	return results
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(
+		description="Measures mean time to recovery of the drone interface for each recovery tier, by injecting faults "
+					"into a simulated interface.")
+	parser.add_argument("--output", help="File to write the JSON results to, instead of stdout.")
+	parser.add_argument("--faults", type=lambda value: value.split(","),
+						default=[fault.value for fault in SimulatedFault], help="Comma separated faults to inject.")
+	parser.add_argument("--trials", type=int, default=5, help="Times each fault is injected.")
+	parser.add_argument("--trial-timeout", type=float, default=30, help="Longest wait for the interface to recover.")
+	parser.add_argument("--interface-timeout", type=float,
+						help="Seconds before an unanswered request counts as a stall, INTERFACE_TIMEOUT by default.")
+	parser.add_argument("--update-hz", type=int, default=32, help="Rate of the drone's update loop.")
+	parser.add_argument("--telemetry-hz", type=float, default=50, help="Telemetry rate of the simulated interface.")
+	args = parser.parse_args(argv)
+	known_faults = [fault.value for fault in SimulatedFault]
+	for fault in args.faults:
+		if fault not in known_faults:
+			parser.error(f"Unknown fault '{fault}'.")
+
+	config.ConfigManager()
+	# Recordings of injected faults aren't worth keeping
+	config.RECORDER_ENABLED = False
+	if args.interface_timeout is not None:
+		config.INTERFACE_TIMEOUT = args.interface_timeout
+	with contextlib.redirect_stdout(sys.stderr):
+		Log.start_background()
+		try:
+			results = run_trials(args)
+		finally:
+			Log.stop_background()
+
+	output = json.dumps(results, indent=2)
+	if args.output is None:
+		print(output)
+	else:
+		with open(args.output, "w") as f:
+			f.write(output + "\n")
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,179 @@
+import os
+import re
+import shlex
+from threading import Lock
+
+import configure as config
+from drone import DJIDrone, ReactorDJIInterface, ReactorTelemetrySubscriber
+from reactor import IOReactor, ReactorProcessSupervisor
+from supervisor import UnmanagedProcess
+from utility import activate_feed
+from logger import Log
+
+
+# One vehicle of a fleet. Its interface binds its feeds in /tmp/feeds/<vehicle id>/, and its request and telemetry
+# sockets run on the fleet's shared reactor instead of threads of their own, so messages are handled on the reactor
+# thread. Fleet listeners get every message tagged with the vehicle's id.
+# Its frames go to the fleet's recorder, tagged with the vehicle, and the recorder is left running when it stops.
+class FleetDrone(DJIDrone):
+	def __init__(self, zmq_context, reactor, vehicle_id, supervisor, listeners, recorder=None):
+		self.vehicle_id = vehicle_id
+		self._reactor = reactor
+		self._supervisor = supervisor
+		self._listeners = listeners
+		self._fleet_recorder = recorder
+		super().__init__(zmq_context, event_driven=True)
+
+	@property
+	def drone_feed(self):
+		return f"{self.vehicle_id}/drone"
+
+	@property
+	def telemetry_feed(self):
+		return f"{self.vehicle_id}/telemetry"
+
+	@property
+	def shared_telemetry_name(self):
+		return f"autocopilot-telemetry-{self.vehicle_id}"
+
+	def _make_supervisor(self):
+		return self._supervisor
+
+	def _start_recorder(self):
+		return None if self._fleet_recorder is None else self._fleet_recorder.for_vehicle(self.vehicle_id)
+
+	def set_update_rate(self, rate):
+		# The reactor is event driven, so there's no period to change
+		self._update_rate = rate
+
+	def update(self):
+		# Timed out requests are flagged on the reactor thread but acted on here, like the interface thread's idle check
+		self._interface._check_for_errors()
+		super().update()
+
+	def _start_interface_client(self, wire_format):
+		interface = ReactorDJIInterface(
+			self._reactor, self._process_drone_update, self.supervisor, wire_format=wire_format, recorder=self.recorder,
+			feed_name=self.drone_feed)
+		interface.start()
+		return interface
+
+	def _start_telemetry_subscriber(self, wire_format):
+		subscriber = ReactorTelemetrySubscriber(
+			self._reactor, self._process_drone_update, conflate=config.TELEMETRY_CONFLATE, recorder=self.recorder,
+			feed_name=self.telemetry_feed, wire_format=wire_format)
+		subscriber.start()
+		return subscriber
+
+	def _process_drone_update(self, topic, message, last_msg):
+		super()._process_drone_update(topic, message, last_msg)
+		for listener in self._listeners:
+			listener(self.vehicle_id, topic, message)
+
+	def stop(self):
+		if self._interface is not None:
+			self._interface.stop()
+		if self._telemetry_subscriber is not None:
+			self._telemetry_subscriber.stop()
+		self.supervisor.stop()
+		if self.shared_telemetry is not None:
+			self.shared_telemetry.close()
+
+
+# Manages any number of vehicles from one AutoCopilot. All of their interface sockets are driven by a single
+# IOReactor thread, so adding a vehicle adds a few sockets and a FleetDrone rather than threads. Vehicles whose
+# interface AutoCopilot starts itself also get a supervisor, which watches its process from the same reactor.
+# Every vehicle is recorded into one recording, in which frames are tagged with the vehicle they came from.
+class FleetManager:
+	FEED_DIRECTORY = "/tmp/feeds"
+	VEHICLE_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+	def __init__(self, zmq_context):
+		self.zmq_context = zmq_context
+		self.reactor = IOReactor(zmq_context)
+		self.reactor.start()
+		self.recorder = DJIDrone._start_recorder() if config.RECORDER_ENABLED else None
+		self._vehicles = dict()
+		self._vehicles_lock = Lock()
+		self._listeners = []
+
+	@property
+	def vehicle_ids(self):
+		with self._vehicles_lock:
+			return list(self._vehicles.keys())
+
+	def vehicle(self, vehicle_id):
+		with self._vehicles_lock:
+			return self._vehicles[vehicle_id]
+
+	def feed_directory(self, vehicle_id):
+		return os.path.join(self.FEED_DIRECTORY, vehicle_id)
+
+	# Listeners are called with (vehicle id, topic, message) for every message from every vehicle, on the reactor
+	# thread. They must not block.
+	def add_listener(self, callback):
+		self._listeners.append(callback)
+
+	def remove_listener(self, callback):
+		self._listeners.remove(callback)
+
+	# Adds a vehicle whose interface binds its feeds in feed_directory(vehicle_id). Without a command the interface is
+	# expected to be started by something else, otherwise command is run with AUTOCOPILOT_FEED_DIR set to that
+	# directory and restarted like the single vehicle interface. An empty command runs bin/dji-interface.
+	def add_vehicle(self, vehicle_id, command=None):
+		if self.VEHICLE_ID.match(vehicle_id) is None:
+			raise ValueError(f"'{vehicle_id}' can't be used as a vehicle id. Use letters, digits, '-' and '_'.")
+		with self._vehicles_lock:
+			if vehicle_id in self._vehicles:
+				raise ValueError(f"Vehicle '{vehicle_id}' is already part of the fleet.")
+
+			os.makedirs(self.feed_directory(vehicle_id), exist_ok=True)
+			supervisor = UnmanagedProcess(f"dji-interface-{vehicle_id}") if command is None else self._make_supervisor(vehicle_id, command)
+			drone = FleetDrone(self.zmq_context, self.reactor, vehicle_id, supervisor, self._listeners, recorder=self.recorder)
+			self._vehicles[vehicle_id] = drone
+		Log.add(f"Added vehicle {vehicle_id} to the fleet")
+		return drone
+
+	def remove_vehicle(self, vehicle_id):
+		with self._vehicles_lock:
+			drone = self._vehicles.pop(vehicle_id)
+		drone.stop()
+		Log.add(f"Removed vehicle {vehicle_id} from the fleet")
+
+	def _make_supervisor(self, vehicle_id, command):
+		current_folder = os.path.dirname(os.path.realpath(__file__))
+		parent_folder = current_folder[:current_folder.rindex("/")]
+		directory = self.feed_directory(vehicle_id)
+		if isinstance(command, str):
+			command = shlex.split(command)
+		if len(command) == 0:
+			command = [parent_folder + "/bin/dji-interface"]
+		return ReactorProcessSupervisor(
+			self.reactor, f"dji-interface-{vehicle_id}", command, directory + "/dji-interface.pid", output_path=directory + "/nohup.out",
+			heartbeat_timeout=DJIDrone._heartbeat_timeout(), restart_on_exit=config.RESTART_ON_CRASH,
+			before_start=lambda: activate_feed(f"{vehicle_id}/drone"), cwd=parent_folder,
+			env={"AUTOCOPILOT_FEED_DIR": directory}, **DJIDrone._output_rotation())
+
+	def update(self):
+		with self._vehicles_lock:
+			vehicles = list(self._vehicles.values())
+		for drone in vehicles:
+			drone.update()
+
+	def interface_status(self):
+		with self._vehicles_lock:
+			return {vehicle_id: drone.interface_status.value for vehicle_id, drone in self._vehicles.items()}
+
+	def heartbeat_timeout_changed(self):
+		with self._vehicles_lock:
+			vehicles = list(self._vehicles.values())
+		for drone in vehicles:
+			drone.heartbeat_timeout_changed()
+
+	def stop(self):
+		for vehicle_id in self.vehicle_ids:
+			self.remove_vehicle(vehicle_id)
+		self.reactor.stop()
+		self.reactor.join()
+		if self.recorder is not None:
+			self.recorder.stop()
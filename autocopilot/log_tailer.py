@@ -0,0 +1,92 @@
+import os
+from collections import deque
+
+
+# Follows a file another process appends to, reading only what was added since the last poll. Reads start at the byte
+# offset the last poll stopped at and go in large chunks, and lines containing marker are found by searching the chunk
+# for it rather than splitting every line. They're kept in a bounded index that drops the oldest first.
+# A file replaced under the same path is read from its start. It's recognized by a new inode or, since inodes get
+# reused, by its first bytes no longer matching. A file truncated in place by copy-truncate rotation has the rest of
+# its old content read from backup_path first, if the backup has it.
+class LogTailer:
+	CHUNK_SIZE = 1 << 20
+	# Bytes at the start of the file compared to tell a replacement with a reused inode from the same file
+	FINGERPRINT_BYTES = 64
+
+	def __init__(self, path, marker=b"ERRORLOG", max_entries=100, backup_path=None):
+		self.path = path
+		self.marker = marker
+		self.backup_path = path + ".1" if backup_path is None else backup_path
+		self.entries = deque(maxlen=max_entries)
+		self._inode = None
+		self._fingerprint = b""
+		self._offset = 0
+		# The end of the last chunk, up to where a line will be completed by the next read
+		self._partial = b""
+
+	@property
+	def offset(self):
+		return self._offset
+
+	# Reads whatever was added since the last poll, returning the new entries
+	def poll(self):
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return []
+
+		new_entries = []
+		if stat.st_ino != self._inode or (stat.st_size >= self._offset and not self._same_start()):
+			self._inode = stat.st_ino
+			self._restart()
+		elif stat.st_size < self._offset:
+			self._read(self.backup_path, self._offset, new_entries)
+			self._restart()
+		self._offset = self._read(self.path, self._offset, new_entries)
+		if len(self._fingerprint) < self.FINGERPRINT_BYTES:
+			self._fingerprint = self._start()
+		return new_entries
+
+	def _restart(self):
+		self._offset = 0
+		self._partial = b""
+		self._fingerprint = b""
+
+	def _start(self):
+		try:
+			with open(self.path, "rb", buffering=0) as f:
+				return f.read(self.FINGERPRINT_BYTES)
+		except FileNotFoundError:
+			return b""
+
+	def _same_start(self):
+		return self._start()[:len(self._fingerprint)] == self._fingerprint
+
+	# Reads path from offset to its end, returning the offset reached
+	def _read(self, path, offset, new_entries):
+		try:
+			with open(path, "rb", buffering=0) as f:
+				f.seek(offset)
+				while True:
+					chunk = f.read(self.CHUNK_SIZE)
+					if not chunk:
+						return offset
+					offset += len(chunk)
+					self._partial = self._scan(self._partial + chunk, new_entries)
+		except FileNotFoundError:
+			return offset
+
+	# Indexes the complete lines of data that contain the marker, returning the incomplete line at its end
+	def _scan(self, data, new_entries):
+		end = data.rfind(b"\n") + 1
+		position = data.find(self.marker, 0, end)
+		while position >= 0:
+			start = data.rfind(b"\n", 0, position) + 1
+			stop = data.find(b"\n", position)
+			entry = data[start:stop].decode("utf-8", "replace")
+			self.entries.append(entry)
+			new_entries.append(entry)
+			position = data.find(self.marker, stop, end)
+		partial = data[end:]
+		# Output without line breaks isn't worth holding on to
+		return partial if len(partial) <= self.CHUNK_SIZE else b""
@@ -1,29 +1,201 @@
 import os
 import datetime
 import sys
+import time
+import atexit
+import threading
+from queue import Queue, Empty, Full
+
+
+class LogRecord:
+	__slots__ = ("timestamp", "entry", "warn")
+
+	def __init__(self, timestamp, entry, warn):
+		self.timestamp = timestamp
+		self.entry = entry
+		self.warn = warn
+
+	def format(self):
+		line = '{:%H:%M:%S}'.format(datetime.datetime.fromtimestamp(self.timestamp)) + "\t"
+		if self.warn:
+			line = line + "WARNING: "
+		return line + self.entry
+
 
 class Logger():
 	def __init__(self, filepath=None):
-		self.writing_logfile = filepath is not None
-		if self.writing_logfile:
-			if os.path.isfile(filepath):
-				self.logfile = open(filepath, 'a')
-				self.add(f"{sys.argv[0]} is now appending to this log file " + '({:%Y-%m-%d})'.format(datetime.datetime.now()))
-			else:
-				self.logfile = open(filepath, 'w')
-				self.add(f"Starting log file for {sys.argv[0]} at '{filepath}' on date " + '{:%Y-%m-%d}'.format(datetime.datetime.now()))
+		self.writing_logfile = False
+		self.filepath = None
+		self.dropped_records = 0
+		# Set by start_background
+		self._queue = None
+		self._writer = None
+		if filepath is not None:
+			self.open_logfile(filepath)
+
+	def open_logfile(self, filepath):
+		self.writing_logfile = True
+		self.filepath = filepath
+		if os.path.isfile(filepath):
+			self.logfile = open(filepath, 'a')
+			self.add(f"{sys.argv[0]} is now appending to this log file " + '({:%Y-%m-%d})'.format(datetime.datetime.now()))
+		else:
+			self.logfile = open(filepath, 'w')
+			self.add(f"Starting log file for {sys.argv[0]} at '{filepath}' on date " + '{:%Y-%m-%d}'.format(datetime.datetime.now()))
+
+	@property
+	def background(self):
+		return self._queue is not None
 
 	def add(self, entry, warn=False):
-		line = '{:%H:%M:%S}'.format(datetime.datetime.now()) + "\t"
-		if warn:
-			line = line + "WARNING: "
-		line = line + entry
+		record = LogRecord(time.time(), entry, warn)
+		if self._queue is not None:
+			try:
+				self._queue.put_nowait(record)
+			except Full:
+				# Counted and reported by the writer once it catches up, rather than blocking the caller
+				self.dropped_records += 1
+			return
 
+		line = record.format()
 		if self.writing_logfile:
 			self.logfile.write(line + "\n")
 			self.logfile.flush()
 			os.fsync(self.logfile.fileno())
 		print(line)
 
+	# Moves all formatting and writing onto a background thread, so add only timestamps the entry and queues it.
+	# Records are written in batches and the log file is only fsynced every fsync_interval seconds or fsync_bytes bytes.
+	# Once the file grows past max_bytes it's rotated to filepath.1 after the batch that crossed the limit, keeping
+	# backup_count old files.
+	# When queue_size records are already waiting, new ones are dropped and counted.
+	def start_background(self, queue_size=4096, fsync_interval=1.0, fsync_bytes=64 * 1024, max_bytes=None, backup_count=3):
+		if self._queue is not None:
+			return
+		self._queue = Queue(maxsize=queue_size)
+		self._writer = LogWriter(self, self._queue, fsync_interval, fsync_bytes, max_bytes, backup_count)
+		self._writer.start()
+		atexit.register(self.stop_background)
+
+	# Blocks until every queued record is written and the log file is synced
+	def flush(self):
+		if self._queue is not None:
+			self._queue.join()
+			self._writer.sync_requested.set()
+			self._queue.put(None)
+			self._queue.join()
+
+	# Writes out everything still queued and goes back to writing on the caller's thread
+	def stop_background(self):
+		if self._queue is None:
+			return
+		writer = self._writer
+		self._queue = None
+		self._writer = None
+		writer.stop()
+		writer.join()
+
+
+class LogWriter(threading.Thread):
+	# Most records written per batch
+	BATCH_SIZE = 256
+
+	def __init__(self, logger, queue, fsync_interval, fsync_bytes, max_bytes, backup_count):
+		super().__init__(name="log-writer")
+		self.sync_requested = threading.Event()
+
+		self._logger = logger
+		self._queue = queue
+		self._fsync_interval = fsync_interval
+		self._fsync_bytes = fsync_bytes
+		self._max_bytes = max_bytes
+		self._backup_count = backup_count
+		self._halt_event = threading.Event()
+		self._unsynced_bytes = 0
+		self._last_sync_time = time.monotonic()
+		self._reported_drops = 0
+
+		self.daemon = True
+
+	def stop(self):
+		self._halt_event.set()
+		self._queue.put(None)
+
+	def run(self):
+		while not (self._halt_event.is_set() and self._queue.empty()):
+			batch = self._next_batch()
+			lines = [record.format() for record in batch if record is not None]
+
+			dropped = self._logger.dropped_records
+			if dropped != self._reported_drops:
+				lines.append(LogRecord(time.time(), f"Dropped {dropped - self._reported_drops} log records", True).format())
+				self._reported_drops = dropped
+
+			if len(lines) > 0:
+				self._write("\n".join(lines) + "\n")
+			self._sync_if_due()
+
+			for _ in batch:
+				self._queue.task_done()
+
+		if self._logger.writing_logfile:
+			self._sync()
+
+	def _next_batch(self):
+		try:
+			batch = [self._queue.get(timeout=self._fsync_interval)]
+		except Empty:
+			return []
+
+		while len(batch) < self.BATCH_SIZE:
+			try:
+				batch.append(self._queue.get_nowait())
+			except Empty:
+				break
+		return batch
+
+	def _write(self, text):
+		sys.stdout.write(text)
+		sys.stdout.flush()
+
+		logger = self._logger
+		if not logger.writing_logfile:
+			return
+		logger.logfile.write(text)
+		self._unsynced_bytes += len(text)
+		if self._max_bytes is not None and logger.logfile.tell() >= self._max_bytes:
+			self._rotate()
+
+	def _sync_if_due(self):
+		if not self._logger.writing_logfile or (self._unsynced_bytes == 0 and not self.sync_requested.is_set()):
+			return
+		now = time.monotonic()
+		if self.sync_requested.is_set() or self._unsynced_bytes >= self._fsync_bytes or now - self._last_sync_time >= self._fsync_interval:
+			self.sync_requested.clear()
+			self._sync()
+
+	def _sync(self):
+		logfile = self._logger.logfile
+		logfile.flush()
+		os.fsync(logfile.fileno())
+		self._unsynced_bytes = 0
+		self._last_sync_time = time.monotonic()
+
+	def _rotate(self):
+		logger = self._logger
+		self._sync()
+		logger.logfile.close()
+
+		for index in range(self._backup_count - 1, 0, -1):
+			source = f"{logger.filepath}.{index}"
+			if os.path.exists(source):
+				os.replace(source, f"{logger.filepath}.{index + 1}")
+		if self._backup_count > 0:
+			os.replace(logger.filepath, logger.filepath + ".1")
+		else:
+			os.remove(logger.filepath)
+
+		logger.logfile = open(logger.filepath, 'w')
+
 
-Log = Logger(filepath=None)
\ No newline at end of file
+Log = Logger(filepath=None)
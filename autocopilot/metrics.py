@@ -0,0 +1,298 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Counters, gauges and latency histograms that any thread can update, collected into a snapshot for the stats command
+# or rendered as Prometheus text for a scraper. Updating a metric takes one uncontended lock and never allocates, so
+# hot paths look their metrics up once and keep them, rather than going through the registry every time.
+METRIC_PREFIX = "autocopilot_"
+
+
+class Counter:
+	kind = "counter"
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._value = 0
+
+	def inc(self, amount=1):
+		with self._lock:
+			self._value += amount
+
+	@property
+	def value(self):
+		return self._value
+
+	def snapshot(self):
+		return {"value": self._value}
+
+
+# A counter that also keeps one second buckets of what was counted, to report a recent rate
+class Meter(Counter):
+	# Seconds the rate is averaged over, not counting the second in progress
+	WINDOW = 5
+	# Buckets kept, a power of two above WINDOW
+	SLOTS = 8
+
+	def __init__(self):
+		super().__init__()
+		self._slot_seconds = [-1] * self.SLOTS
+		self._slot_counts = [0] * self.SLOTS
+
+	def inc(self, amount=1):
+		second = int(time.monotonic())
+		slot = second & (self.SLOTS - 1)
+		with self._lock:
+			self._value += amount
+			if self._slot_seconds[slot] != second:
+				self._slot_seconds[slot] = second
+				self._slot_counts[slot] = 0
+			self._slot_counts[slot] += amount
+
+	@property
+	def rate(self):
+		current = int(time.monotonic())
+		with self._lock:
+			total = sum(count for second, count in zip(self._slot_seconds, self._slot_counts)
+						if current - self.WINDOW <= second < current)
+		return total / self.WINDOW
+
+	def snapshot(self):
+		return {"value": self._value, "rate": self.rate}
+
+
+# A gauge is either set directly, or reads its value from a function whenever it's collected, which costs nothing
+# until then and suits things like queue depths
+class Gauge:
+	kind = "gauge"
+
+	def __init__(self):
+		self._value = 0
+		self._function = None
+
+	def set(self, value):
+		self._value = value
+
+	def set_function(self, function):
+		self._function = function
+
+	@property
+	def value(self):
+		if self._function is not None:
+			return self._function()
+		return self._value
+
+	def snapshot(self):
+		return {"value": self.value}
+
+
+# Latency histogram with HDR-style log-linear buckets over whole microseconds. Values below 2^SUB_BUCKET_BITS
+# microseconds get a bucket each, and every power of two above that is split into 2^(SUB_BUCKET_BITS - 1) buckets,
+# so any recorded value is known to within 1 / 2^(SUB_BUCKET_BITS - 1) of itself, from a microsecond to an hour.
+class Histogram:
+	kind = "histogram"
+	SUB_BUCKET_BITS = 7
+	# Longer values are counted in the last bucket, a little over an hour
+	MAX_MICROSECONDS = 2 ** 32
+	QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._half_count = 1 << (self.SUB_BUCKET_BITS - 1)
+		self._counts = [0] * (self._bucket_index(self.MAX_MICROSECONDS) + 1)
+		self._count = 0
+		self._sum = 0.0
+		self._min = None
+		self._max = None
+
+	def _bucket_index(self, microseconds):
+		shift = microseconds.bit_length() - self.SUB_BUCKET_BITS
+		if shift <= 0:
+			return microseconds
+		return shift * self._half_count + (microseconds >> shift)
+
+	def _bucket_upper_bound(self, index):
+		if index < 2 * self._half_count:
+			return index + 1
+		shift = index // self._half_count - 1
+		return (index - shift * self._half_count + 1) << shift
+
+	# Records a duration in seconds
+	def record(self, seconds):
+		microseconds = min(max(int(seconds * 1000000), 0), self.MAX_MICROSECONDS)
+		index = self._bucket_index(microseconds)
+		with self._lock:
+			self._counts[index] += 1
+			self._count += 1
+			self._sum += seconds
+			if self._min is None or seconds < self._min:
+				self._min = seconds
+			if self._max is None or seconds > self._max:
+				self._max = seconds
+
+	@property
+	def count(self):
+		return self._count
+
+	# Upper bounds in seconds of the buckets the given quantiles fall in, capped at the largest recorded value
+	def quantiles(self, quantiles=QUANTILES):
+		with self._lock:
+			counts = list(self._counts)
+			total = self._count
+			maximum = self._max
+		if total == 0:
+			return [None for _ in quantiles]
+
+		results = []
+		targets = sorted((max(1, int(quantile * total + 0.5)), i) for i, quantile in enumerate(quantiles))
+		seen = 0
+		target = 0
+		for index, count in enumerate(counts):
+			seen += count
+			while target < len(targets) and seen >= targets[target][0]:
+				results.append((targets[target][1], min(self._bucket_upper_bound(index) / 1000000, maximum)))
+				target += 1
+			if target == len(targets):
+				break
+		return [value for _, value in sorted(results)]
+
+	def snapshot(self):
+		with self._lock:
+			count, total, minimum, maximum = self._count, self._sum, self._min, self._max
+		summary = {"count": count, "sum": total, "min": minimum, "max": maximum,
+					"mean": total / count if count > 0 else None}
+		for quantile, value in zip(self.QUANTILES, self.quantiles()):
+			summary["p{:g}".format(quantile * 100)] = value
+		return summary
+
+
+class MetricFamily:
+	def __init__(self, name, kind, description):
+		self.name = name
+		self.kind = kind
+		self.description = description
+		# Metrics by their sorted (label, value) pairs
+		self.metrics = dict()
+
+
+class MetricsRegistry:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._families = dict()
+		self._start_time = time.monotonic()
+
+	# Returns the metric with this name and labels, creating it the first time
+	def _get(self, metric_type, name, description, labels):
+		key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+		with self._lock:
+			family = self._families.get(name)
+			if family is None:
+				family = self._families[name] = MetricFamily(name, metric_type.kind, description)
+			elif family.kind != metric_type.kind:
+				raise ValueError(f"The metric '{name}' is a {family.kind}, not a {metric_type.kind}.")
+			metric = family.metrics.get(key)
+			if metric is None:
+				metric = family.metrics[key] = metric_type()
+			return metric
+
+	def counter(self, name, description="", **labels):
+		return self._get(Counter, name, description, labels)
+
+	def meter(self, name, description="", **labels):
+		return self._get(Meter, name, description, labels)
+
+	def gauge(self, name, description="", **labels):
+		return self._get(Gauge, name, description, labels)
+
+	def histogram(self, name, description="", **labels):
+		return self._get(Histogram, name, description, labels)
+
+	def _families_copy(self):
+		with self._lock:
+			return [(family, list(family.metrics.items())) for family in self._families.values()]
+
+	def snapshot(self):
+		metrics = dict()
+		for family, items in self._families_copy():
+			metrics[family.name] = {"type": family.kind, "help": family.description,
+									"samples": [dict(labels=dict(key), **metric.snapshot()) for key, metric in items]}
+		return {"uptime": time.monotonic() - self._start_time, "metrics": metrics}
+
+	# Renders every metric in the Prometheus text exposition format. Histograms are exported as summaries, since
+	# their quantiles are what's kept, and meters as plain counters.
+	def prometheus_text(self):
+		lines = []
+		for family, items in self._families_copy():
+			name = METRIC_PREFIX + family.name
+			kind = "summary" if family.kind == "histogram" else family.kind
+			lines.append(f"# HELP {name} {_escape_help(family.description)}")
+			lines.append(f"# TYPE {name} {kind}")
+			for key, metric in items:
+				if family.kind == "histogram":
+					for quantile, value in zip(metric.QUANTILES, metric.quantiles()):
+						if value is not None:
+							lines.append(f"{name}{_format_labels(key + (('quantile', str(quantile)),))} {value!r}")
+					snapshot = metric.snapshot()
+					lines.append(f"{name}_sum{_format_labels(key)} {snapshot['sum']!r}")
+					lines.append(f"{name}_count{_format_labels(key)} {snapshot['count']}")
+				else:
+					lines.append(f"{name}{_format_labels(key)} {metric.value!r}")
+		return "\n".join(lines) + "\n"
+
+
+def _escape_help(text):
+	return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(key):
+	if len(key) == 0:
+		return ""
+	escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in key)
+	return "{" + ",".join(f"{label}=\"{value}\"" for (label, _), value in zip(key, escaped)) + "}"
+
+
+# Serves the registry as Prometheus text on http://address:port/metrics from a background thread.
+# It only listens on the loopback interface unless told otherwise.
+class MetricsServer:
+	def __init__(self, registry, port, address="127.0.0.1"):
+		self.registry = registry
+		self.port = port
+		self.address = address
+		self._server = None
+		self._thread = None
+
+	def start(self):
+		registry = self.registry
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] not in ("/", "/metrics"):
+					self.send_error(404)
+					return
+				body = registry.prometheus_text().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = ThreadingHTTPServer((self.address, self.port), Handler)
+		self._server.daemon_threads = True
+		# Port 0 picks a free port
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+
+Metrics = MetricsRegistry()
@@ -0,0 +1,49 @@
+from enum import Enum
+
+import configure as config
+
+# Package frequencies the OSDK accepts, in Hz
+SUBSCRIPTION_FREQUENCIES = (1, 5, 10, 50, 100, 200, 400)
+# The most often each package can be sent, the lowest maxFreq among its topics: GPS_FUSED and STATUS_DISPLAYMODE for the
+# fast package, GPS_VELOCITY for the velocity package
+FAST_PACKAGE_MAX_HZ = 50
+VELOCITY_PACKAGE_MAX_HZ = 5
+
+
+class RateMode(str, Enum):
+	GROUND = "GROUND"
+	AIR = "AIR"
+	SDK_CONTROL = "SDK_CONTROL"
+
+
+# The lowest frequency the OSDK accepts that isn't below hz, so a configured rate is never quietly lowered past what
+# the package allows. Rates above the package's maximum are clamped to it.
+def subscription_frequency(hz, max_hz):
+	for frequency in SUBSCRIPTION_FREQUENCIES:
+		if frequency >= min(hz, max_hz):
+			return frequency
+	return max_hz
+
+
+# Whether the OSDK accepts the pair of package rates, as the interface checks them for set_rates
+def is_subscription_rates(hz, velocity_hz):
+	return (hz in SUBSCRIPTION_FREQUENCIES and hz <= FAST_PACKAGE_MAX_HZ
+			and velocity_hz in SUBSCRIPTION_FREQUENCIES and velocity_hz <= VELOCITY_PACKAGE_MAX_HZ)
+
+
+# SDK control wins over the flight state, since the vehicle is then flying itself on what AutoCopilot sees
+def rate_mode(in_air, auto_mode):
+	if auto_mode:
+		return RateMode.SDK_CONTROL
+	return RateMode.AIR if in_air else RateMode.GROUND
+
+
+# (fast package Hz, velocity package Hz) for a mode, read from the config every time so changes apply on the next update
+def subscription_rates(mode):
+	if mode is RateMode.SDK_CONTROL:
+		rates = config.SDK_CONTROL_HZ, config.SDK_CONTROL_VELOCITY_HZ
+	elif mode is RateMode.AIR:
+		rates = config.AIR_HZ, config.AIR_VELOCITY_HZ
+	else:
+		rates = config.GROUND_HZ, config.GROUND_VELOCITY_HZ
+	return subscription_frequency(rates[0], FAST_PACKAGE_MAX_HZ), subscription_frequency(rates[1], VELOCITY_PACKAGE_MAX_HZ)
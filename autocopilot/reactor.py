@@ -0,0 +1,377 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import TimeoutError
+from itertools import count
+
+import zmq
+
+from zmq_threads import WakeupSignal, PendingRequest, RequestAbortedError, RequestMetrics, RequestAdmission, RequestLanes, RequestLane
+from supervisor import ProcessSupervisor
+from utility import UnexpectedStateError
+from logger import Log
+
+
+# One thread and one zmq.Poller driving the sockets of any number of clients, so a client costs a socket and its
+# state rather than threads of its own. Sockets are created, used and closed on the reactor thread only. Other
+# threads hand work to it with call_soon, which wakes the poller.
+# Socket handlers and calls run one at a time on the reactor thread, so they must not block. A handler that raises is
+# logged and the reactor carries on with the other clients.
+class IOReactor(threading.Thread):
+	def __init__(self, zmq_context):
+		super().__init__(name="io-reactor")
+		self.zmq_context = zmq_context
+
+		self._poller = zmq.Poller()
+		self._wakeup = WakeupSignal()
+		self._halt_event = threading.Event()
+		self._calls = deque()
+		# Readable handlers by socket
+		self._handlers = dict()
+		# Clients with deadlines. _next_deadline() returns the time.time() a client next needs attention, or None, and
+		# _on_timer() is called after every pass to act on whatever is due.
+		self._timed_clients = []
+
+		self.daemon = True
+
+	# Runs function(*args) on the reactor thread. Safe to call from any thread.
+	def call_soon(self, function, *args):
+		self._calls.append((function, args))
+		self._wakeup.set()
+
+	# Only call these from the reactor thread. Besides zmq sockets, any file descriptor can be registered by number.
+	def register(self, socket, handler):
+		self._handlers[socket] = handler
+		self._poller.register(socket, zmq.POLLIN)
+
+	def unregister(self, socket):
+		if self._handlers.pop(socket, None) is not None:
+			self._poller.unregister(socket)
+
+	def add_timed_client(self, client):
+		self._timed_clients.append(client)
+
+	def remove_timed_client(self, client):
+		if client in self._timed_clients:
+			self._timed_clients.remove(client)
+
+	@property
+	def socket_count(self):
+		return len(self._handlers)
+
+	def stop(self):
+		self._halt_event.set()
+		self._wakeup.set()
+
+	def run(self):
+		self._poller.register(self._wakeup, zmq.POLLIN)
+		wakeup_fd = self._wakeup.fileno()
+		try:
+			while not self._halt_event.is_set():
+				for socket, _ in self._poller.poll(self._poll_timeout()):
+					# The poller reports file descriptors by number, not by the object that was registered
+					if socket == wakeup_fd:
+						self._wakeup.clear()
+						continue
+					handler = self._handlers.get(socket)
+					if handler is not None:
+						self._guard(handler)
+				self._run_calls()
+				for client in list(self._timed_clients):
+					self._guard(client._on_timer)
+		finally:
+			# Lets clients stopped on the way out close their sockets
+			self._run_calls()
+
+	def _poll_timeout(self):
+		deadlines = [deadline for deadline in (client._next_deadline() for client in self._timed_clients) if deadline is not None]
+		if len(self._calls) > 0:
+			return 0
+		if len(deadlines) == 0:
+			return None
+		return max(0, (min(deadlines) - time.time()) * 1000)
+
+	def _run_calls(self):
+		while True:
+			try:
+				function, args = self._calls.popleft()
+			except IndexError:
+				return
+			self._guard(function, *args)
+
+	@staticmethod
+	def _guard(function, *args):
+		try:
+			function(*args)
+		except Exception as e:
+			Log.add(f"The I/O reactor caught {type(e).__name__} from {getattr(function, '__qualname__', function)}: {e}", warn=True)
+
+
+# Counterpart of IPCRequestThread that runs on an IOReactor. It speaks the same [request id, request] protocol over a
+# DEALER socket and send_request returns a concurrent.futures.Future, but replies are processed on the reactor thread
+# as soon as they arrive instead of on an update thread of their own.
+# A request that can't be queued on the socket straight away fails rather than stalling the reactor.
+class ReactorRequestClient:
+	def __init__(self, reactor, message_callback, feed_name, request_timeout=None, max_pending=64, coalesced_requests=(),
+				max_in_flight=None):
+		self.request_timeout = request_timeout
+		self.max_in_flight = max_in_flight
+		self.initialized = False
+		self.last_reply_time = 0
+
+		self._reactor = reactor
+		self._zmq_context = reactor.zmq_context
+		self._message_callback = message_callback
+		self._feed_name = feed_name
+		self._socket = None
+		self._started = False
+		self._stopped = False
+		self._request_ids = count(1)
+		self._send_queue = RequestLanes()
+		self._request_state_lock = threading.Lock()
+		# In flight requests by id, in the order they were sent
+		self._in_flight = dict()
+		self._metrics = RequestMetrics(feed_name, self._send_queue, lambda: len(self._in_flight))
+		self.admission = RequestAdmission(feed_name, max_pending, coalesced_requests)
+
+	def start(self):
+		if self._started:
+			raise UnexpectedStateError("Tried to start a reactor client that was already started. It must be reinitialized.")
+		self._started = True
+		self._reactor.call_soon(self._attach)
+
+	def is_alive(self):
+		return self._started and not self._stopped
+
+	def stop(self):
+		if self._started and not self._stopped:
+			self._stopped = True
+			self._reactor.call_soon(self._detach)
+
+	def _attach(self):
+		if self._stopped:
+			return
+		self._client_init()
+		self._reactor.register(self._socket, self._receive_replies)
+		self._reactor.add_timed_client(self)
+		self.initialized = True
+		self._send_queued_requests()
+
+	def _detach(self):
+		if self._socket is None:
+			return
+		self._reactor.remove_timed_client(self)
+		self._reactor.unregister(self._socket)
+		self._client_complete()
+
+	def _client_init(self):
+		self._socket = self._zmq_context.socket(zmq.DEALER)
+		self._socket.connect("ipc:///tmp/feeds/{}.ipc".format(self._feed_name))
+
+	def _client_complete(self):
+		for pending in self._send_queue.clear():
+			pending.future.cancel()
+
+		with self._request_state_lock:
+			aborted = list(self._in_flight.values())
+			self._in_flight.clear()
+		for pending in aborted:
+			pending.future.set_exception(RequestAbortedError(f"The request client stopped before '{pending.request}' was answered."))
+
+		self._socket.close(linger=0)
+		self._socket = None
+
+	def send_request(self, request, timeout=None, lane=RequestLane.CONTROL, send_deadline=None):
+		request_id = str(next(self._request_ids)).encode("utf-8")
+		pending = PendingRequest(
+			request_id, request, self.request_timeout if timeout is None else timeout, lane=lane, send_deadline=send_deadline)
+		outstanding = self.admission.admit(pending)
+		if outstanding is not None:
+			return outstanding
+		self._send_queue.put(pending)
+		self._reactor.call_soon(self._send_queued_requests)
+		return pending.future
+
+	def _send_queued_requests(self):
+		# Requests sent before the socket exists are flushed once it's attached
+		if self._socket is None:
+			return
+		for pending in self._send_queue.take_expired(time.time()):
+			if pending.future.set_running_or_notify_cancel():
+				pending.future.set_exception(pending.expired_error())
+				self._metrics.record_expired(pending)
+
+		while True:
+			with self._request_state_lock:
+				window_full = self.max_in_flight is not None and len(self._in_flight) >= self.max_in_flight
+			pending = self._send_queue.pop(safety_only=window_full)
+			if pending is None:
+				return
+			# The caller may have cancelled the request while it was queued
+			if not pending.future.set_running_or_notify_cancel():
+				continue
+
+			with self._request_state_lock:
+				pending.send_time = time.time()
+				self._in_flight[pending.request_id] = pending
+			try:
+				self._socket.send_multipart([pending.request_id, pending.request.encode("utf-8")], zmq.NOBLOCK)
+			except zmq.Again:
+				with self._request_state_lock:
+					del self._in_flight[pending.request_id]
+				pending.future.set_exception(RequestAbortedError(f"'{pending.request}' could not be queued on {self._feed_name}."))
+
+	def _receive_replies(self):
+		while True:
+			try:
+				frames = self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+			except zmq.Again:
+				break
+
+			with self._request_state_lock:
+				pending = self._in_flight.pop(frames[0].bytes, None)
+			# Replies to requests that already timed out are dropped
+			if pending is None:
+				continue
+
+			try:
+				pending.future.set_result(self._process_reply(frames[1:]))
+			except Exception as e:
+				pending.future.set_exception(e)
+			now = time.time()
+			self.last_reply_time = now - pending.send_time
+			self._metrics.record_reply(pending, now)
+		# Replies free slots in the in flight window
+		self._send_queued_requests()
+
+	def _next_deadline(self):
+		with self._request_state_lock:
+			deadlines = [pending.deadline for pending in self._in_flight.values() if pending.deadline is not None]
+		expiry = self._send_queue.next_expiry()
+		if expiry is not None:
+			deadlines.append(expiry)
+		return min(deadlines) if len(deadlines) > 0 else None
+
+	def _on_timer(self):
+		self._expire_requests()
+
+	def _expire_requests(self):
+		now = time.time()
+		with self._request_state_lock:
+			expired = [pending for pending in self._in_flight.values() if pending.deadline is not None and pending.deadline <= now]
+			for pending in expired:
+				del self._in_flight[pending.request_id]
+
+		for pending in expired:
+			pending.future.set_exception(TimeoutError(f"No reply to '{pending.request}' after {pending.timeout} seconds."))
+			self._metrics.record_timeout(pending.request)
+			self._request_expired(pending)
+		self._send_queued_requests()
+
+	# Called on the reactor thread for every request that timed out
+	def _request_expired(self, pending):
+		pass
+
+	def _process_reply(self, replies):
+		messages = [str(reply.bytes, "utf-8") for reply in replies]
+		for message in messages:
+			self._message_callback(message)
+		return messages
+
+	@property
+	def waiting_on_reply(self):
+		with self._request_state_lock:
+			return len(self._in_flight) > 0
+
+	# The oldest request still waiting on a reply
+	@property
+	def oldest_request(self):
+		with self._request_state_lock:
+			return next(iter(self._in_flight.values()), None)
+
+	def get_reply_time(self):
+		pending = self.oldest_request
+		return 0 if pending is None else time.time() - pending.send_time
+
+
+# ProcessSupervisor watched from an IOReactor rather than a monitor thread of its own, so supervising many processes
+# doesn't take a thread each. The reactor polls a duplicate of the pidfd next to its sockets, and its timer covers
+# heartbeat timeouts, restart backoffs and output rotation. Those checks run on the reactor thread, so rotating the
+# output holds up the reactor while it lasts. A hung process is killed and waited on by a thread of its own.
+class ReactorProcessSupervisor(ProcessSupervisor):
+	def __init__(self, reactor, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._reactor = reactor
+		self._attached = False
+		self._deadline = None
+		# The reactor's own duplicate of the pidfd and the pid it belongs to. It's only opened, registered and closed on
+		# the reactor thread, so the pidfd can be replaced on any thread without the reactor polling a closed descriptor.
+		self._watched_fd = None
+		self._watched_pid = None
+
+	def _start_monitor(self):
+		if not self._attached:
+			self._attached = True
+			self._halt_event.clear()
+			self._reactor.call_soon(self._attach)
+
+	def _notify_monitor(self):
+		self._reactor.call_soon(self._watch)
+
+	def _stop_monitor(self):
+		self._attached = False
+		self._reactor.call_soon(self._detach)
+
+	def _attach(self):
+		if self._halt_event.is_set():
+			return
+		self._reactor.add_timed_client(self)
+		self._watch()
+
+	def _detach(self):
+		self._reactor.remove_timed_client(self)
+		self._unwatch()
+
+	# Polls the pidfd of the current process, if there's one and it's still running
+	def _watch(self):
+		with self._lock:
+			pid = self._pid if self._running and self._pidfd is not None and not self._halt_event.is_set() else None
+			if pid is not None and pid != self._watched_pid:
+				self._unwatch()
+				self._watched_fd = os.dup(self._pidfd)
+				self._watched_pid = pid
+				self._reactor.register(self._watched_fd, self._process_event)
+		if pid is None:
+			self._unwatch()
+
+	def _unwatch(self):
+		if self._watched_fd is not None:
+			self._reactor.unregister(self._watched_fd)
+			os.close(self._watched_fd)
+			self._watched_fd = None
+			self._watched_pid = None
+
+	def _process_event(self):
+		if self._halt_event.is_set():
+			return
+		self._check()
+		# An exited process leaves its pidfd readable, so it has to stop being polled
+		self._watch()
+
+	# Waiting for the killed process to exit would hold up every other client of the reactor
+	def _handle_hang(self, now):
+		killer = threading.Thread(target=super()._handle_hang, args=(now,), name=f"{self.name}-kill")
+		killer.daemon = True
+		killer.start()
+
+	def _next_deadline(self):
+		with self._lock:
+			timeout = None if self._halt_event.is_set() else self._monitor_timeout()
+		self._deadline = None if timeout is None else time.time() + timeout
+		return self._deadline
+
+	def _on_timer(self):
+		if self._deadline is not None and time.time() >= self._deadline and not self._halt_event.is_set():
+			self._check()
+			self._watch()
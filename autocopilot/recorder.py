@@ -0,0 +1,352 @@
+import os
+import mmap
+import time
+import atexit
+import datetime
+import json
+import struct
+import threading
+from enum import Enum
+from collections import deque
+
+import numpy as np
+
+from logger import Log
+
+
+# A recording is a directory of segments. Each segment is a pair of preallocated, memory-mapped files:
+# segment-NNNN.dat holds the raw frames back to back, and segment-NNNN.idx holds a header followed by one fixed size
+# index entry per frame, with its receive time, topic, source, vehicle and location in the data file. Readers only need
+# the index to seek or filter, and it maps straight onto a numpy array. The header's record count is written after the
+# records it covers, so a recording cut short by a crash is still readable up to the last committed batch.
+# A recording of a fleet numbers its vehicles from 1 and lists their ids in vehicles.json. Frames of a single vehicle
+# are tagged 0, as is everything in a version 1 recording, where the vehicle number was padding.
+RECORDING_MAGIC = b"ACPREC01"
+RECORDING_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+VEHICLES_FILE = "vehicles.json"
+
+# magic, version, segment number, record count, data bytes used, wall clock and monotonic time at creation
+SEGMENT_HEADER = struct.Struct("<8sIIQQdd16x")
+COUNT_OFFSET = 16
+# timestamp, data offset, length, topic, source, vehicle
+INDEX_ENTRY = struct.Struct("<dQIBBH")
+INDEX_DTYPE = np.dtype({
+	"names": ["timestamp", "offset", "length", "topic", "source", "vehicle"],
+	"formats": [np.float64, np.uint64, np.uint32, np.uint8, np.uint8, np.uint16],
+	"offsets": [0, 8, 16, 20, 21, 22],
+	"itemsize": INDEX_ENTRY.size})
+
+
+class RecordTopic(int, Enum):
+	Unknown = 0
+	InterfaceStatus = 1
+	FlightStatus = 2
+	ControlDevice = 3
+	Telemetry = 4
+	CommandResult = 5
+	Heartbeat = 6
+	TelemetryBatch = 7
+
+	@classmethod
+	def from_name(cls, name):
+		return cls.__members__.get(name, cls.Unknown)
+
+
+class RecordSource(int, Enum):
+	REPLY = 0
+	STREAM = 1
+
+
+class RecordingError(Exception):
+	pass
+
+
+def _preallocate(fd, size):
+	if hasattr(os, "posix_fallocate"):
+		os.posix_fallocate(fd, 0, size)
+	else:
+		os.ftruncate(fd, size)
+
+
+class SegmentWriter:
+	def __init__(self, directory, number, data_capacity, index_capacity):
+		self.number = number
+		self.count = 0
+		self.data_used = 0
+		self.data_capacity = data_capacity
+		self.index_capacity = index_capacity
+
+		base_path = os.path.join(directory, "segment-{:04}".format(number))
+		self._data_fd = os.open(base_path + ".dat", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		self._index_fd = os.open(base_path + ".idx", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		_preallocate(self._data_fd, data_capacity)
+		_preallocate(self._index_fd, SEGMENT_HEADER.size + index_capacity * INDEX_ENTRY.size)
+		self._data = mmap.mmap(self._data_fd, data_capacity)
+		self._index = mmap.mmap(self._index_fd, SEGMENT_HEADER.size + index_capacity * INDEX_ENTRY.size)
+
+		SEGMENT_HEADER.pack_into(
+			self._index, 0, RECORDING_MAGIC, RECORDING_VERSION, number, 0, 0, time.time(), time.monotonic())
+
+	def fits(self, length):
+		return self.count < self.index_capacity and self.data_used + length <= self.data_capacity
+
+	def append(self, timestamp, topic, source, vehicle, payload):
+		length = len(payload)
+		self._data[self.data_used:self.data_used + length] = payload
+		INDEX_ENTRY.pack_into(
+			self._index, SEGMENT_HEADER.size + self.count * INDEX_ENTRY.size, timestamp, self.data_used, length, topic, source,
+			vehicle)
+		self.data_used += length
+		self.count += 1
+
+	# Makes the records appended so far visible to readers
+	def commit(self):
+		struct.pack_into("<QQ", self._index, COUNT_OFFSET, self.count, self.data_used)
+
+	# Commits, then trims both files down to what was used
+	def close(self):
+		self.commit()
+		self._data.close()
+		self._index.close()
+		os.ftruncate(self._data_fd, self.data_used)
+		os.ftruncate(self._index_fd, SEGMENT_HEADER.size + self.count * INDEX_ENTRY.size)
+		os.close(self._data_fd)
+		os.close(self._index_fd)
+
+
+# Records raw frames from the DJI interface into a new recording directory.
+# record only timestamps the frame and appends it to a deque, which doesn't take a lock, and a background thread
+# copies frames into the memory-mapped segments in batches, so the receive path never waits on the disk. Frames are
+# dropped and counted when queue_size frames are already waiting. A segment is closed and a new one started once
+# either of its files is full.
+# Several vehicles can share a recorder, each recording through the view for_vehicle returns.
+class FlightRecorder:
+	# Most frames written per batch, the header's record count is updated once per batch
+	BATCH_SIZE = 512
+	# How long the writer sleeps once it has caught up
+	WRITE_INTERVAL = 0.05
+	# Average frame size used to size the index file of a segment
+	AVERAGE_FRAME_BYTES = 64
+
+	def __init__(self, directory, segment_bytes=64 * 1024 * 1024, queue_size=8192):
+		self.directory = os.path.join(directory, "{:%Y%m%d-%H%M%S}".format(datetime.datetime.now()))
+		self.segment_bytes = segment_bytes
+		self.index_capacity = max(1, segment_bytes // self.AVERAGE_FRAME_BYTES)
+		self.dropped_frames = 0
+		self.recorded_frames = 0
+
+		self.queue_size = queue_size
+		self._queue = deque()
+		self._segment = None
+		self._segment_count = 0
+		# Vehicle numbers by id
+		self._vehicles = dict()
+		self._vehicles_lock = threading.Lock()
+		self._halt_event = threading.Event()
+		self._writer = threading.Thread(target=self._write_frames, name="flight-recorder")
+		self._writer.daemon = True
+
+	def start(self):
+		os.makedirs(self.directory, exist_ok=True)
+		self._writer.start()
+		atexit.register(self.stop)
+		Log.add(f"Recording interface traffic to {self.directory}")
+
+	def is_alive(self):
+		return self._writer.is_alive()
+
+	# Payload can be bytes, a memoryview or a zmq.Frame buffer. It's kept as is until written, so it must not change.
+	def record(self, topic, source, payload, vehicle=0):
+		if len(self._queue) >= self.queue_size:
+			self.dropped_frames += 1
+		else:
+			self._queue.append((time.monotonic(), topic, source, vehicle, payload))
+
+	# A recorder for one vehicle of a fleet, whose frames are tagged with its number. A vehicle keeps its number for the
+	# whole recording, even after it leaves the fleet and comes back.
+	def for_vehicle(self, vehicle_id):
+		with self._vehicles_lock:
+			number = self._vehicles.get(vehicle_id)
+			if number is None:
+				number = len(self._vehicles) + 1
+				self._vehicles[vehicle_id] = number
+				self._write_vehicles()
+		return VehicleRecorder(self, vehicle_id, number)
+
+	def _write_vehicles(self):
+		os.makedirs(self.directory, exist_ok=True)
+		path = os.path.join(self.directory, VEHICLES_FILE)
+		with open(path + ".tmp", "w") as f:
+			json.dump({str(number): vehicle_id for vehicle_id, number in self._vehicles.items()}, f)
+		os.replace(path + ".tmp", path)
+
+	# Writes out every queued frame and closes the current segment
+	def stop(self):
+		if not self._writer.is_alive():
+			return
+		self._halt_event.set()
+		self._writer.join()
+
+	def _write_frames(self):
+		try:
+			while not (self._halt_event.is_set() and len(self._queue) == 0):
+				written = self._write_batch()
+				if self._segment is not None and written > 0:
+					self._segment.commit()
+				if written < self.BATCH_SIZE:
+					self._halt_event.wait(self.WRITE_INTERVAL)
+		finally:
+			if self._segment is not None:
+				self._segment.close()
+				self._segment = None
+
+	def _write_batch(self):
+		written = 0
+		while written < self.BATCH_SIZE:
+			try:
+				frame = self._queue.popleft()
+			except IndexError:
+				break
+			self._write_frame(*frame)
+			written += 1
+		return written
+
+	def _write_frame(self, timestamp, topic, source, vehicle, payload):
+		length = len(payload)
+		if length > self.segment_bytes:
+			self.dropped_frames += 1
+			return
+
+		if self._segment is None or not self._segment.fits(length):
+			if self._segment is not None:
+				self._segment.close()
+			self._segment = SegmentWriter(self.directory, self._segment_count, self.segment_bytes, self.index_capacity)
+			self._segment_count += 1
+
+		self._segment.append(timestamp, topic, source, vehicle, payload)
+		self.recorded_frames += 1
+
+
+class VehicleRecorder:
+	__slots__ = ("recorder", "vehicle_id", "number")
+
+	def __init__(self, recorder, vehicle_id, number):
+		self.recorder = recorder
+		self.vehicle_id = vehicle_id
+		self.number = number
+
+	def record(self, topic, source, payload):
+		self.recorder.record(topic, source, payload, self.number)
+
+
+class RecordedFrame:
+	__slots__ = ("timestamp", "topic", "source", "vehicle", "payload")
+
+	def __init__(self, timestamp, topic, source, vehicle, payload):
+		self.timestamp = timestamp
+		self.topic = topic
+		self.source = source
+		# The vehicle's id in a fleet recording, otherwise None
+		self.vehicle = vehicle
+		self.payload = payload
+
+
+class _SegmentReader:
+	def __init__(self, base_path):
+		with open(base_path + ".idx", "rb") as f:
+			self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, self.number, self.count, data_used, self.wall_time, self.monotonic_time = \
+			SEGMENT_HEADER.unpack_from(self._index_map, 0)
+		if magic != RECORDING_MAGIC:
+			raise RecordingError(f"{base_path}.idx is not a flight recorder segment.")
+		if version not in READABLE_VERSIONS:
+			raise RecordingError(f"Unsupported flight recording version {version}, expected {RECORDING_VERSION}.")
+
+		self.index = np.frombuffer(self._index_map, dtype=INDEX_DTYPE, count=self.count, offset=SEGMENT_HEADER.size)
+		self._data_map = None
+		if data_used > 0:
+			with open(base_path + ".dat", "rb") as f:
+				self._data_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.data = memoryview(self._data_map) if self._data_map is not None else memoryview(b"")
+
+
+# Opens a recording made by FlightRecorder without reading its frames.
+# The index of every segment is mapped and combined into one array sorted by receive time, which is used to seek and
+# filter, and frame payloads are returned as memoryviews into the mapped data files. Those must be released before
+# close is called.
+class FlightRecording:
+	def __init__(self, directory):
+		self.directory = directory
+		names = sorted(name[:-4] for name in os.listdir(directory) if name.endswith(".idx"))
+		if len(names) == 0:
+			raise RecordingError(f"There are no flight recorder segments in {directory}.")
+		self._segments = [_SegmentReader(os.path.join(directory, name)) for name in names]
+		# Vehicle ids by number, empty unless this is a fleet recording
+		self.vehicles = dict()
+		vehicles_path = os.path.join(directory, VEHICLES_FILE)
+		if os.path.exists(vehicles_path):
+			with open(vehicles_path) as f:
+				self.vehicles = {int(number): vehicle_id for number, vehicle_id in json.load(f).items()}
+
+		segment_numbers = np.concatenate([np.full(segment.count, i, dtype=np.uint32) for i, segment in enumerate(self._segments)])
+		index = np.concatenate([segment.index for segment in self._segments])
+		# Frames from the reply and stream paths are queued by different threads, so they can be slightly out of order
+		order = np.argsort(index["timestamp"], kind="stable")
+		self.index = index[order]
+		self._segment_numbers = segment_numbers[order]
+
+	# Wall clock time the recording started at, for converting the monotonic frame timestamps
+	@property
+	def start_wall_time(self):
+		first = self._segments[0]
+		return first.wall_time - first.monotonic_time
+
+	def __len__(self):
+		return len(self.index)
+
+	@property
+	def timestamps(self):
+		return self.index["timestamp"]
+
+	# Position of the first frame received at or after time t
+	def seek(self, t):
+		return int(np.searchsorted(self.index["timestamp"], t, side="left"))
+
+	def frame(self, position):
+		entry = self.index[position]
+		segment = self._segments[self._segment_numbers[position]]
+		offset = int(entry["offset"])
+		return RecordedFrame(
+			float(entry["timestamp"]), RecordTopic(int(entry["topic"])), RecordSource(int(entry["source"])),
+			self.vehicles.get(int(entry["vehicle"])), segment.data[offset:offset + int(entry["length"])])
+
+	# Positions of the frames in [start, end) with the given topic, source and vehicle id, or any of them when it's None
+	def positions(self, topic=None, start=None, end=None, source=None, vehicle=None):
+		first = 0 if start is None else self.seek(start)
+		last = len(self.index) if end is None else self.seek(end)
+		entries = self.index[first:last]
+		mask = np.ones(len(entries), dtype=bool)
+		if topic is not None:
+			mask &= entries["topic"] == int(topic)
+		if source is not None:
+			mask &= entries["source"] == int(source)
+		if vehicle is not None:
+			number = next((number for number, vehicle_id in self.vehicles.items() if vehicle_id == vehicle), None)
+			if number is None:
+				raise KeyError(f"Vehicle '{vehicle}' isn't part of this recording.")
+			mask &= entries["vehicle"] == number
+		return np.flatnonzero(mask) + first
+
+	def frames(self, topic=None, start=None, end=None, vehicle=None):
+		for position in self.positions(topic, start, end, vehicle=vehicle):
+			yield self.frame(position)
+
+	def close(self):
+		for segment in self._segments:
+			segment.index = None
+			segment.data.release()
+			if segment._data_map is not None:
+				segment._data_map.close()
+			segment._index_map.close()
+		self._segments = []
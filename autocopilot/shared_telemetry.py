@@ -0,0 +1,231 @@
+import os
+import mmap
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from telemetry_buffer import TELEMETRY_DTYPE
+
+# Layout of a shared telemetry region, all little-endian:
+#
+#   offset  size  field
+#        0     8  magic, b"ACPTELEM"
+#        8     4  version, LAYOUT_VERSION
+#       12     4  slot_size, bytes per slot
+#       16     8  capacity, slots in the ring
+#       24     8  count, records ever written
+#       32     8  closed, 1 once the writer stopped publishing to this region
+#       40    24  reserved
+#       64     -  capacity slots, record n of count stored in slot n % capacity
+#
+# A slot is a record followed by its number n, u64, and a checksum, u64, of the record and number bytes. A record is
+# the fields of TELEMETRY_DTYPE packed without padding, in this order: timestamp f64 (host monotonic seconds), lat f64,
+# lon f64, alt f32, vel f32[3], accel f32[3], satellites u16, fc_time f64, received f64, velocity_fc_time f64.
+# TELEMETRY_DTYPE describes the times. Unknown accelerations and times are NaN. The checksum is CHECKSUM_SEED plus the
+# sum of every byte times its weight from checksum_weights, modulo 2**64.
+#
+# There's a single writer, which fills in the slots and then raises the count. Nothing here depends on the order its
+# stores become visible in, since Python can't fence them. A reader copies the slots of the records the count says are
+# newest, and keeps the copy only if every slot holds the record number it expected and a matching checksum. A slot the
+# writer is partway through fails the checksum, and one that's behind or ahead of the count has the wrong number, so the
+# reader starts over. Readers never write to the region, so any number of them can attach.
+LAYOUT_VERSION = 3
+MAGIC = b"ACPTELEM"
+HEADER_DTYPE = np.dtype([
+	("magic", "S8"),
+	("version", "<u4"),
+	("slot_size", "<u4"),
+	("capacity", "<u8"),
+	("count", "<u8"),
+	("closed", "<u8"),
+	("reserved", "V24"),
+])
+RECORD_DTYPE = TELEMETRY_DTYPE.newbyteorder("<")
+SLOT_DTYPE = np.dtype([("record", RECORD_DTYPE), ("number", "<u8"), ("checksum", "<u8")])
+# The checksum covers everything before it
+CHECKED_BYTES = SLOT_DTYPE.fields["checksum"][1]
+# Makes the checksum of a slot that was never written, which is all zeros, wrong for any record number
+CHECKSUM_SEED = 0x243F6A8885A308D3
+_MASK = 2 ** 64 - 1
+
+
+# One weight per checked byte, from the splitmix64 sequence starting at 0, so every process derives the same ones
+def checksum_weights(size):
+	weights = []
+	state = 0
+	for _ in range(size):
+		state = (state + 0x9E3779B97F4A7C15) & _MASK
+		z = ((state ^ (state >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+		z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+		weights.append(z ^ (z >> 31))
+	return np.array(weights, dtype=np.uint64)
+
+
+CHECKSUM_WEIGHTS = checksum_weights(CHECKED_BYTES)
+
+
+def _checksums(slots):
+	data = slots.view(np.uint8).reshape(len(slots), SLOT_DTYPE.itemsize)[:, :CHECKED_BYTES]
+	# Unsigned arithmetic wraps around, which is the modulo
+	return data.astype(np.uint64) @ CHECKSUM_WEIGHTS + np.uint64(CHECKSUM_SEED)
+
+
+class SharedTelemetryError(Exception):
+	pass
+
+
+def _views(buffer):
+	header = np.ndarray((), dtype=HEADER_DTYPE, buffer=buffer)
+	capacity = int(header["capacity"])
+	slots = np.ndarray((capacity,), dtype=SLOT_DTYPE, buffer=buffer, offset=HEADER_DTYPE.itemsize)
+	return header, slots
+
+
+# Publishes telemetry records into a shared memory region named name, replacing a region left behind by a writer that
+# didn't close it. The region is removed on close, but readers attached to it can still read it until they detach.
+class SharedTelemetryWriter:
+	def __init__(self, name, capacity):
+		if capacity < 1:
+			raise ValueError("A shared telemetry region needs a capacity of at least one record.")
+		self.name = name
+		size = HEADER_DTYPE.itemsize + capacity * SLOT_DTYPE.itemsize
+		try:
+			self._memory = shared_memory.SharedMemory(name, create=True, size=size)
+		except FileExistsError:
+			self._replace_stale(name)
+			self._memory = shared_memory.SharedMemory(name, create=True, size=size)
+
+		header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self._memory.buf)
+		header[()] = (MAGIC, LAYOUT_VERSION, SLOT_DTYPE.itemsize, capacity, 0, 0, bytes(24))
+		self._header, self._slots = _views(self._memory.buf)
+		self.capacity = capacity
+
+	# Readers still attached to the old region see it closed and can attach to the new one
+	@staticmethod
+	def _replace_stale(name):
+		stale = shared_memory.SharedMemory(name)
+		try:
+			if stale.size >= HEADER_DTYPE.itemsize:
+				np.ndarray((), dtype=HEADER_DTYPE, buffer=stale.buf)["closed"] = 1
+		finally:
+			stale.close()
+			stale.unlink()
+
+	@property
+	def count(self):
+		return int(self._header["count"])
+
+	# Appends rows of TELEMETRY_DTYPE. Only the newest capacity rows of a larger batch are written.
+	def write(self, samples):
+		count = len(samples)
+		if count == 0:
+			return
+		kept = samples[-self.capacity:]
+		total = int(self._header["count"])
+		slots = np.empty(len(kept), dtype=SLOT_DTYPE)
+		slots["record"] = kept
+		slots["number"] = total + count - len(kept) + np.arange(len(kept), dtype=np.uint64)
+		slots["checksum"] = _checksums(slots)
+
+		self._slots[slots["number"] % self.capacity] = slots
+		self._header["count"] = total + count
+
+	def close(self):
+		if self._memory is None:
+			return
+		self._header["closed"] = 1
+		# The views have to go before the mapping can be closed
+		self._header = self._slots = None
+		self._memory.close()
+		try:
+			self._memory.unlink()
+		except FileNotFoundError:
+			# Another writer already replaced it
+			pass
+		self._memory = None
+
+
+# Reads the region a SharedTelemetryWriter publishes to. Every read is a copy made straight from the mapped memory,
+# so it takes no system calls and is consistent: all of its records come from the same state of the ring.
+# Each reader keeps its own position for poll(), so a reader is meant for a single thread.
+class SharedTelemetryReader:
+	# Reads retried this many times without a consistent copy mean the writer is stuck partway through a write
+	MAX_RETRIES = 10000
+
+	SHM_DIRECTORY = "/dev/shm"
+
+	def __init__(self, name):
+		self.name = name
+		self._memory = self._attach(name)
+		if len(self._memory) < HEADER_DTYPE.itemsize or not self._compatible(np.ndarray((), HEADER_DTYPE, self._memory)):
+			self._memory.close()
+			raise SharedTelemetryError(f"'{name}' isn't a shared telemetry region of layout version {LAYOUT_VERSION}.")
+		self._header, self._slots = _views(self._memory)
+		self.capacity = len(self._slots)
+		# Records ever written when poll() last returned
+		self._position = self.count
+
+	# Maps the region read-only. SharedMemory isn't used since it registers the region with the resource tracker of
+	# every process that attaches, which removes it from under the writer when a reader exits.
+	@classmethod
+	def _attach(cls, name):
+		fd = os.open(os.path.join(cls.SHM_DIRECTORY, name), os.O_RDONLY)
+		try:
+			return mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+		finally:
+			os.close(fd)
+
+	@staticmethod
+	def _compatible(header):
+		return header["magic"] == MAGIC and header["version"] == LAYOUT_VERSION and header["slot_size"] == SLOT_DTYPE.itemsize
+
+	@property
+	def count(self):
+		return int(self._header["count"])
+
+	# Whether the writer stopped publishing here. A new writer under the same name needs a new reader.
+	@property
+	def closed(self):
+		return bool(self._header["closed"])
+
+	# Copies the newest n records, oldest first, along with the number of records ever written at the time
+	def _read(self, n):
+		header = self._header
+		for _ in range(self.MAX_RETRIES):
+			count = int(header["count"])
+			kept = min(n, count, self.capacity)
+			numbers = count - kept + np.arange(kept, dtype=np.uint64)
+			slots = self._slots[numbers % self.capacity]
+			if np.array_equal(slots["number"], numbers) and np.array_equal(slots["checksum"], _checksums(slots)):
+				return slots["record"], count
+		raise SharedTelemetryError(f"Couldn't get a consistent read of '{self.name}', its writer isn't finishing writes.")
+
+	def last(self, n):
+		return self._read(n)[0]
+
+	def all(self):
+		return self._read(self.capacity)[0]
+
+	def latest(self):
+		samples = self.last(1)
+		return samples[0] if len(samples) > 0 else None
+
+	def since(self, t):
+		samples = self.all()
+		return samples[np.searchsorted(samples["timestamp"], t, side="left"):]
+
+	# The records written since the last poll, or since the reader attached. Records the writer overwrote before they
+	# were polled are lost, and their number returned as well.
+	def poll(self):
+		samples, count = self._read(self.capacity)
+		new = count - self._position
+		self._position = count
+		kept = min(new, len(samples))
+		return samples[len(samples) - kept:], new - kept
+
+	def close(self):
+		if self._memory is None:
+			return
+		self._header = self._slots = None
+		self._memory.close()
+		self._memory = None
@@ -0,0 +1,443 @@
+import os
+import sys
+import math
+import time
+import random
+import argparse
+from enum import Enum
+from collections import deque
+from json import JSONEncoder
+
+import zmq
+
+import wire_format
+from recorder import FlightRecording, RecordSource, RecordTopic
+from rate_policy import is_subscription_rates
+from supervisor import write_pidfile
+
+
+# Synthesizes a drone flying a slow circle, for feeding the interface protocol without a vehicle.
+# Its flight controller clock started uptime seconds before t = 0 and runs fast by clock_skew, and every package
+# reaches the interface after a random delay of around mean_delay seconds.
+class TelemetrySynthesizer:
+	# Degrees of latitude or longitude covered by the circle's radius
+	RADIUS = 0.0005
+	# Seconds per lap
+	PERIOD = 60
+
+	def __init__(self, latitude=45.0, longitude=-75.0, altitude=30.0, uptime=100.0, clock_skew=50e-6, mean_delay=0.002,
+				seed=None):
+		self.latitude = latitude
+		self.longitude = longitude
+		self.altitude = altitude
+		self.uptime = uptime
+		self.clock_skew = clock_skew
+		self.mean_delay = mean_delay
+		self.return_to_home = False
+		# OSDK flight status, 2 is in the air
+		self.flight_state = 2
+		self._random = random.Random(seed)
+
+	# The flight controller's clock at host time t, truncated to milliseconds like the OSDK's timestamps
+	def fc_time(self, t):
+		return math.floor((self.uptime + t) * (1 + self.clock_skew) * 1000) / 1000
+
+	def position(self, t):
+		angle = 2 * math.pi * t / self.PERIOD
+		return self.latitude + self.RADIUS * math.sin(angle), self.longitude + self.RADIUS * math.cos(angle)
+
+	def velocity(self, t):
+		angle = 2 * math.pi * t / self.PERIOD
+		speed = 2 * math.pi * self.RADIUS * 111000 / self.PERIOD
+		return -speed * math.sin(angle), speed * math.cos(angle)
+
+	# The fast package sent at host time t, along with the last velocity package when it comes at velocity_hz
+	def telemetry(self, t, velocity_hz=None):
+		velocity_t = t if velocity_hz is None else math.floor(t * velocity_hz) / velocity_hz
+		latitude, longitude = self.position(t)
+		vel_x, vel_y = self.velocity(velocity_t)
+		return {"topic": "Telemetry", "longitude": longitude, "latitude": latitude, "altitude": self.altitude,
+				"satellites": 12, "vel_x": vel_x, "vel_y": vel_y, "vel_z": 0.0, "accel_x": 0.0, "accel_y": 0.0,
+				"accel_z": -9.8, "fc_time": self.fc_time(t), "received": t + self._random.expovariate(1 / self.mean_delay),
+				"velocity_fc_time": self.fc_time(velocity_t)}
+
+	def flight_status(self, t):
+		return {"topic": "FlightStatus", "state": self.flight_state}
+
+	def control_device(self, t):
+		return {"topic": "ControlDevice", "auto_mode": self.return_to_home, "return_to_home": self.return_to_home}
+
+
+class SimulatedFault(str, Enum):
+	# The next requests are swallowed without a reply, as if their messages were lost, but the process carries on
+	DROP_REPLIES = "drop_replies"
+	# Every request is ignored until the process restarts, while telemetry and heartbeats keep being published
+	IGNORE_REQUESTS = "ignore_requests"
+
+
+# Pure Python stand-in for bin/dji-interface that speaks the same protocol on the same feeds.
+# It answers check_interface, start_interface, retrieve_data, retrieve_batch, set_rates and return_home on a ROUTER
+# socket, with start_interface and return_home finishing after a delay like they do on a real vehicle, and publishes
+# Telemetry and ControlDevice at hz, FlightStatus once a second and a Heartbeat once a second on the XPUB socket.
+# Replies are in the format each client negotiated, and the feed publishes each format only while it's subscribed to.
+# set_rates changes hz. Telemetry is only published once the interface is started, unless online is set.
+# Faults are injected with "inject_fault <fault> [count]" requests, which are answered whatever fault is active.
+# With a replay recording, the recorded stream frames are published with their original spacing divided by
+# replay_speed, or as fast as possible when replay_speed is 0, and retrieve_data replies with the latest of them.
+# Synthesized telemetry samples are also buffered for retrieve_batch, like the interface does.
+class SimulatedInterface:
+	HEARTBEAT_INTERVAL = 1
+	SLOW_TOPIC_INTERVAL = 1
+	# Most messages published in one pass before checking for requests again
+	PUBLISH_BATCH = 1000
+	# Samples buffered for retrieve_batch, the same as the interface
+	BATCH_CAPACITY = 256
+
+	def __init__(self, zmq_context, hz=8, online=False, start_delay=1.0, return_home_delay=0.5, replay=None,
+				replay_speed=1.0, loop_replay=False, feed_directory="/tmp/feeds", replay_vehicle=None):
+		self.hz = hz
+		self.velocity_hz = 5
+		self.online = online or replay is not None
+		self.start_delay = start_delay
+		self.return_home_delay = return_home_delay
+		self.replay_speed = replay_speed
+		self.loop_replay = loop_replay
+		self.published = 0
+		self.replies = 0
+
+		self._zmq_context = zmq_context
+		self._feed_directory = feed_directory
+		self._synthesizer = TelemetrySynthesizer()
+		self._json_encoder = JSONEncoder()
+		self._decoder = wire_format.MessageDecoder()
+		# Identities of the clients that negotiated the binary format
+		self._binary_clients = set()
+		# Prefixes subscribed to on the telemetry feed
+		self._feed_prefixes = set()
+		self._replay = replay
+		self._replay_positions = None
+		if replay is not None:
+			if replay_vehicle is None and len(replay.vehicles) > 1:
+				raise ValueError(f"The recording has vehicles {', '.join(replay.vehicles.values())}, choose one to replay.")
+			# The simulator sends its own heartbeats
+			positions = replay.positions(source=RecordSource.STREAM, vehicle=replay_vehicle)
+			self._replay_positions = positions[replay.index["topic"][positions] != RecordTopic.Heartbeat]
+		self._replay_next = 0
+		self._replay_start = None
+		self._latest_replayed = dict()
+		self._starting = False
+		# (due time, action) pairs for requests that take a while to finish
+		self._scheduled = []
+		self._router = None
+		self._pub = None
+		self._halt = False
+		# (timestamp, Telemetry message) samples waiting for retrieve_batch
+		self._batch = deque(maxlen=self.BATCH_CAPACITY)
+		self._batch_dropped = 0
+		self._replies_to_drop = 0
+		self._ignoring_requests = False
+
+	def stop(self):
+		self._halt = True
+
+	def _encode(self, message, binary):
+		if binary:
+			return wire_format.encode(message)
+		return self._json_encoder.encode(message).encode("utf-8")
+
+	def _is_binary(self, envelope):
+		return envelope[0] in self._binary_clients
+
+	def _interface_status(self, binary, fail_state="NO_FAILURE", fail_output=""):
+		state = "ATTEMPTING" if self._starting else "ONLINE" if self.online else "OFFLINE"
+		return self._encode({"topic": "InterfaceStatus", "state": state, "fail_state": fail_state, "fail_output": fail_output,
+							"active_mode": False}, binary)
+
+	def _command_result(self, command, success, message):
+		# Command results are always JSON, like the real interface
+		return self._json_encoder.encode(
+			{"topic": "CommandResult", "command": command, "success": success, "message": message}).encode("utf-8")
+
+	def _reply(self, envelope, *frames):
+		self._router.send_multipart(envelope + list(frames))
+		self.replies += 1
+
+	def _send_frame(self, topic, payload):
+		self._pub.send(topic.encode("utf-8") + b" " + payload, zmq.NOBLOCK)
+		self.published += 1
+
+	# Whether any subscriber would receive a "<topic> " frame
+	def _feed_wants(self, topic):
+		frame_start = topic.encode("utf-8") + b" "
+		for prefix in self._feed_prefixes:
+			length = min(len(prefix), len(frame_start))
+			if prefix[:length] == frame_start[:length]:
+				return True
+		return False
+
+	# Publishes message in each format that's subscribed to
+	def _publish(self, topic, message):
+		if self._feed_wants(topic):
+			self._send_frame(topic, self._encode(message, False))
+		binary_topic = wire_format.feed_topic(topic, wire_format.WireFormat.BINARY)
+		if self._feed_wants(binary_topic):
+			self._send_frame(binary_topic, self._encode(message, True))
+
+	def _update_subscriptions(self):
+		while True:
+			try:
+				subscription = self._pub.recv(zmq.NOBLOCK)
+			except zmq.Again:
+				return
+			# A 1 to subscribe or a 0 to unsubscribe, followed by the prefix
+			if subscription[:1] == b"\x01":
+				self._feed_prefixes.add(subscription[1:])
+			elif subscription[:1] == b"\x00":
+				self._feed_prefixes.discard(subscription[1:])
+
+	def _handle_request(self, frames):
+		if len(frames) != 3:
+			return
+		envelope = frames[:2]
+		words = str(frames[2], "utf-8").split(" ")
+		request = words[0]
+		binary = self._is_binary(envelope)
+
+		if request == "inject_fault":
+			self._inject_fault(envelope, words[1:])
+			return
+		if self._ignoring_requests:
+			return
+		if self._replies_to_drop > 0:
+			self._replies_to_drop -= 1
+			return
+
+		if request == "check_interface":
+			if len(words) > 1 and words[1] == "binary":
+				self._binary_clients.add(envelope[0])
+			else:
+				self._binary_clients.discard(envelope[0])
+			self._reply(envelope, self._interface_status(self._is_binary(envelope)))
+		elif request == "retrieve_data":
+			if not self.online:
+				self._reply(envelope, self._command_result(request, False, "Vehicle is not connected."))
+			else:
+				self._reply(envelope, *self._latest_data(time.monotonic(), binary))
+		elif request == "retrieve_batch":
+			if not self.online:
+				self._reply(envelope, self._command_result(request, False, "Vehicle is not connected."))
+			elif self._replay is not None:
+				self._reply(envelope, self._command_result(request, False, "Telemetry batches aren't available from a replay."))
+			else:
+				self._reply(envelope, self._encode(self._take_batch(), binary))
+		elif request == "start_interface":
+			if self._starting or self.online:
+				self._reply(envelope, self._interface_status(binary))
+			else:
+				self._starting = True
+				self._schedule(self.start_delay, lambda: self._finish_start(envelope))
+		elif request == "set_rates":
+			self._set_rates(envelope, words[1:])
+		elif request == "return_home":
+			if not self.online:
+				self._reply(envelope, self._command_result(request, False, "Vehicle is not connected."))
+			else:
+				self._schedule(self.return_home_delay, lambda: self._finish_return_home(envelope))
+		else:
+			self._reply(envelope, self._command_result(request, False, "Unknown command."))
+
+	def _inject_fault(self, envelope, arguments):
+		try:
+			fault = SimulatedFault(arguments[0])
+			count = int(arguments[1]) if len(arguments) > 1 else 1
+		except (IndexError, ValueError):
+			self._reply(envelope, self._command_result("inject_fault", False, "Unknown fault."))
+			return
+		if fault is SimulatedFault.DROP_REPLIES:
+			self._replies_to_drop += count
+		else:
+			self._ignoring_requests = True
+		self._reply(envelope, self._command_result("inject_fault", True, f"Injected {fault.value}."))
+
+	def _set_rates(self, envelope, rates):
+		try:
+			hz, velocity_hz = (int(rate) for rate in rates)
+		except ValueError:
+			hz = velocity_hz = None
+		if not self.online:
+			self._reply(envelope, self._command_result("set_rates", False, "Vehicle is not connected."))
+		elif not is_subscription_rates(hz, velocity_hz):
+			self._reply(envelope, self._command_result("set_rates", False, "Unsupported subscription frequency."))
+		else:
+			self.hz, self.velocity_hz = hz, velocity_hz
+			self._reply(envelope, self._command_result("set_rates", True, "Changed the subscription rates."))
+
+	def _latest_data(self, now, binary):
+		if self._replay is not None:
+			topics = (RecordTopic.FlightStatus, RecordTopic.ControlDevice, RecordTopic.Telemetry)
+			return [self._encode(self._latest_replayed[topic], binary) for topic in topics if topic in self._latest_replayed]
+		return [self._encode(self._synthesizer.flight_status(now), binary),
+				self._encode(self._synthesizer.control_device(now), binary),
+				self._encode(self._synthesizer.telemetry(now, self.velocity_hz), binary)]
+
+	def _take_batch(self):
+		batch = {"topic": "TelemetryBatch", "dropped": self._batch_dropped,
+				"timestamp": [timestamp for timestamp, _ in self._batch]}
+		for name in ("fc_time", "received", "velocity_fc_time", "longitude", "latitude", "altitude", "vel_x", "vel_y", "vel_z",
+					"accel_x", "accel_y", "accel_z", "satellites"):
+			batch[name] = [sample[name] for _, sample in self._batch]
+		self._batch.clear()
+		self._batch_dropped = 0
+		return batch
+
+	def _schedule(self, delay, action):
+		self._scheduled.append((time.monotonic() + delay, action))
+
+	def _finish_start(self, envelope):
+		self._starting = False
+		self.online = True
+		self._reply(envelope, self._interface_status(self._is_binary(envelope)))
+
+	def _finish_return_home(self, envelope):
+		self._synthesizer.return_to_home = True
+		self._reply(envelope, self._command_result("return_home", True, "Going home!"))
+
+	def _run_scheduled(self, now):
+		due = [item for item in self._scheduled if item[0] <= now]
+		if len(due) == 0:
+			return
+		self._scheduled = [item for item in self._scheduled if item[0] > now]
+		for _, action in due:
+			action()
+
+	# Returns when the next sample is due
+	def _publish_synthesized(self, now, next_publish):
+		interval = 1 / self.hz
+		# Skip ahead rather than trying to catch up on a backlog that can't be published in time
+		next_publish = max(next_publish, now - self.PUBLISH_BATCH * interval)
+		published = 0
+		while next_publish <= now and published < self.PUBLISH_BATCH:
+			telemetry = self._synthesizer.telemetry(next_publish, self.velocity_hz)
+			self._publish("ControlDevice", self._synthesizer.control_device(next_publish))
+			self._publish("Telemetry", telemetry)
+			if len(self._batch) == self._batch.maxlen:
+				self._batch_dropped += 1
+			self._batch.append((next_publish, telemetry))
+			next_publish += interval
+			published += 1
+		return next_publish
+
+	# Returns when the next replayed frame is due, or None once the replay is over
+	def _publish_replayed(self, now):
+		if self._replay_start is None:
+			self._replay_start = now
+		timestamps = self._replay.timestamps
+		first_timestamp = timestamps[self._replay_positions[0]]
+
+		published = 0
+		while published < self.PUBLISH_BATCH:
+			if self._replay_next >= len(self._replay_positions):
+				if not self.loop_replay:
+					return None
+				self._replay_next = 0
+				self._replay_start = now
+			position = self._replay_positions[self._replay_next]
+			due = self._replay_start if self.replay_speed == 0 else \
+				self._replay_start + (timestamps[position] - first_timestamp) / self.replay_speed
+			if due > now:
+				return due
+
+			# Recorded frames are in whichever format was recorded, so they're decoded to be published in both
+			frame = self._replay.frame(position)
+			message = self._decoder.decode(bytes(frame.payload))
+			self._latest_replayed[frame.topic] = message
+			self._publish(frame.topic.name, message)
+			self._replay_next += 1
+			published += 1
+		return now
+
+	def run(self):
+		os.makedirs(self._feed_directory, exist_ok=True)
+		self._router = self._zmq_context.socket(zmq.ROUTER)
+		self._router.bind("ipc://{}/drone.ipc".format(self._feed_directory))
+		self._pub = self._zmq_context.socket(zmq.XPUB)
+		self._pub.bind("ipc://{}/telemetry.ipc".format(self._feed_directory))
+
+		poller = zmq.Poller()
+		poller.register(self._router, zmq.POLLIN)
+		poller.register(self._pub, zmq.POLLIN)
+		now = time.monotonic()
+		next_heartbeat = now
+		next_slow_topic = now
+		next_publish = now
+		next_replay = now if self._replay is not None and len(self._replay_positions) > 0 else None
+		heartbeat_sequence = 0
+
+		try:
+			while not self._halt:
+				wake_times = [next_heartbeat] + [due for due, _ in self._scheduled]
+				if self._replay is None and self.online:
+					wake_times += [next_publish, next_slow_topic]
+				if next_replay is not None:
+					wake_times.append(next_replay)
+				timeout = max(0, (min(wake_times) - time.monotonic()) * 1000)
+
+				events = dict(poller.poll(timeout))
+				if self._pub in events:
+					self._update_subscriptions()
+				if self._router in events:
+					while True:
+						try:
+							self._handle_request(self._router.recv_multipart(zmq.NOBLOCK))
+						except zmq.Again:
+							break
+
+				now = time.monotonic()
+				self._run_scheduled(now)
+				if now >= next_heartbeat:
+					self._send_frame("Heartbeat", self._json_encoder.encode(
+						{"topic": "Heartbeat", "pid": os.getpid(), "sequence": heartbeat_sequence}).encode("utf-8"))
+					heartbeat_sequence += 1
+					next_heartbeat = now + self.HEARTBEAT_INTERVAL
+				if next_replay is not None:
+					next_replay = self._publish_replayed(now)
+				elif self._replay is None and self.online:
+					if now >= next_slow_topic:
+						self._publish("FlightStatus", self._synthesizer.flight_status(now))
+						next_slow_topic = now + self.SLOW_TOPIC_INTERVAL
+					next_publish = self._publish_synthesized(now, next_publish)
+		finally:
+			self._router.close(linger=0)
+			self._pub.close(linger=0)
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Simulated stand-in for the DJI interface process.")
+	parser.add_argument("--hz", type=float, default=8, help="Telemetry rate in Hz.")
+	parser.add_argument("--online", action="store_true", help="Start with the vehicle already connected.")
+	parser.add_argument("--start-delay", type=float, default=1.0, help="Seconds start_interface takes to finish.")
+	parser.add_argument("--replay", help="Directory of a flight recording to replay instead of synthesizing telemetry.")
+	parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, or 0 to replay as fast as possible.")
+	parser.add_argument("--loop", action="store_true", help="Restart the replay when it ends.")
+	parser.add_argument("--vehicle", help="Vehicle to replay from a recording of a fleet.")
+	parser.add_argument("--feeds", default=os.environ.get("AUTOCOPILOT_FEED_DIR", "/tmp/feeds"),
+						help="Directory of the ipc feeds to bind, AUTOCOPILOT_FEED_DIR or /tmp/feeds by default.")
+	parser.add_argument("--pidfile", help="Write a pidfile so a supervisor can adopt this process.")
+	args = parser.parse_args(argv)
+
+	replay = FlightRecording(args.replay) if args.replay is not None else None
+	if args.pidfile is not None:
+		write_pidfile(args.pidfile, os.getpid())
+
+	interface = SimulatedInterface(
+		zmq.Context(), hz=args.hz, online=args.online, start_delay=args.start_delay, replay=replay, replay_speed=args.speed,
+		loop_replay=args.loop, feed_directory=args.feeds, replay_vehicle=args.vehicle)
+	try:
+		interface.run()
+	except KeyboardInterrupt:
+		pass
+	print(f"Published {interface.published} messages and sent {interface.replies} replies.")
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,522 @@
+import os
+import shutil
+import select
+import signal
+import threading
+import time
+from subprocess import Popen, STDOUT, DEVNULL, TimeoutExpired
+
+from zmq_threads import WakeupSignal
+from logger import Log
+
+
+# Start time of a process in clock ticks since boot, which together with its pid identifies it even after pid reuse
+def process_start_time(pid):
+	with open(f"/proc/{pid}/stat", "rb") as f:
+		stat = f.read()
+	# The command name in the second field may itself contain spaces and parentheses
+	return int(stat[stat.rindex(b")") + 2:].split()[19])
+
+
+# Pidfiles hold "<pid> <start time>", so a pid that was reused by an unrelated process isn't mistaken for the original
+def write_pidfile(path, pid):
+	temp_path = path + ".tmp"
+	with open(temp_path, "w") as f:
+		f.write(f"{pid} {process_start_time(pid)}")
+	os.replace(temp_path, path)
+
+
+# Returns the pid in the pidfile if that process is still running, otherwise None
+def read_pidfile(path):
+	try:
+		with open(path) as f:
+			pid, start_time = (int(field) for field in f.read().split())
+		if process_start_time(pid) != start_time:
+			return None
+	except (OSError, ValueError):
+		return None
+	return pid
+
+
+# Running totals of how long failures took to notice and to recover from, in seconds.
+# Detection is measured from the last sign of life, which is the last heartbeat or the process starting, so for a crash
+# it's an upper bound. Recovery is measured from detection to the first heartbeat of the replacement process, or to it
+# starting when there are no heartbeats.
+class RecoveryStats:
+	__slots__ = ("crashes", "hangs", "restarts", "detections", "recoveries", "last_time_to_detect", "last_time_to_recover",
+				"_total_time_to_detect", "_total_time_to_recover")
+
+	def __init__(self):
+		self.crashes = 0
+		self.hangs = 0
+		self.restarts = 0
+		self.detections = 0
+		self.recoveries = 0
+		self.last_time_to_detect = None
+		self.last_time_to_recover = None
+		self._total_time_to_detect = 0
+		self._total_time_to_recover = 0
+
+	def record_detection(self, seconds):
+		self.detections += 1
+		self.last_time_to_detect = seconds
+		self._total_time_to_detect += seconds
+
+	def record_recovery(self, seconds):
+		self.recoveries += 1
+		self.last_time_to_recover = seconds
+		self._total_time_to_recover += seconds
+
+	@property
+	def mean_time_to_detect(self):
+		return None if self.detections == 0 else self._total_time_to_detect / self.detections
+
+	@property
+	def mean_time_to_recover(self):
+		return None if self.recoveries == 0 else self._total_time_to_recover / self.recoveries
+
+	def as_dict(self):
+		return {"crashes": self.crashes, "hangs": self.hangs, "restarts": self.restarts,
+				"last_time_to_detect": self.last_time_to_detect, "mean_time_to_detect": self.mean_time_to_detect,
+				"last_time_to_recover": self.last_time_to_recover, "mean_time_to_recover": self.mean_time_to_recover}
+
+
+# Starts a process and keeps it alive without scanning the process table.
+# The process id is kept in a pidfile, so a later supervisor can adopt a process that outlived the one that started it,
+# or one that was started by hand and wrote the pidfile itself.
+# Exits are noticed through a pidfd where the kernel supports it, or by reaping the child with waitpid otherwise, and a
+# process that stops sending heartbeats for heartbeat_timeout seconds is killed as hung. Unexpected exits are restarted
+# after a backoff that doubles with every failure, and resets once a process stays up for stable_time seconds.
+# is_running only reads state kept up to date by the monitor thread, so it's cheap enough to call from anywhere.
+class ProcessSupervisor:
+	# How often liveness is polled when there's no pidfd to wait on
+	CHECK_INTERVAL = 0.25
+	# How long to wait for a killed process to exit
+	KILL_TIMEOUT = 5
+	# How often the size of the output is checked when it's rotated
+	OUTPUT_CHECK_INTERVAL = 5
+
+	def __init__(self, name, command, pidfile, output_path=None, heartbeat_timeout=None, restart_on_exit=True,
+				before_start=None, min_backoff=0.5, max_backoff=30, stable_time=10, cwd=None, env=None, output_max_bytes=None,
+				output_backup_count=1):
+		self.name = name
+		self.command = command
+		self.cwd = cwd
+		# Variables added to the supervisor's own environment for the process
+		self.env = env
+		self.pidfile = pidfile
+		self.output_path = output_path
+		# Without a limit the output starts out empty with every process. With one it's appended to and rotated.
+		self.output_max_bytes = output_max_bytes
+		self.output_backup_count = output_backup_count
+		self.heartbeat_timeout = heartbeat_timeout
+		self.restart_on_exit = restart_on_exit
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.stable_time = stable_time
+		self.stats = RecoveryStats()
+
+		self._before_start = before_start
+		self._lock = threading.RLock()
+		# Held for the whole of a kill, which waits on the process without holding _lock. Taken before _lock.
+		self._kill_lock = threading.Lock()
+		self._wakeup = WakeupSignal()
+		self._monitor = None
+		self._halt_event = threading.Event()
+		self._popen = None
+		self._pid = None
+		self._pidfd = None
+		self._running = False
+		self._start_time = None
+		self._last_heartbeat = None
+		# Set while the current process is being killed on purpose, so its exit isn't treated as a failure
+		self._expected_exit = False
+		self._backoff = min_backoff
+		self._restart_time = None
+		# When the failure currently being recovered from was detected
+		self._failure_time = None
+		self._next_output_check = 0
+
+	@property
+	def is_running(self):
+		return self._running
+
+	@property
+	def pid(self):
+		return self._pid
+
+	@property
+	def restart_pending(self):
+		return self._restart_time is not None
+
+	# Number of times the process was replaced, whether by the supervisor or through restart()
+	@property
+	def restart_count(self):
+		return self.stats.restarts
+
+	# Makes sure the process is running, adopting the one in the pidfile if it's still alive.
+	# Returns True if a new process was started. Does nothing while a restart is waiting out its backoff.
+	def ensure_running(self):
+		with self._lock:
+			self._start_monitor()
+			if self._running or self._restart_time is not None:
+				return False
+			if self._adopt():
+				Log.add(f"Adopted the running {self.name} process {self._pid}")
+				return False
+			self._spawn()
+			return True
+
+	# Called whenever the process shows a sign of life
+	def heartbeat(self):
+		now = time.monotonic()
+		with self._lock:
+			self._last_heartbeat = now
+			if self._failure_time is not None and self._running:
+				self.stats.record_recovery(now - self._failure_time)
+				self._failure_time = None
+
+	# Changes how long the process can go without a heartbeat, or turns hang detection off with None
+	def set_heartbeat_timeout(self, timeout):
+		with self._lock:
+			self.heartbeat_timeout = timeout
+		self._notify_monitor()
+
+	# Kills the current process, if any, and starts a new one straight away
+	def restart(self, reason=None):
+		with self._lock:
+			now = time.monotonic()
+			if reason is not None:
+				Log.add(f"Restarting {self.name}: {reason}", warn=True)
+				self.stats.record_detection(now - self._last_sign_of_life())
+				self._failure_time = now
+			self._start_monitor()
+			# The monitor mustn't start a process of its own while this one is killed
+			self._restart_time = None
+		self._kill()
+		with self._lock:
+			self._restart_time = None
+			self._spawn()
+			self.stats.restarts += 1
+
+	# Kills the process and stops supervising it
+	def stop(self):
+		with self._lock:
+			self._halt_event.set()
+			self._restart_time = None
+		self._kill()
+		with self._lock:
+			self._restart_time = None
+			self._remove_pidfile()
+		self._stop_monitor()
+
+	def _start_monitor(self):
+		if self._monitor is None or not self._monitor.is_alive():
+			self._halt_event.clear()
+			self._monitor = threading.Thread(target=self._monitor_process, name=f"{self.name}-supervisor")
+			self._monitor.daemon = True
+			self._monitor.start()
+
+	# Has the monitor look at the process again, called whenever something it waits on changed
+	def _notify_monitor(self):
+		self._wakeup.set()
+
+	def _stop_monitor(self):
+		self._wakeup.set()
+		if self._monitor is not None and self._monitor is not threading.current_thread():
+			self._monitor.join(self.KILL_TIMEOUT)
+
+	def _last_sign_of_life(self):
+		if self._last_heartbeat is not None and (self._start_time is None or self._last_heartbeat > self._start_time):
+			return self._last_heartbeat
+		return self._start_time if self._start_time is not None else time.monotonic()
+
+	def _spawn(self):
+		if self._before_start is not None:
+			self._before_start()
+
+		output = DEVNULL if self.output_path is None else self._open_output()
+		# A new session keeps the process running after a hangup, like nohup did
+		env = None if self.env is None else dict(os.environ, **self.env)
+		self._popen = Popen(
+			self.command, stdin=DEVNULL, stdout=output, stderr=STDOUT, start_new_session=True, cwd=self.cwd, env=env)
+		if output is not DEVNULL:
+			os.close(output)
+
+		self._track(self._popen.pid)
+		self._write_pidfile()
+		Log.add(f"Started {self.name} with pid {self._pid}")
+
+		if self._failure_time is not None and self.heartbeat_timeout is None:
+			self.stats.record_recovery(time.monotonic() - self._failure_time)
+			self._failure_time = None
+		self._notify_monitor()
+
+	# Opened for appending, so the process keeps writing at the end of the file after rotation truncates it
+	def _open_output(self):
+		flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+		if self.output_max_bytes is None:
+			flags |= os.O_TRUNC
+		return os.open(self.output_path, flags, 0o644)
+
+	# Copy-truncate rotation, since the process holds its output open and can't be told to reopen it. The output is
+	# copied to numbered backups and truncated in place. Anything written between the copy and the truncation is lost.
+	def _rotate_output(self):
+		try:
+			if os.path.getsize(self.output_path) < self.output_max_bytes:
+				return
+			for number in range(self.output_backup_count - 1, 0, -1):
+				backup = f"{self.output_path}.{number}"
+				if os.path.exists(backup):
+					os.replace(backup, f"{self.output_path}.{number + 1}")
+			if self.output_backup_count > 0:
+				shutil.copyfile(self.output_path, self.output_path + ".1")
+			os.truncate(self.output_path, 0)
+		except OSError as e:
+			Log.add(f"Couldn't rotate the output of {self.name}: {e}", warn=True)
+
+	def _adopt(self):
+		pid = read_pidfile(self.pidfile)
+		if pid is None:
+			return False
+
+		self._popen = None
+		self._track(pid)
+		self._notify_monitor()
+		return True
+
+	def _track(self, pid):
+		self._close_pidfd()
+		self._pid = pid
+		self._pidfd = self._open_pidfd(pid)
+		self._running = True
+		self._expected_exit = False
+		self._start_time = time.monotonic()
+
+	@staticmethod
+	def _open_pidfd(pid):
+		if not hasattr(os, "pidfd_open"):
+			return None
+		try:
+			return os.pidfd_open(pid)
+		except OSError:
+			return None
+
+	def _close_pidfd(self):
+		if self._pidfd is not None:
+			os.close(self._pidfd)
+			self._pidfd = None
+
+	# Kills the current process and waits for it to exit. Returns False if there was no process to kill.
+	# The process is taken over under _lock, then signalled and waited on without it, so heartbeat() and the monitor
+	# carry on while it dies. Never call it with _lock held.
+	def _kill(self):
+		with self._kill_lock:
+			with self._lock:
+				if not self._running:
+					return False
+				self._expected_exit = True
+				popen, pid, pidfd = self._popen, self._pid, self._pidfd
+				# The pidfd is closed here once the wait is over, so nothing else may close it in the meantime
+				self._pidfd = None
+
+			try:
+				if pidfd is not None:
+					signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+				else:
+					os.kill(pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+			self._wait_for_exit(popen, pid, self.KILL_TIMEOUT)
+			if pidfd is not None:
+				os.close(pidfd)
+
+			with self._lock:
+				self._process_exited()
+			return True
+
+	# Returns True once the process is gone. Children are reaped, adopted processes can only be watched.
+	def _wait_for_exit(self, popen, pid, timeout):
+		if popen is not None:
+			try:
+				popen.wait(timeout)
+				return True
+			except TimeoutExpired:
+				return False
+
+		deadline = time.monotonic() + timeout
+		while self._pid_exists(popen, pid):
+			if time.monotonic() >= deadline:
+				return False
+			time.sleep(0.01)
+		return True
+
+	@staticmethod
+	def _pid_exists(popen, pid):
+		if popen is not None:
+			return popen.poll() is None
+		try:
+			os.kill(pid, 0)
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			pass
+		return True
+
+	def _process_exited(self):
+		self._running = False
+		self._close_pidfd()
+		self._remove_pidfile()
+
+	def _write_pidfile(self):
+		try:
+			write_pidfile(self.pidfile, self._pid)
+		except OSError:
+			# The process already exited, which the monitor picks up
+			pass
+
+	def _remove_pidfile(self):
+		try:
+			os.remove(self.pidfile)
+		except FileNotFoundError:
+			pass
+
+	def _monitor_timeout(self):
+		now = time.monotonic()
+		timeouts = []
+		if self._running:
+			if self._pidfd is None:
+				timeouts.append(self.CHECK_INTERVAL)
+			# A process that's being killed can't hang again
+			if self.heartbeat_timeout is not None and not self._expected_exit:
+				timeouts.append(self._last_sign_of_life() + self.heartbeat_timeout - now)
+		if self._restart_time is not None:
+			timeouts.append(self._restart_time - now)
+		if self._running and self.output_path is not None and self.output_max_bytes is not None:
+			timeouts.append(self._next_output_check - now)
+		return None if len(timeouts) == 0 else max(0, min(timeouts))
+
+	def _monitor_process(self):
+		while not self._halt_event.is_set():
+			with self._lock:
+				timeout = self._monitor_timeout()
+				watched = [self._wakeup] if self._pidfd is None else [self._wakeup, self._pidfd]
+			readable, _, _ = select.select(watched, [], [], timeout)
+			if self._wakeup in readable:
+				self._wakeup.clear()
+			if self._halt_event.is_set():
+				break
+			self._check()
+
+	# Acts on an exit or a hang of the process, a restart that's due and output that's due a size check
+	def _check(self):
+		with self._lock:
+			now = time.monotonic()
+			hung = False
+			# A readable pidfd only prompts the check, since the descriptor may have been replaced while waiting
+			if self._running and not self._pid_exists(self._popen, self._pid):
+				self._handle_exit(now)
+			elif self._running and not self._expected_exit and self.heartbeat_timeout is not None and \
+					now - self._last_sign_of_life() >= self.heartbeat_timeout:
+				# Killed once the lock is released
+				hung = True
+
+			if self._restart_time is not None and now >= self._restart_time:
+				self._restart_time = None
+				# Counted once the new process is up, since restart_count is read without the lock
+				self._spawn()
+				self.stats.restarts += 1
+
+			rotate = self.output_path is not None and self.output_max_bytes is not None and now >= self._next_output_check
+			if rotate:
+				self._next_output_check = now + self.OUTPUT_CHECK_INTERVAL
+		if hung:
+			self._handle_hang(now)
+		# Copying the output can take a while, and heartbeats shouldn't wait on it
+		if rotate:
+			self._rotate_output()
+
+	def _handle_exit(self, now):
+		if self._expected_exit:
+			return
+
+		exit_code = None
+		if self._popen is not None:
+			self._popen.wait()
+			exit_code = self._popen.returncode
+		uptime = now - self._start_time
+		self._process_exited()
+
+		self.stats.crashes += 1
+		self.stats.record_detection(now - self._last_sign_of_life())
+		self._failure_time = now
+		Log.add(f"{self.name} exited unexpectedly with code {exit_code} after {uptime:.1f} seconds", warn=True)
+		self._schedule_restart(now, uptime)
+
+	# Called without the lock held, since the kill waits on the process
+	def _handle_hang(self, now):
+		with self._lock:
+			uptime = now - self._start_time
+			detection = now - self._last_sign_of_life()
+		# Something else, such as stop(), got to the process first
+		if not self._kill():
+			return
+
+		with self._lock:
+			self.stats.hangs += 1
+			self.stats.record_detection(detection)
+			self._failure_time = now
+			Log.add(f"{self.name} sent no heartbeat for {detection:.1f} seconds and was killed", warn=True)
+			if not self._halt_event.is_set():
+				self._schedule_restart(now, uptime)
+		self._notify_monitor()
+
+	def _schedule_restart(self, now, uptime):
+		if not self.restart_on_exit:
+			return
+		if uptime >= self.stable_time:
+			self._backoff = self.min_backoff
+		self._restart_time = now + self._backoff
+		Log.add(f"Restarting {self.name} in {self._backoff:.1f} seconds")
+		self._backoff = min(self._backoff * 2, self.max_backoff)
+
+
+# Stands in for a ProcessSupervisor when the interface process is started and looked after by something else.
+# The process is assumed to be running, and restarts are only logged.
+class UnmanagedProcess:
+	def __init__(self, name):
+		self.name = name
+		self.heartbeat_timeout = None
+		self.stats = RecoveryStats()
+
+	@property
+	def is_running(self):
+		return True
+
+	@property
+	def pid(self):
+		return None
+
+	@property
+	def restart_pending(self):
+		return False
+
+	@property
+	def restart_count(self):
+		return 0
+
+	def ensure_running(self):
+		return False
+
+	def heartbeat(self):
+		pass
+
+	def set_heartbeat_timeout(self, timeout):
+		pass
+
+	def restart(self, reason=None):
+		Log.add(f"{self.name} needs restarting but isn't managed by AutoCopilot" + ("" if reason is None else f": {reason}"),
+				warn=True)
+
+	def stop(self):
+		pass
@@ -0,0 +1,107 @@
+import numpy as np
+
+TELEMETRY_DTYPE = np.dtype([
+	("timestamp", np.float64),
+	("lat", np.float64),
+	("lon", np.float64),
+	("alt", np.float32),
+	("vel", np.float32, (3,)),
+	("accel", np.float32, (3,)),
+	("satellites", np.uint16),
+	# The flight controller's clock when it sent the fast and velocity packages, and the host's monotonic clock when the
+	# fast package arrived at the interface, in seconds. NaN when the interface didn't report them.
+	("fc_time", np.float64),
+	("received", np.float64),
+	("velocity_fc_time", np.float64),
+])
+# Fields that are NaN until written
+UNKNOWN_FIELDS = ("accel", "fc_time", "received", "velocity_fc_time")
+
+
+# Fixed capacity history of telemetry samples stored as columns of a preallocated structured array.
+# Every sample is written twice, capacity rows apart, so the newest samples always form one contiguous slice and
+# every query returns a view instead of a copy. There must only be a single writer. Readers don't lock, so a reader
+# holding on to a view while the writer laps the buffer will see the oldest rows of that view change.
+# Timestamps are expected to increase monotonically.
+class TelemetryBuffer:
+	def __init__(self, capacity):
+		if capacity < 1:
+			raise ValueError("A telemetry buffer needs a capacity of at least one sample.")
+		self.capacity = capacity
+		self._data = np.zeros(capacity * 2, dtype=TELEMETRY_DTYPE)
+		for field in UNKNOWN_FIELDS:
+			self._data[field] = np.nan
+		# Total samples ever appended. Only the writer changes it, after the sample is fully written.
+		self._count = 0
+
+	@classmethod
+	def for_duration(cls, seconds, hz):
+		return cls(max(1, int(np.ceil(seconds * hz))))
+
+	def __len__(self):
+		return min(self._count, self.capacity)
+
+	@property
+	def total_appended(self):
+		return self._count
+
+	def append(self, timestamp, lat, lon, alt, vel, accel, satellites, fc_time=np.nan, received=np.nan,
+			velocity_fc_time=np.nan):
+		index = self._count % self.capacity
+		row = (timestamp, lat, lon, alt, vel, accel, satellites, fc_time, received, velocity_fc_time)
+		self._data[index] = row
+		self._data[index + self.capacity] = row
+		self._count += 1
+
+	# Appends rows of TELEMETRY_DTYPE in one step. Only the newest capacity rows of a larger batch are kept.
+	def extend(self, samples):
+		count = len(samples)
+		if count == 0:
+			return
+		kept = samples[-self.capacity:]
+		indices = (self._count + count - len(kept) + np.arange(len(kept))) % self.capacity
+		self._data[indices] = kept
+		self._data[indices + self.capacity] = kept
+		self._count += count
+
+	def append_message(self, timestamp, message):
+		nan = np.nan
+		self.append(
+			timestamp, message["latitude"], message["longitude"], message["altitude"],
+			(message["vel_x"], message["vel_y"], message["vel_z"]),
+			(message.get("accel_x", nan), message.get("accel_y", nan), message.get("accel_z", nan)),
+			message["satellites"], message.get("fc_time", nan), message.get("received", nan),
+			message.get("velocity_fc_time", nan))
+
+	def _newest(self, count, n):
+		n = min(n, count, self.capacity)
+		if n <= 0:
+			return self._data[:0]
+		end = (count - 1) % self.capacity + self.capacity + 1
+		return self._data[end - n:end]
+
+	def all(self):
+		count = self._count
+		return self._newest(count, count)
+
+	def last(self, n):
+		return self._newest(self._count, n)
+
+	def latest(self):
+		samples = self.last(1)
+		return samples[0] if len(samples) > 0 else None
+
+	# The newest sample copied out of the buffer, so it never changes as the buffer laps, and made read-only
+	def latest_copy(self):
+		samples = self.last(1).copy()
+		samples.flags.writeable = False
+		return samples[0] if len(samples) > 0 else None
+
+	def since(self, t):
+		samples = self.all()
+		return samples[np.searchsorted(samples["timestamp"], t, side="left"):]
+
+	def window(self, t0, t1):
+		samples = self.all()
+		timestamps = samples["timestamp"]
+		return samples[np.searchsorted(timestamps, t0, side="left"):np.searchsorted(timestamps, t1, side="right")]
@@ -0,0 +1,172 @@
+from threading import Lock
+
+import numpy as np
+
+# Telemetry put on a uniform grid of host monotonic times, with every field interpolated to the grid's times
+ALIGNED_DTYPE = np.dtype([
+	("time", np.float64),
+	("lat", np.float64),
+	("lon", np.float64),
+	("alt", np.float32),
+	("vel", np.float32, (3,)),
+	("accel", np.float32, (3,)),
+])
+
+
+# Maps the flight controller's clock to the host's monotonic clock, from pairs of when the flight controller sent a
+# package and when it arrived. Arrivals are only ever late, by however long the link and the OSDK took, so the fit
+# follows the least delayed pair of every BIN seconds rather than the average: host = fc + offset + skew * (fc - reference).
+# The constant part of the delay can't be told apart from the offset, so mapped times keep the least delay that was seen.
+# Pairs older than WINDOW seconds are forgotten, which lets the fit follow drift. A flight controller clock going
+# backwards means it restarted, and starts a new fit. One thread adds pairs, any thread can map times.
+class ClockEstimator:
+	WINDOW = 60
+	BIN = 1.0
+	# Shortest span of flight controller time the skew is fitted over, below it only the offset is estimated
+	MIN_SKEW_SPAN = 10
+	# How far the flight controller clock can go backwards before it's taken for a restart
+	RESET_TOLERANCE = 1.0
+
+	def __init__(self):
+		self._fc = np.empty(0)
+		self._host = np.empty(0)
+		self._lock = Lock()
+		self._fitted = False
+		self._offset = None
+		self._skew = 0.0
+		self._reference = 0.0
+		self.resets = 0
+
+	@property
+	def ready(self):
+		return self.fit() is not None
+
+	@property
+	def offset(self):
+		fit = self.fit()
+		return None if fit is None else fit[0]
+
+	@property
+	def skew(self):
+		fit = self.fit()
+		return None if fit is None else fit[1]
+
+	# Adds pairs of flight controller send times and host arrival times. Pairs with an unknown time are skipped.
+	def add(self, fc_times, host_times):
+		fc_times = np.atleast_1d(np.asarray(fc_times, dtype=np.float64))
+		host_times = np.atleast_1d(np.asarray(host_times, dtype=np.float64))
+		known = np.isfinite(fc_times) & np.isfinite(host_times)
+		fc_times, host_times = fc_times[known], host_times[known]
+		if len(fc_times) == 0:
+			return
+
+		with self._lock:
+			fc, host = self._fc, self._host
+			restarted = np.flatnonzero(np.diff(np.concatenate((fc[-1:], fc_times))) < -self.RESET_TOLERANCE)
+			if len(restarted) > 0:
+				# Only the pairs since the last restart belong to the current clock
+				self.resets += 1
+				start = restarted[-1] - min(len(fc), 1) + 1
+				fc, host = np.empty(0), np.empty(0)
+				fc_times, host_times = fc_times[start:], host_times[start:]
+			fc = np.concatenate((fc, fc_times))
+			host = np.concatenate((host, host_times))
+			keep = np.searchsorted(fc, fc[-1] - self.WINDOW, side="left")
+			self._fc, self._host = fc[keep:], host[keep:]
+			self._fitted = False
+
+	# (offset, skew, reference) of the current fit, or None before the first pair
+	def fit(self):
+		with self._lock:
+			if not self._fitted:
+				self._fit()
+			return None if self._offset is None else (self._offset, self._skew, self._reference)
+
+	def _fit(self):
+		self._fitted = True
+		fc, host = self._fc, self._host
+		if len(fc) == 0:
+			self._offset = None
+			return
+
+		lags = host - fc
+		bins = np.floor((fc - fc[0]) / self.BIN).astype(np.int64)
+		starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+		# Sorted by bin and then lag, the first pair of every bin is its least delayed one. Flight controller times
+		# only increase, so the bins start at the same positions as before sorting.
+		least_delayed = np.lexsort((lags, bins))[starts]
+		fc, lags = fc[least_delayed], lags[least_delayed]
+
+		self._reference = fc[-1]
+		if len(fc) >= 3 and fc[-1] - fc[0] >= self.MIN_SKEW_SPAN:
+			self._skew, self._offset = np.polyfit(fc - self._reference, lags, 1)
+		else:
+			self._skew, self._offset = 0.0, lags.min()
+
+	# Host monotonic times of flight controller times, or None before the first pair
+	def to_host(self, fc_times):
+		fit = self.fit()
+		if fit is None:
+			return None
+		offset, skew, reference = fit
+		fc_times = np.asarray(fc_times, dtype=np.float64)
+		return fc_times + offset + skew * (fc_times - reference)
+
+
+# Times from start to stop, both included, every 1 / hz seconds. The times are whole multiples of the period, so grids
+# made from overlapping spans line up with each other.
+def uniform_grid(start, stop, hz):
+	first, last = np.ceil(start * hz), np.floor(stop * hz)
+	if last < first:
+		return np.empty(0)
+	return np.arange(first, last + 1) / hz
+
+
+# Linearly interpolates values taken at times onto grid in one pass over every column. Times must be increasing, and
+# values have one row per time. Grid times outside of times are NaN rather than extrapolated.
+def resample(times, values, grid):
+	times = np.asarray(times, dtype=np.float64)
+	values = np.asarray(values)
+	grid = np.asarray(grid, dtype=np.float64)
+	result = np.full((len(grid),) + values.shape[1:], np.nan, dtype=np.result_type(values.dtype, np.float32))
+	if len(times) == 0:
+		return result
+
+	inside = (grid >= times[0]) & (grid <= times[-1])
+	grid = grid[inside]
+	right = np.clip(np.searchsorted(times, grid, side="right"), 1, max(len(times) - 1, 1))
+	left = right - 1
+	span = times[right] - times[left]
+	weight = np.divide(grid - times[left], span, out=np.zeros_like(grid), where=span > 0)
+	weight = weight.reshape(weight.shape + (1,) * (values.ndim - 1))
+	result[inside] = values[left] + weight * (values[right] - values[left])
+	return result
+
+
+# Puts telemetry samples on a uniform grid at hz over the span where both the fast and velocity packages have samples.
+# With a ready clock, positions and accelerations are placed at when the flight controller sent the fast package and
+# velocities at when it sent the velocity package, mapped to host time. Without one every field is placed at the
+# sample's timestamp.
+def align_telemetry(samples, hz, clock=None):
+	if clock is not None and clock.ready:
+		samples = samples[np.isfinite(samples["fc_time"]) & np.isfinite(samples["velocity_fc_time"])]
+		fast_times = clock.to_host(samples["fc_time"])
+		velocity_times = clock.to_host(samples["velocity_fc_time"])
+	else:
+		fast_times = velocity_times = samples["timestamp"]
+
+	# Batches hold each fast package once, but streamed and retrieve_data samples are read at the publish rate and can
+	# repeat one. The velocity package comes slower than the fast package, so consecutive samples share it.
+	fast_times, fast = np.unique(fast_times, return_index=True)
+	velocity_times, velocity = np.unique(velocity_times, return_index=True)
+	if len(fast) == 0 or len(velocity) == 0:
+		return np.empty(0, dtype=ALIGNED_DTYPE)
+
+	grid = uniform_grid(max(fast_times[0], velocity_times[0]), min(fast_times[-1], velocity_times[-1]), hz)
+	aligned = np.empty(len(grid), dtype=ALIGNED_DTYPE)
+	aligned["time"] = grid
+	position = resample(fast_times, np.column_stack((samples["lat"][fast], samples["lon"][fast], samples["alt"][fast])), grid)
+	aligned["lat"], aligned["lon"], aligned["alt"] = position.T
+	aligned["accel"] = resample(fast_times, samples["accel"][fast], grid)
+	aligned["vel"] = resample(velocity_times, samples["vel"][velocity], grid)
+	return aligned
@@ -1,6 +1,5 @@
 import os
 import os.path
-from subprocess import check_output, CalledProcessError, Popen, run
 import functools
 from sys import exc_info
 
@@ -9,60 +8,41 @@ class UnexpectedStateError(Exception):
 	pass
 
 
-# Ensure an ipc feed is activated. Returns True if it created a new feed.
-# Set bound_process_name to check if a binding process exists
-def activate_feed(feed_name, bound_process_name=None):
-	feed_exists = os.path.exists("/tmp/feeds/{0}.ipc".format(feed_name))
-	owner_count = process_count(bound_process_name) if bound_process_name is not None else 0
+# Base of immutable state snapshots listing their fields in __slots__. A snapshot is never changed once built, a writer
+# builds a new one and swaps it in with a single assignment, so a reader loading that one attribute gets a consistent
+# state without locking. Writers still serialize among themselves, or one change could overwrite another.
+class Snapshot:
+	__slots__ = ()
 
-	if feed_exists is False and owner_count == 0:
-		# If the directory doesn't exist then we're starting fresh
-		if os.path.exists("/tmp/feeds/") is False:
-			os.mkdir("/tmp/feeds/")
-		open("/tmp/feeds/{0}.ipc".format(feed_name), "a").close()
-		return True
-	elif feed_exists is True:
-		if owner_count == 1:
-			# The feed exists and is likely bound to the individual owner
-			return False
-		elif owner_count == 0:
-			# The feed exists but it's owner is gone. Remake the feed.
-			os.remove("/tmp/feeds/{0}.ipc".format(feed_name))
-			open("/tmp/feeds/{0}.ipc".format(feed_name), "a").close()
-			return True
+	def __init__(self, **fields):
+		for name in self.__slots__:
+			object.__setattr__(self, name, fields.pop(name, None))
+		if len(fields) > 0:
+			raise TypeError(f"{type(self).__name__} has no fields {', '.join(fields)}.")
 
-	# If we made it this far then we're in an unexpected state
-	feed_exists_str = "DOES" if feed_exists else "DOES NOT"
-	raise UnexpectedStateError("""
-		Unexpected state when verifying ipc feed {0} with owner {1}. 
-		Feed {2} exist but the owner count is {3}.""".format(feed_name, bound_process_name, feed_exists_str, owner_count))
+	def __setattr__(self, name, value):
+		raise AttributeError(f"{type(self).__name__} can't be changed, publish a copy made with replace() instead.")
 
+	def __delattr__(self, name):
+		raise AttributeError(f"{type(self).__name__} can't be changed.")
 
-def process_count(name):
-	try:
-		result = check_output(["pgrep","-f",name]).split(b"\n")[:-1]
-		return len(result)
-	except CalledProcessError:
-		return 0
+	def replace(self, **changes):
+		fields = {name: getattr(self, name) for name in self.__slots__}
+		fields.update(changes)
+		return type(self)(**fields)
 
+	def __repr__(self):
+		return "{}({})".format(type(self).__name__, ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__))
 
-def kill_process(name):
-	try:
-		run(["pkill","-9","-f",name])
-	except CalledProcessError:
-		return
 
-
-def open_process_detached(command, args=[], output_filename=None):
-	filename = "nohup.out" if output_filename is None else output_filename
-	output_path = os.path.dirname(os.path.realpath(__file__)) + "/" + filename
-	if os.path.isfile(output_path):
-		run(["rm", output_path])
-	
-	if output_filename is None:
-		return Popen(['nohup', command] + args, preexec_fn=os.setpgrp)
-	else:
-		return Popen(['nohup', f'{command}',f'&> {output_filename} &'] + args, preexec_fn=os.setpgrp)
+# Ensure an ipc feed is activated, remaking a feed left behind by an earlier process. Returns True once it's created.
+def activate_feed(feed_name):
+	# If the directory doesn't exist then we're starting fresh. Fleet feeds are nested one directory deeper.
+	os.makedirs(os.path.dirname("/tmp/feeds/{0}.ipc".format(feed_name)), exist_ok=True)
+	if os.path.exists("/tmp/feeds/{0}.ipc".format(feed_name)):
+		os.remove("/tmp/feeds/{0}.ipc".format(feed_name))
+	open("/tmp/feeds/{0}.ipc".format(feed_name), "a").close()
+	return True
 
 
 def arg_string_to_dict(arg_string):
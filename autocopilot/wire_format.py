@@ -0,0 +1,178 @@
+import struct
+from enum import Enum
+from json import JSONDecoder
+
+import numpy as np
+
+from telemetry_buffer import TELEMETRY_DTYPE
+
+# Binary messages from the DJI interface are a fixed header followed by a packed, little-endian struct for the topic.
+# The layouts must match dji-interface/wire_format.hpp. JSON messages always start with '{', which can never be
+# mistaken for the magic byte, so both formats can be told apart frame by frame.
+WIRE_MAGIC = 0xDB
+SCHEMA_VERSION = 2
+# Version 1 messages, from recordings made before telemetry carried flight controller times, still decode
+SUPPORTED_SCHEMA_VERSIONS = (1, 2)
+# Replies are in the format each client negotiated with check_interface. The telemetry feed publishes binary messages
+# under "<topic>.bin", so a subscriber chooses its format by what it subscribes to.
+BINARY_TOPIC_SUFFIX = ".bin"
+
+
+class WireFormat(str, Enum):
+	JSON = "json"
+	BINARY = "binary"
+
+
+class WireTopic(int, Enum):
+	InterfaceStatus = 1
+	FlightStatus = 2
+	ControlDevice = 3
+	Telemetry = 4
+	TelemetryBatch = 5
+
+
+class WireFormatError(Exception):
+	pass
+
+
+HEADER = struct.Struct("<BBB")
+# state, fail_state, active_mode, length of the fail output string that follows
+INTERFACE_STATUS = struct.Struct("<BBBH")
+# state
+FLIGHT_STATUS = struct.Struct("<B")
+# auto_mode, return_to_home
+CONTROL_DEVICE = struct.Struct("<BB")
+# longitude, latitude, altitude, satellites, vel_x, vel_y, vel_z, has_accel, accel_x, accel_y, accel_z
+TELEMETRY_V1 = struct.Struct("<ddfHfffBfff")
+# Followed by has_time, fc_time, received, velocity_fc_time, see TELEMETRY_DTYPE for their meaning
+TELEMETRY = struct.Struct("<ddfHfffBfffBddd")
+# reserved, sample count, samples dropped since the last batch. The header pads the columns to an 8 byte boundary.
+TELEMETRY_BATCH = struct.Struct("<BIQ")
+# A telemetry batch is one column per field after its header, each holding every sample, in this order.
+# Timestamps are seconds of the interface host's monotonic clock when the sample was taken. Unknown times are NaN.
+TELEMETRY_BATCH_COLUMNS = (
+	("timestamp", np.dtype("<f8")), ("fc_time", np.dtype("<f8")), ("received", np.dtype("<f8")),
+	("velocity_fc_time", np.dtype("<f8")), ("longitude", np.dtype("<f8")), ("latitude", np.dtype("<f8")),
+	("altitude", np.dtype("<f4")), ("vel_x", np.dtype("<f4")), ("vel_y", np.dtype("<f4")), ("vel_z", np.dtype("<f4")),
+	("accel_x", np.dtype("<f4")), ("accel_y", np.dtype("<f4")), ("accel_z", np.dtype("<f4")), ("satellites", np.dtype("<u2")))
+TIME_COLUMNS = ("fc_time", "received", "velocity_fc_time")
+
+INTERFACE_STATES = ("OFFLINE", "ATTEMPTING", "ONLINE")
+INTERFACE_FAIL_STATES = ("NO_FAILURE", "ATTEMPT_FAILURE", "THREAD_TIMEOUT")
+
+
+def is_binary(buffer):
+	return len(buffer) > 0 and buffer[0] == WIRE_MAGIC
+
+
+# The name a topic is published under on the telemetry feed
+def feed_topic(topic, wire_format):
+	return topic + BINARY_TOPIC_SUFFIX if wire_format is WireFormat.BINARY else topic
+
+
+# Gathers the columns of a telemetry batch into rows of TELEMETRY_DTYPE, one column at a time
+def telemetry_samples(columns, count):
+	samples = np.empty(count, dtype=TELEMETRY_DTYPE)
+	samples["timestamp"] = columns["timestamp"]
+	samples["lat"] = columns["latitude"]
+	samples["lon"] = columns["longitude"]
+	samples["alt"] = columns["altitude"]
+	for axis, name in enumerate(("x", "y", "z")):
+		samples["vel"][:, axis] = columns["vel_" + name]
+		samples["accel"][:, axis] = columns["accel_" + name]
+	samples["satellites"] = columns["satellites"]
+	for name in TIME_COLUMNS:
+		# JSON sends unknown times as null
+		samples[name] = np.asarray(columns[name], dtype=np.float64) if name in columns else np.nan
+	return samples
+
+
+class MessageDecoder:
+	def __init__(self):
+		self._json_decoder = JSONDecoder()
+
+	# Decodes a JSON or binary message into the same dictionary layout.
+	# Buffer can be bytes or a memoryview, such as zmq.Frame.buffer, in which case the binary path doesn't copy it.
+	# A TelemetryBatch decodes to {"topic", "dropped", "samples"}, with the samples in an array of TELEMETRY_DTYPE.
+	def decode(self, buffer):
+		if not is_binary(buffer):
+			message = self._json_decoder.decode(str(buffer, "utf-8"))
+			if message.get("topic") == "TelemetryBatch":
+				return {"topic": "TelemetryBatch", "dropped": message["dropped"],
+						"samples": telemetry_samples(message, len(message["timestamp"]))}
+			return message
+
+		_, version, topic_id = HEADER.unpack_from(buffer, 0)
+		if version not in SUPPORTED_SCHEMA_VERSIONS:
+			raise WireFormatError(f"Unsupported wire format schema version {version}, expected {SCHEMA_VERSION}.")
+
+		offset = HEADER.size
+		if topic_id == WireTopic.Telemetry:
+			if version == 1:
+				fields = TELEMETRY_V1.unpack_from(buffer, offset) + (False, 0, 0, 0)
+			else:
+				fields = TELEMETRY.unpack_from(buffer, offset)
+			lon, lat, alt, sats, vel_x, vel_y, vel_z, has_accel, accel_x, accel_y, accel_z, has_time, fc_time, received, \
+				velocity_fc_time = fields
+			message = {"topic": "Telemetry", "longitude": lon, "latitude": lat, "altitude": alt, "satellites": sats,
+					"vel_x": vel_x, "vel_y": vel_y, "vel_z": vel_z}
+			if has_accel:
+				message["accel_x"] = accel_x
+				message["accel_y"] = accel_y
+				message["accel_z"] = accel_z
+			if has_time:
+				message["fc_time"] = fc_time
+				message["received"] = received
+				message["velocity_fc_time"] = velocity_fc_time
+			return message
+		elif topic_id == WireTopic.TelemetryBatch:
+			_, count, dropped = TELEMETRY_BATCH.unpack_from(buffer, offset)
+			offset += TELEMETRY_BATCH.size
+			columns = dict()
+			for name, dtype in TELEMETRY_BATCH_COLUMNS:
+				if version == 1 and name in TIME_COLUMNS:
+					continue
+				columns[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+				offset += count * dtype.itemsize
+			return {"topic": "TelemetryBatch", "dropped": dropped, "samples": telemetry_samples(columns, count)}
+		elif topic_id == WireTopic.ControlDevice:
+			auto_mode, return_to_home = CONTROL_DEVICE.unpack_from(buffer, offset)
+			return {"topic": "ControlDevice", "auto_mode": bool(auto_mode), "return_to_home": bool(return_to_home)}
+		elif topic_id == WireTopic.FlightStatus:
+			return {"topic": "FlightStatus", "state": FLIGHT_STATUS.unpack_from(buffer, offset)[0]}
+		elif topic_id == WireTopic.InterfaceStatus:
+			state, fail_state, active_mode, output_length = INTERFACE_STATUS.unpack_from(buffer, offset)
+			output_start = offset + INTERFACE_STATUS.size
+			return {"topic": "InterfaceStatus", "state": INTERFACE_STATES[state], "fail_state": INTERFACE_FAIL_STATES[fail_state],
+					"fail_output": str(buffer[output_start:output_start + output_length], "utf-8"), "active_mode": bool(active_mode)}
+
+		raise WireFormatError(f"Unknown wire format topic id {topic_id}.")
+
+
+# Messages are laid out the same as their JSON, so a TelemetryBatch is encoded from a list per column
+def encode(message):
+	topic = message["topic"]
+	header = HEADER.pack(WIRE_MAGIC, SCHEMA_VERSION, WireTopic[topic])
+
+	if topic == "TelemetryBatch":
+		count = len(message["timestamp"])
+		body = TELEMETRY_BATCH.pack(0, count, message["dropped"]) + b"".join(
+			np.asarray(message.get(name, [np.nan] * count), dtype=dtype).tobytes() for name, dtype in TELEMETRY_BATCH_COLUMNS)
+	elif topic == "Telemetry":
+		has_accel = "accel_x" in message
+		body = TELEMETRY.pack(
+			message["longitude"], message["latitude"], message["altitude"], message["satellites"],
+			message["vel_x"], message["vel_y"], message["vel_z"], has_accel,
+			message.get("accel_x", 0), message.get("accel_y", 0), message.get("accel_z", 0), "fc_time" in message,
+			message.get("fc_time", 0), message.get("received", 0), message.get("velocity_fc_time", 0))
+	elif topic == "ControlDevice":
+		body = CONTROL_DEVICE.pack(message["auto_mode"], message["return_to_home"])
+	elif topic == "FlightStatus":
+		body = FLIGHT_STATUS.pack(message["state"])
+	else:
+		fail_output = message["fail_output"].encode("utf-8")
+		body = INTERFACE_STATUS.pack(
+			INTERFACE_STATES.index(message["state"]), INTERFACE_FAIL_STATES.index(message["fail_state"]),
+			message["active_mode"], len(fail_output)) + fail_output
+
+	return header + body
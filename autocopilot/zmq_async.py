@@ -0,0 +1,158 @@
+import asyncio
+import time
+from itertools import count
+
+import zmq
+import zmq.asyncio
+
+from zmq_threads import PendingRequest, RequestAbortedError, RequestMetrics, RequestAdmission, RequestLanes, RequestLane
+
+
+# Coroutine counterpart of IPCRequestThread. It speaks the same [request id, request] protocol over a DEALER socket,
+# but its sending and receiving run as tasks on the caller's event loop instead of on two threads.
+# send_request returns an asyncio.Future and must be called from the event loop's thread.
+class AsyncIPCRequestClient:
+	def __init__(self, zmq_context, message_callback, feed_name, request_timeout=None, max_pending=64, coalesced_requests=(),
+				max_in_flight=None):
+		self.request_timeout = request_timeout
+		self.max_in_flight = max_in_flight
+		self.initialized = False
+		self.last_reply_time = 0
+
+		self._zmq_context = zmq_context
+		self._message_callback = message_callback
+		self._feed_name = feed_name
+		self._socket = None
+		self._request_ids = count(1)
+		self._send_queue = RequestLanes()
+		self._send_event = asyncio.Event()
+		# In flight requests by id, in the order they were sent
+		self._in_flight = dict()
+		self._task = None
+		self._metrics = RequestMetrics(feed_name, self._send_queue, lambda: len(self._in_flight))
+		self.admission = RequestAdmission(feed_name, max_pending, coalesced_requests)
+
+	def start(self):
+		self._task = asyncio.get_running_loop().create_task(self.run())
+
+	def is_alive(self):
+		return self._task is not None and not self._task.done()
+
+	def stop(self):
+		if self._task is not None:
+			self._task.cancel()
+
+	async def run(self):
+		self._client_init()
+		self.initialized = True
+		try:
+			await asyncio.gather(self._send_loop(), self._receive_loop())
+		finally:
+			self._client_complete()
+
+	def _client_init(self):
+		self._socket = self._zmq_context.socket(zmq.DEALER)
+		self._socket.connect("ipc:///tmp/feeds/{}.ipc".format(self._feed_name))
+
+	def _client_complete(self):
+		for pending in self._send_queue.clear():
+			pending.future.cancel()
+
+		for pending in self._in_flight.values():
+			if not pending.future.done():
+				pending.future.set_exception(RequestAbortedError(f"The request client stopped before '{pending.request}' was answered."))
+		self._in_flight.clear()
+
+		self._socket.close(linger=0)
+
+	async def _send_loop(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			await self._send_event.wait()
+			self._send_event.clear()
+
+			for pending in self._send_queue.take_expired(time.time()):
+				if not pending.future.done():
+					pending.future.set_exception(pending.expired_error())
+					self._metrics.record_expired(pending)
+
+			while True:
+				window_full = self.max_in_flight is not None and len(self._in_flight) >= self.max_in_flight
+				pending = self._send_queue.pop(safety_only=window_full)
+				if pending is None:
+					break
+				if pending.future.done():
+					continue
+
+				pending.send_time = time.time()
+				self._in_flight[pending.request_id] = pending
+				if pending.timeout is not None:
+					loop.call_later(pending.timeout, self._expire_request, pending)
+				await self._socket.send_multipart([pending.request_id, pending.request.encode("utf-8")])
+
+	async def _receive_loop(self):
+		while True:
+			frames = await self._socket.recv_multipart(copy=False)
+			pending = self._in_flight.pop(frames[0].bytes, None)
+			# Replies to requests that already timed out are dropped
+			if pending is None:
+				continue
+
+			try:
+				pending.future.set_result(self._process_reply(frames[1:]))
+			except Exception as e:
+				pending.future.set_exception(e)
+			now = time.time()
+			self.last_reply_time = now - pending.send_time
+			self._metrics.record_reply(pending, now)
+			# A reply frees a slot in the in flight window
+			if self.max_in_flight is not None:
+				self._send_event.set()
+
+	def _expire_request(self, pending):
+		if self._in_flight.pop(pending.request_id, None) is None:
+			return
+		pending.future.set_exception(asyncio.TimeoutError(f"No reply to '{pending.request}' after {pending.timeout} seconds."))
+		self._metrics.record_timeout(pending.request)
+		self._request_expired(pending)
+		if self.max_in_flight is not None:
+			self._send_event.set()
+
+	def _request_expired(self, pending):
+		pass
+
+	def _process_reply(self, replies):
+		messages = [str(reply.bytes, "utf-8") for reply in replies]
+		for message in messages:
+			self._message_callback(message)
+		return messages
+
+	def send_request(self, request, timeout=None, lane=RequestLane.CONTROL, send_deadline=None):
+		request_id = str(next(self._request_ids)).encode("utf-8")
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		pending = PendingRequest(
+			request_id, request, self.request_timeout if timeout is None else timeout, future, lane=lane, send_deadline=send_deadline)
+		outstanding = self.admission.admit(pending)
+		if outstanding is not None:
+			return outstanding
+		self._send_queue.put(pending)
+		self._send_event.set()
+		if send_deadline is not None:
+			# Wakes the send loop to drop the request if it's still waiting by then
+			loop.call_later(send_deadline, self._send_event.set)
+		return future
+
+	@property
+	def waiting_on_reply(self):
+		return len(self._in_flight) > 0
+
+	# The oldest request still waiting on a reply
+	@property
+	def oldest_request(self):
+		return next(iter(self._in_flight.values()), None)
+
+	def get_reply_time(self):
+		pending = self.oldest_request
+		return 0 if pending is None else time.time() - pending.send_time
+
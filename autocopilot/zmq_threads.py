@@ -1,16 +1,80 @@
+import os
 import zmq
 import threading
 import time
-from queue import Queue
+from enum import Enum
+from collections import deque
+from itertools import count
+from queue import Queue, Empty
+from concurrent.futures import Future, TimeoutError
 
 from utility import activate_feed, UnexpectedStateError
+from metrics import Metrics
+
+
+class RequestAbortedError(Exception):
+	pass
+
+
+# Raised by send_request when a client already has as many requests outstanding as it allows
+class RequestQueueFullError(Exception):
+	pass
+
+
+# A request that waited longer than its send deadline is dropped instead of being sent
+class RequestExpiredError(TimeoutError):
+	pass
+
+
+# Requests waiting to be sent are scheduled by lane, highest first
+class RequestLane(str, Enum):
+	SAFETY = "SAFETY"
+	CONTROL = "CONTROL"
+	TELEMETRY = "TELEMETRY"
+
+
+class WakeupSignal:
+	# A pollable flag that any thread can raise to wake a thread blocked in zmq.Poller.poll().
+	# Backed by an eventfd where available, otherwise by a non-blocking pipe.
+	def __init__(self):
+		if hasattr(os, "eventfd"):
+			self._read_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+			self._write_fd = self._read_fd
+		else:
+			self._read_fd, self._write_fd = os.pipe()
+			os.set_blocking(self._read_fd, False)
+			os.set_blocking(self._write_fd, False)
+
+	def fileno(self):
+		return self._read_fd
+
+	def set(self):
+		try:
+			os.write(self._write_fd, (1).to_bytes(8, "little"))
+		except BlockingIOError:
+			# The counter or pipe is already full, so the poller is guaranteed to wake anyway
+			pass
+
+	def clear(self):
+		try:
+			os.read(self._read_fd, 4096)
+		except BlockingIOError:
+			pass
+
+	def __del__(self):
+		os.close(self._read_fd)
+		if self._write_fd != self._read_fd:
+			os.close(self._write_fd)
 
 
 class IPCThread(threading.Thread):
-	def __init__(self, zmq_context, zmq_type, feed_name, auto_feed_activation=False, rate=10/1000):
+	def __init__(self, zmq_context, zmq_type, feed_name, auto_feed_activation=False, rate=10/1000, event_driven=False):
 		super().__init__()
 		self.rate = rate
 		self.initialized = False
+		# Event driven threads sleep in a zmq.Poller until their socket is ready or they are woken up,
+		# instead of running their action once every rate seconds
+		self.event_driven = event_driven
 
 		self._zmq_context = zmq_context
 		self._zmq_type = zmq_type
@@ -18,6 +82,7 @@ class IPCThread(threading.Thread):
 		self._feed_name = feed_name
 		self._auto_feed_activation = auto_feed_activation
 		self._socket = None
+		self._wakeup = WakeupSignal() if event_driven else None
 
 		self.setDaemon(True)
 
@@ -34,9 +99,26 @@ class IPCThread(threading.Thread):
 	def _thread_action(self):
 		pass
 
+	def _thread_event(self, events):
+		self._thread_action()
+
+	def _poll_items(self):
+		return [(self._socket, self._socket_poll_flags())]
+
+	def _socket_poll_flags(self):
+		return zmq.POLLIN
+
+	# Longest time in milliseconds an event driven thread may sleep for, or None to only wake up on events
+	def _poll_timeout(self):
+		return None
+
 	def _thread_complete(self):
 		pass
 
+	def wakeup(self):
+		if self._wakeup is not None:
+			self._wakeup.set()
+
 	def start(self):
 		if self.is_alive():
 			raise UnexpectedStateError("Tried to start an IPC thread that is already running.")
@@ -47,61 +129,373 @@ class IPCThread(threading.Thread):
 	def run(self):
 		self._thread_init()
 		self.initialized = True
-		while not self._halt_event.is_set():
-			self._thread_action()
-			self._halt_event.wait(self.rate)
+		if self.event_driven:
+			self._run_event_driven()
+		else:
+			while not self._halt_event.is_set():
+				self._thread_action()
+				self._halt_event.wait(self.rate)
 		self._thread_complete()
 
+	def _run_event_driven(self):
+		poller = zmq.Poller()
+		poller.register(self._wakeup, zmq.POLLIN)
+		while not self._halt_event.is_set():
+			# Registering an already registered socket updates its flags, and flags of 0 unregister it
+			for socket, flags in self._poll_items():
+				poller.register(socket, flags)
+			events = dict(poller.poll(self._poll_timeout()))
+			# The poller reports file descriptors by number, not by the object that was registered
+			if self._wakeup.fileno() in events:
+				self._wakeup.clear()
+				del events[self._wakeup.fileno()]
+			if self._halt_event.is_set():
+				break
+			self._thread_event(events)
+
 	def stop(self):
 		self._halt_event.set()
+		self.wakeup()
+
 
+# Latency and timeout metrics of the requests sent on one feed, by request type and by lane, plus gauges of its queue
+# depths. The depth functions are only called when the metrics are collected.
+class RequestMetrics:
+	def __init__(self, feed_name, request_lanes, in_flight_count, reply_queue_depth=None):
+		self._feed_name = feed_name
+		self._latencies = dict()
+		self._lane_latencies = {lane: Metrics.histogram(
+			"ipc_lane_latency_seconds", "Time from queueing a request to processing its reply", feed=feed_name, lane=lane.value)
+			for lane in RequestLane}
+		Metrics.gauge("ipc_request_queue_depth", "Requests waiting to be sent", feed=feed_name).set_function(request_lanes.__len__)
+		for lane in RequestLane:
+			Metrics.gauge("ipc_lane_queue_depth", "Requests waiting to be sent in each lane", feed=feed_name,
+						lane=lane.value).set_function(lambda lane=lane: request_lanes.depth(lane))
+		Metrics.gauge("ipc_requests_in_flight", "Requests sent and waiting on a reply", feed=feed_name).set_function(in_flight_count)
+		if reply_queue_depth is not None:
+			Metrics.gauge("ipc_reply_queue_depth", "Replies waiting to be processed", feed=feed_name).set_function(reply_queue_depth)
+
+	@staticmethod
+	def request_type(request):
+		return request.split(" ")[0]
+
+	# Records the latency of a request whose reply has just been processed
+	def record_reply(self, pending, now):
+		request_type = self.request_type(pending.request)
+		histogram = self._latencies.get(request_type)
+		if histogram is None:
+			histogram = self._latencies[request_type] = Metrics.histogram(
+				"ipc_request_latency_seconds", "Time from sending a request to processing its reply",
+				feed=self._feed_name, request=request_type)
+		histogram.record(now - pending.send_time)
+		self._lane_latencies[pending.lane].record(now - pending.queue_time)
+
+	def record_timeout(self, request):
+		Metrics.counter("ipc_request_timeouts_total", "Requests that were not answered in time", feed=self._feed_name,
+						request=self.request_type(request)).inc()
+
+	def record_expired(self, pending):
+		Metrics.counter("ipc_requests_expired_total", "Requests dropped for missing their send deadline", feed=self._feed_name,
+						lane=pending.lane.value).inc()
+
+
+# timeout is how long to wait for a reply once the request is sent. send_deadline is how long the request may wait
+# to be sent at all before it's worthless and dropped.
+class PendingRequest:
+	__slots__ = ("request_id", "request", "future", "timeout", "send_time", "lane", "queue_time", "send_deadline")
+
+	def __init__(self, request_id, request, timeout, future=None, lane=RequestLane.CONTROL, send_deadline=None):
+		self.request_id = request_id
+		self.request = request
+		self.future = Future() if future is None else future
+		self.timeout = timeout
+		self.send_time = None
+		self.lane = lane
+		self.queue_time = time.time()
+		self.send_deadline = send_deadline
+
+	@property
+	def deadline(self):
+		if self.timeout is None or self.send_time is None:
+			return None
+		return self.send_time + self.timeout
+
+	# When the request expires if it hasn't been sent yet
+	@property
+	def expiry(self):
+		return None if self.send_deadline is None else self.queue_time + self.send_deadline
+
+	def expired_error(self):
+		return RequestExpiredError(f"'{self.request}' wasn't sent within its {self.send_deadline} second deadline.")
+
+
+# Requests waiting to be sent, in one FIFO per lane. pop always takes from the highest lane that has a request, so a
+# backlog of telemetry polls can't hold up a safety command. Safe to use from any thread.
+class RequestLanes:
+	def __init__(self):
+		self._lanes = {lane: deque() for lane in RequestLane}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		with self._lock:
+			return sum(len(queue) for queue in self._lanes.values())
+
+	def depth(self, lane):
+		with self._lock:
+			return len(self._lanes[lane])
+
+	def put(self, pending):
+		with self._lock:
+			self._lanes[pending.lane].append(pending)
+
+	# Returns the next request to send, or None. With safety_only, requests in the lower lanes are held back.
+	def pop(self, safety_only=False):
+		with self._lock:
+			for lane, queue in self._lanes.items():
+				if safety_only and lane is not RequestLane.SAFETY:
+					return None
+				if len(queue) > 0:
+					return queue.popleft()
+		return None
+
+	# Removes and returns the requests that missed their send deadline
+	def take_expired(self, now):
+		expired = []
+		with self._lock:
+			for lane, queue in self._lanes.items():
+				if any(pending.expiry is not None and pending.expiry <= now for pending in queue):
+					expired += [pending for pending in queue if pending.expiry is not None and pending.expiry <= now]
+					self._lanes[lane] = deque(pending for pending in queue if pending.expiry is None or pending.expiry > now)
+		return expired
+
+	def next_expiry(self):
+		with self._lock:
+			expiries = [pending.expiry for queue in self._lanes.values() for pending in queue if pending.expiry is not None]
+		return min(expiries) if len(expiries) > 0 else None
+
+	def clear(self):
+		with self._lock:
+			cleared = [pending for queue in self._lanes.values() for pending in queue]
+			for queue in self._lanes.values():
+				queue.clear()
+		return cleared
+
+
+# Bounds the requests a client has outstanding, from being queued until their future is done, and coalesces repeats.
+# A request whose type is in coalesced and that's identical to one already outstanding isn't sent again, its caller
+# shares the outstanding request's future instead. Since replies only come back for outstanding requests, the bound
+# covers every queue between the caller and the reply being processed.
+class RequestAdmission:
+	def __init__(self, feed_name, limit, coalesced=()):
+		self.limit = limit
+		self.coalesced = coalesced
+		self._outstanding = 0
+		# Outstanding coalesced requests by request
+		self._by_request = dict()
+		self._lock = threading.Lock()
+		self._coalesced_count = Metrics.counter(
+			"ipc_requests_coalesced_total", "Requests answered by an identical request already outstanding", feed=feed_name)
+		self._overflow_count = Metrics.counter(
+			"ipc_request_overflows_total", "Requests refused because too many were outstanding", feed=feed_name)
+		Metrics.gauge("ipc_requests_outstanding", "Requests queued, in flight or waiting on their reply to be processed",
+					feed=feed_name).set_function(lambda: self._outstanding)
+
+	@property
+	def outstanding(self):
+		with self._lock:
+			return self._outstanding
+
+	@property
+	def coalesced_count(self):
+		return self._coalesced_count.value
 
+	@property
+	def overflow_count(self):
+		return self._overflow_count.value
+
+	# Returns the future of an identical outstanding request, or None if pending was admitted and should be queued.
+	# Raises RequestQueueFullError if limit requests are already outstanding.
+	def admit(self, pending):
+		key = pending.request if RequestMetrics.request_type(pending.request) in self.coalesced else None
+		with self._lock:
+			if key is not None and key in self._by_request:
+				self._coalesced_count.inc()
+				return self._by_request[key].future
+			if self._outstanding >= self.limit:
+				self._overflow_count.inc()
+				raise RequestQueueFullError(f"'{pending.request}' was refused, {self._outstanding} requests are already outstanding.")
+			self._outstanding += 1
+			if key is not None:
+				self._by_request[key] = pending
+		pending.future.add_done_callback(lambda future: self._release(pending, key))
+		return None
+
+	def _release(self, pending, key):
+		with self._lock:
+			self._outstanding -= 1
+			if key is not None and self._by_request.get(key) is pending:
+				del self._by_request[key]
+
+
+# Requests are tagged with an id and sent over a DEALER socket, so any number of them can be in flight at once.
+# A request is sent as the frames [request id, request] and its reply comes back as [request id, *reply frames],
+# in whatever order the other end finishes them. send_request returns a Future that resolves with the result of
+# _process_reply, or fails with a TimeoutError if no reply arrives within the request's timeout.
+# At most max_pending requests can be outstanding at once, see RequestAdmission.
+# Requests wait to be sent in RequestLanes. With max_in_flight set, requests outside the safety lane are held back
+# while that many are in flight, so the interface isn't handed a backlog that a safety command would queue behind.
 class IPCRequestThread(IPCThread):
-	def __init__(self, zmq_context, message_callback, feed_name, auto_feed_activation=False, rate=10/1000):
-		super().__init__(zmq_context, zmq.REQ, feed_name, auto_feed_activation, rate)
+	def __init__(self, zmq_context, message_callback, feed_name, auto_feed_activation=False, rate=10/1000, event_driven=False,
+				request_timeout=None, max_pending=64, coalesced_requests=(), max_in_flight=None):
+		super().__init__(zmq_context, zmq.DEALER, feed_name, auto_feed_activation, rate, event_driven)
 
+		self.request_timeout = request_timeout
+		self.max_in_flight = max_in_flight
 		self._request_state_lock = threading.Lock()
-		self._request_in_progress = False
 		self._message_callback = message_callback
-		self._request_queue = Queue()
+		# Both queues are bounded by the admission limit
+		self._request_queue = RequestLanes()
 		self._reply_queue = Queue()
-		self._request_time = None
+		self._request_ids = count(1)
+		# In flight requests by id, in the order they were sent
+		self._in_flight = dict()
 		self.last_reply_time = 0
 		self._update_thread = None
+		self._metrics = RequestMetrics(
+			feed_name, self._request_queue, lambda: len(self._in_flight), self._reply_queue.qsize)
+		self.admission = RequestAdmission(feed_name, max_pending, coalesced_requests)
 
 	def _thread_init(self):
 		super()._thread_init()
 
 	def _thread_action(self):
-		while not self._request_queue.empty():
+		self._send_queued_requests()
+		self._receive_replies()
+		self._expire_requests()
+		super()._thread_action()
+
+	def _thread_event(self, events):
+		if events.get(self._socket, 0) & zmq.POLLIN:
+			self._receive_replies()
+		self._expire_requests()
+		self._send_queued_requests()
+
+	def _poll_timeout(self):
+		with self._request_state_lock:
+			deadlines = [pending.deadline for pending in self._in_flight.values() if pending.deadline is not None]
+		expiry = self._request_queue.next_expiry()
+		if expiry is not None:
+			deadlines.append(expiry)
+		if len(deadlines) == 0:
+			return None
+		return max(0, (min(deadlines) - time.time()) * 1000)
+
+	def _window_full(self):
+		with self._request_state_lock:
+			return self.max_in_flight is not None and len(self._in_flight) >= self.max_in_flight
+
+	def _send_queued_requests(self):
+		for pending in self._request_queue.take_expired(time.time()):
+			if pending.future.set_running_or_notify_cancel():
+				pending.future.set_exception(pending.expired_error())
+				self._metrics.record_expired(pending)
+
+		while True:
+			pending = self._request_queue.pop(safety_only=self._window_full())
+			if pending is None:
+				return
+
+			# The caller may have cancelled the request while it was queued
+			if not pending.future.set_running_or_notify_cancel():
+				continue
+
 			with self._request_state_lock:
-				if self._request_in_progress:
-					continue
-				self._request_in_progress = True
+				pending.send_time = time.time()
+				self._in_flight[pending.request_id] = pending
+			self._socket.send_multipart([pending.request_id, pending.request.encode("utf-8")])
 
-			self._socket.send_string(self._request_queue.get())
-			self._reply_queue.put(self._socket.recv())
-		super()._thread_action()
+	def _receive_replies(self):
+		while True:
+			try:
+				frames = self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+			except zmq.Again:
+				return
+
+			with self._request_state_lock:
+				pending = self._in_flight.pop(frames[0].bytes, None)
+			# Replies to requests that already timed out are dropped
+			if pending is not None:
+				self._reply_queue.put((pending, frames[1:]))
+
+	def _expire_requests(self):
+		now = time.time()
+		with self._request_state_lock:
+			expired = [pending for pending in self._in_flight.values() if pending.deadline is not None and pending.deadline <= now]
+			for pending in expired:
+				del self._in_flight[pending.request_id]
+
+		for pending in expired:
+			pending.future.set_exception(TimeoutError(f"No reply to '{pending.request}' after {pending.timeout} seconds."))
+			self._metrics.record_timeout(pending.request)
+			self._request_expired(pending)
+
+	# Called on the socket thread for every request that timed out
+	def _request_expired(self, pending):
+		pass
 
 	def _thread_complete(self):
-		super()._thread_complete()
+		for pending in self._request_queue.clear():
+			pending.future.cancel()
 
-	def send_request(self, request):
 		with self._request_state_lock:
-			self._request_time = time.time()
-		self._request_queue.put(request)
+			aborted = list(self._in_flight.values())
+			self._in_flight.clear()
+		for pending in aborted:
+			pending.future.set_exception(RequestAbortedError(f"The request thread stopped before '{pending.request}' was answered."))
 
-	def update(self):
-		while True:
-			while not self._reply_queue.empty():
-				with self._request_state_lock:
-					self._request_in_progress = False
+		self._socket.close(linger=0)
+		super()._thread_complete()
 
-				self._message_callback(str(self._reply_queue.get(), "utf-8"))
+	def send_request(self, request, timeout=None, lane=RequestLane.CONTROL, send_deadline=None):
+		request_id = str(next(self._request_ids)).encode("utf-8")
+		pending = PendingRequest(
+			request_id, request, self.request_timeout if timeout is None else timeout, lane=lane, send_deadline=send_deadline)
+		outstanding = self.admission.admit(pending)
+		if outstanding is not None:
+			return outstanding
+		self._request_queue.put(pending)
+		self.wakeup()
+		return pending.future
+
+	def _process_reply(self, replies):
+		messages = [str(reply.bytes, "utf-8") for reply in replies]
+		for message in messages:
+			self._message_callback(message)
+		return messages
+
+	def _update_timeout(self):
+		return None if self.event_driven else self.rate
+
+	def _update_idle(self):
+		pass
 
-				with self._request_state_lock:
-					self.last_reply_time = time.time() - self._request_time
-			time.sleep(self.rate)
+	def update(self):
+		while True:
+			try:
+				pending, replies = self._reply_queue.get(timeout=self._update_timeout())
+			except Empty:
+				self._update_idle()
+				continue
+
+			try:
+				pending.future.set_result(self._process_reply(replies))
+			except Exception as e:
+				pending.future.set_exception(e)
+
+			now = time.time()
+			with self._request_state_lock:
+				self.last_reply_time = now - pending.send_time
+			self._metrics.record_reply(pending, now)
 
 	def start_update_async(self):
 		if self._update_thread is None or not self._update_thread.is_alive():
@@ -116,13 +510,27 @@ class IPCRequestThread(IPCThread):
 	@property
 	def waiting_on_reply(self):
 		with self._request_state_lock:
-			return self._request_in_progress
-	
-	def get_reply_time(self):
+			return len(self._in_flight) > 0
+
+	# The oldest request still waiting on a reply
+	@property
+	def oldest_request(self):
 		with self._request_state_lock:
-			if self._request_in_progress:
-				return time.time() - self._request_time
-			return 0
+			return next(iter(self._in_flight.values()), None)
+
+	def get_reply_time(self):
+		pending = self.oldest_request
+		return 0 if pending is None else time.time() - pending.send_time
+
+
+def bind_or_connect_tcp(socket, address, port):
+	try:
+		socket.bind("tcp://*:{}".format(port))
+	except zmq.error.ZMQError as e:
+		if "Address already in use" in e.strerror:
+			socket.connect("tcp://{}:{}".format(address, port))
+		else:
+			raise e
 
 
 class TCPThread(threading.Thread):
@@ -143,13 +551,7 @@ class TCPThread(threading.Thread):
 
 	def _thread_init(self):
 		self._socket = self._zmq_context.socket(self._zmq_type)
-		try:
-			self._socket.bind("tcp://*:{}".format(self._port))
-		except zmq.error.ZMQError as e:
-			if "Address already in use" in e.strerror:
-				self._socket.connect("tcp://{}:{}".format(self._address, self._port))
-			else:
-				raise e
+		bind_or_connect_tcp(self._socket, self._address, self._port)
 
 	def _thread_action(self):
 		pass
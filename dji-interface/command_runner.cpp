@@ -0,0 +1,61 @@
+#include "command_runner.hpp"
+
+using namespace std;
+
+#define COMMAND_RUNNER_ADDRESS "inproc://command-runner"
+
+CommandRunner::CommandRunner(zmq::context_t* context)
+	: wake_socket(*context, zmq::socket_type::pull)
+{
+	this->context = context;
+	this->in_flight = 0;
+	this->wake_socket.bind(COMMAND_RUNNER_ADDRESS);
+}
+
+void CommandRunner::run(function<Completion()> work)
+{
+	this->in_flight++;
+	zmq::context_t* context = this->context;
+	thread([this, context, work]() {
+		Completion completion = work();
+		{
+			lock_guard<mutex> lock(this->completed_mutex);
+			this->completed.push_back(completion);
+		}
+
+		// Sockets aren't thread safe, so every worker wakes the receive loop with its own
+		zmq::socket_t notify_socket(*context, zmq::socket_type::push);
+		notify_socket.connect(COMMAND_RUNNER_ADDRESS);
+		zmq::message_t notify_msg(0);
+		notify_socket.send(notify_msg, zmq::send_flags::none);
+		notify_socket.close();
+	}).detach();
+}
+
+void CommandRunner::runCompletions()
+{
+	zmq::message_t notify_msg;
+	while (this->wake_socket.recv(notify_msg, zmq::recv_flags::dontwait)) {}
+
+	vector<Completion> ready;
+	{
+		lock_guard<mutex> lock(this->completed_mutex);
+		ready.swap(this->completed);
+	}
+
+	for (size_t i = 0; i < ready.size(); i++)
+	{
+		ready[i]();
+		this->in_flight--;
+	}
+}
+
+zmq::socket_t* CommandRunner::getWakeSocket()
+{
+	return &this->wake_socket;
+}
+
+int CommandRunner::getInFlight()
+{
+	return this->in_flight;
+}
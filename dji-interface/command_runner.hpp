@@ -0,0 +1,31 @@
+#ifndef COMMAND_RUNNER_HPP
+#define COMMAND_RUNNER_HPP
+
+#include <vector>
+#include <mutex>
+#include <thread>
+#include <functional>
+#include <zmq_addon.hpp>
+
+// Runs long commands on their own threads so the receive loop keeps answering other requests.
+// Sockets can only be used by the receive loop, so a command's work returns a completion that the
+// receive loop runs once it is woken up through the runner's inproc socket.
+typedef std::function<void()> Completion;
+
+class CommandRunner
+{
+public:
+	CommandRunner(zmq::context_t* context);
+	void run(std::function<Completion()> work);
+	void runCompletions();
+	zmq::socket_t* getWakeSocket();
+	int getInFlight();
+private:
+	zmq::context_t* context;
+	zmq::socket_t wake_socket;
+	std::mutex completed_mutex;
+	std::vector<Completion> completed;
+	int in_flight;
+};
+
+#endif
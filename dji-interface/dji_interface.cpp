@@ -19,8 +19,50 @@ vector<string> split(const string &s, char delim) {
     return elems;
 }
 
-void sendInterfaceStatus(zmq::socket_t& zmq_socket, string state, string fail_state, string fail_out, bool active_mode)
+// Identities of the clients that asked check_interface for the binary format. Every other client is replied to in JSON,
+// so one client negotiating doesn't change what the others receive.
+set<string> binary_clients;
+
+// Requests arrive on the ROUTER socket as [identity, request id, request] and replies go back as
+// [identity, request id, reply frames...], so a client can have several requests in flight at once.
+// The empty delimiter frame of a REQ client takes the place of the request id.
+struct Envelope
+{
+	string identity;
+	string request_id;
+	// Whether the requester negotiated the binary format
+	bool binary;
+};
+
+void sendEnvelope(zmq::socket_t& zmq_socket, const Envelope& envelope)
+{
+	zmq::message_t identity_msg(envelope.identity.data(), envelope.identity.size());
+	zmq_socket.send(identity_msg, zmq::send_flags::sndmore);
+	zmq::message_t request_id_msg(envelope.request_id.data(), envelope.request_id.size());
+	zmq_socket.send(request_id_msg, zmq::send_flags::sndmore);
+}
+
+void sendReply(zmq::socket_t& zmq_socket, const Envelope& envelope, const string& payload)
+{
+	sendEnvelope(zmq_socket, envelope);
+	zmq::message_t zmq_msg(payload.data(), payload.size());
+	zmq_socket.send(zmq_msg, zmq::send_flags::none);
+}
+
+string makeInterfaceStatus(bool binary, string state, string fail_state, string fail_out, bool active_mode)
 {
+	if (binary)
+	{
+		WireInterfaceStatus wire;
+		wire.header = makeWireHeader(WIRE_TOPIC_INTERFACE_STATUS);
+		wire.state = wireInterfaceState(state);
+		wire.fail_state = wireInterfaceFailState(fail_state);
+		wire.active_mode = active_mode;
+		wire.fail_output_length = (uint16_t)min(fail_out.size(), (size_t)UINT16_MAX);
+
+		return wireBytes(wire) + fail_out.substr(0, wire.fail_output_length);
+	}
+
 	json interface_status;
 	interface_status["topic"] = "InterfaceStatus";
 	interface_status["state"] = state;
@@ -28,18 +70,45 @@ void sendInterfaceStatus(zmq::socket_t& zmq_socket, string state, string fail_st
 	interface_status["fail_output"] = fail_out;
 	interface_status["active_mode"] = active_mode;
 
-	string json_string = interface_status.dump();
-	int json_length = json_string.length();
+	return interface_status.dump();
+}
 
-	zmq::message_t zmq_msg(json_length);
-	memcpy(zmq_msg.data(), json_string.c_str(), json_length);
+void sendInterfaceStatus(zmq::socket_t& zmq_socket, const Envelope& envelope, string state, string fail_state, string fail_out, bool active_mode)
+{
+	sendReply(zmq_socket, envelope, makeInterfaceStatus(envelope.binary, state, fail_state, fail_out, active_mode));
+}
 
-	zmq_socket.send(zmq_msg, zmq::send_flags::none);
+// Replies to commands that don't produce any telemetry topic. These are always JSON.
+void sendCommandResult(zmq::socket_t& zmq_socket, const Envelope& envelope, string command, bool success, string message)
+{
+	json command_result;
+	command_result["topic"] = "CommandResult";
+	command_result["command"] = command;
+	command_result["success"] = success;
+	command_result["message"] = message;
+
+	sendReply(zmq_socket, envelope, command_result.dump());
+	cout << "REPLY: " << message << "\n";
+}
+
+// Published on the telemetry feed whatever state the vehicle is in, so the supervisor can tell the receive loop is alive
+#define HEARTBEAT_INTERVAL_MS 1000
+
+void publishHeartbeat(zmq::socket_t& pub_socket, uint64_t sequence)
+{
+	json heartbeat;
+	heartbeat["topic"] = "Heartbeat";
+	heartbeat["pid"] = getpid();
+	heartbeat["sequence"] = sequence;
+
+	string frame = "Heartbeat " + heartbeat.dump();
+	zmq::message_t zmq_msg(frame.data(), frame.size());
+	pub_socket.send(zmq_msg, zmq::send_flags::dontwait);
 }
 
-Vehicle* startVehicleInterface(zmq::socket_t& zmq_socket, LinuxSetup *linuxEnvironment) 
+Vehicle* startVehicleInterface(LinuxSetup *linuxEnvironment, string& fail_output) 
 {
-	Vehicle* vehicle;
+	Vehicle* vehicle = NULL;
 	string init_errors = "Could not detect the error.";
 	string rt_errors = "";
 
@@ -58,22 +127,14 @@ Vehicle* startVehicleInterface(zmq::socket_t& zmq_socket, LinuxSetup *linuxEnvir
 
 	if (vehicle == NULL)
 	{
-		if (rt_errors.length() == 0) {
-			sendInterfaceStatus(zmq_socket, "OFFLINE", "ATTEMPT_FAILURE", init_errors, false);
-		} else {
-			sendInterfaceStatus(zmq_socket, "OFFLINE", "ATTEMPT_FAILURE", rt_errors, false);
-		}
+		fail_output = rt_errors.length() == 0 ? init_errors : rt_errors;
 		cout << "Could not connect.\n";
-		
 	}
 	else
 	{
 		cout << "Connected.\n";
-		sendInterfaceStatus(zmq_socket, "ONLINE", "NO_FAILURE", "", false);
 	}
 
-	cout << "Sending interface status.\n";
-
 	return vehicle;
 }
 
@@ -83,67 +144,229 @@ int main(int argc, char *argv[])
 	cout << "Starting interface program.\n";
 	zmq::context_t context;
 	// create and bind a server socket
-	zmq::socket_t zmq_socket (context, zmq::socket_type::rep);
+	zmq::socket_t zmq_socket (context, zmq::socket_type::router);
 	cout << "Made socket.\n";
-	zmq_socket.bind("ipc:///tmp/feeds/drone.ipc");
+	// Each interface of a fleet binds its feeds in its own directory
+	const char* feed_directory_env = getenv("AUTOCOPILOT_FEED_DIR");
+	string feed_directory = feed_directory_env != NULL ? feed_directory_env : "/tmp/feeds";
+	zmq_socket.bind("ipc://" + feed_directory + "/drone.ipc");
+	// Telemetry is streamed out on its own feed so it doesn't hold up the request socket. XPUB reports what is
+	// subscribed to, so each topic is only encoded in the formats someone is listening for.
+	zmq::socket_t pub_socket (context, zmq::socket_type::xpub);
+	pub_socket.bind("ipc://" + feed_directory + "/telemetry.ipc");
 	cout << "Binded.\n";
 
 	LinuxSetup linuxEnvironment(argc, argv);
-	Vehicle* vehicle;
-	TelemetryController* tele_control;
+	Vehicle* vehicle = NULL;
+	TelemetryController* tele_control = NULL;
+	bool starting_interface = false;
+	CommandRunner command_runner(&context);
+
+	zmq::pollitem_t poll_items[] = {
+		{ static_cast<void*>(zmq_socket), 0, ZMQ_POLLIN, 0 },
+		{ static_cast<void*>(*command_runner.getWakeSocket()), 0, ZMQ_POLLIN, 0 },
+		{ static_cast<void*>(pub_socket), 0, ZMQ_POLLIN, 0 }
+	};
+	FeedSubscriptions feed_subscriptions;
+	uint64_t next_publish_time = 0;
+	uint64_t next_heartbeat_time = 0;
+	uint64_t heartbeat_sequence = 0;
 
 	while (true) 
 	{
-		zmq::message_t req_message;
-		zmq_socket.recv (req_message);
-		vector<string> req_vec = split(string(static_cast<char*>(req_message.data()), req_message.size()), *const_cast<char*>(" "));
-		string rep_string = "";
+		// Wait for a request, but wake up in time to publish telemetry at the subscription rate and the heartbeat
+		uint64_t next_wake_time = next_heartbeat_time;
+		if (tele_control != NULL && !tele_control->isChangingRates())
+		{
+			next_wake_time = min(next_wake_time, next_publish_time);
+		}
+		uint64_t now = timeSinceEpochMillisec();
+		long poll_timeout = next_wake_time > now ? (long)(next_wake_time - now) : 0;
+		zmq::poll(poll_items, 3, std::chrono::milliseconds(poll_timeout));
+
+		if (poll_items[2].revents & ZMQ_POLLIN)
+		{
+			zmq::message_t subscription;
+			while (pub_socket.recv(subscription, zmq::recv_flags::dontwait))
+			{
+				feed_subscriptions.update(subscription);
+			}
+		}
+
+		if (timeSinceEpochMillisec() >= next_heartbeat_time)
+		{
+			publishHeartbeat(pub_socket, heartbeat_sequence++);
+			next_heartbeat_time = timeSinceEpochMillisec() + HEARTBEAT_INTERVAL_MS;
+		}
+
+		if (poll_items[1].revents & ZMQ_POLLIN)
+		{
+			command_runner.runCompletions();
+		}
+
+		if (tele_control != NULL && !tele_control->isChangingRates() && timeSinceEpochMillisec() >= next_publish_time)
+		{
+			tele_control->publishData(feed_subscriptions);
+			next_publish_time = timeSinceEpochMillisec() + tele_control->getPublishInterval();
+		}
+
+		if (!(poll_items[0].revents & ZMQ_POLLIN))
+		{
+			continue;
+		}
+
+		vector<zmq::message_t> req_frames;
+		if (!zmq::recv_multipart(zmq_socket, std::back_inserter(req_frames)))
+		{
+			continue;
+		}
+		if (req_frames.size() != 3)
+		{
+			cout << "Dropping a request with " << req_frames.size() << " frames.\n";
+			continue;
+		}
+
+		Envelope envelope;
+		envelope.identity = req_frames[0].to_string();
+		envelope.request_id = req_frames[1].to_string();
+		envelope.binary = binary_clients.count(envelope.identity) > 0;
+		vector<string> req_vec = split(req_frames[2].to_string(), ' ');
+		if (req_vec.size() == 0)
+		{
+			req_vec.push_back("");
+		}
 
 		cout << "REQUEST: " << req_vec[0] << "\n";
 
 		if (req_vec[0] == "check_interface")
 		{
-			if (vehicle == NULL) {
-				sendInterfaceStatus(zmq_socket, "OFFLINE", "NO_FAILURE", "", false);
+			envelope.binary = req_vec.size() > 1 && req_vec[1] == "binary";
+			if (envelope.binary) {
+				binary_clients.insert(envelope.identity);
+			} else {
+				binary_clients.erase(envelope.identity);
+			}
+
+			if (starting_interface) {
+				sendInterfaceStatus(zmq_socket, envelope, "ATTEMPTING", "NO_FAILURE", "", false);
+			} else if (vehicle == NULL) {
+				sendInterfaceStatus(zmq_socket, envelope, "OFFLINE", "NO_FAILURE", "", false);
 			} else {
-				sendInterfaceStatus(zmq_socket, "ONLINE", "NO_FAILURE", "", false);
+				sendInterfaceStatus(zmq_socket, envelope, "ONLINE", "NO_FAILURE", "", false);
 			}
 		}
 		else if (req_vec[0] == "retrieve_data") 
 		{
-			tele_control->retrieveData();
+			if (tele_control == NULL) {
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Vehicle is not connected.");
+			} else if (tele_control->isChangingRates()) {
+				// Packages 1 and 2 are being resubscribed on the command thread and can't be read until that's done
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Subscription rates are changing.");
+			} else {
+				sendEnvelope(zmq_socket, envelope);
+				tele_control->retrieveData(envelope.binary);
+			}
 		} 
+		else if (req_vec[0] == "retrieve_batch")
+		{
+			if (tele_control != NULL) {
+				sendEnvelope(zmq_socket, envelope);
+				tele_control->retrieveBatch(envelope.binary);
+			} else {
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Vehicle is not connected.");
+			}
+		}
 		else if (req_vec[0] == "start_interface")
 		{
-			vehicle = startVehicleInterface(zmq_socket, &linuxEnvironment);
-			if (vehicle != NULL)
-			{
-				tele_control = new TelemetryController(vehicle, &zmq_socket, 8);
+			if (starting_interface) {
+				sendInterfaceStatus(zmq_socket, envelope, "ATTEMPTING", "NO_FAILURE", "", false);
+			} else if (vehicle != NULL) {
+				sendInterfaceStatus(zmq_socket, envelope, "ONLINE", "NO_FAILURE", "", false);
+			} else {
+				// Activating the vehicle and subscribing to telemetry takes seconds, so it runs off the receive loop
+				starting_interface = true;
+				command_runner.run([envelope, &linuxEnvironment, &zmq_socket, &pub_socket, &vehicle, &tele_control, &starting_interface]() -> Completion {
+					string fail_output;
+					Vehicle* new_vehicle = startVehicleInterface(&linuxEnvironment, fail_output);
+					TelemetryController* new_tele_control = NULL;
+					if (new_vehicle != NULL)
+					{
+						new_tele_control = new TelemetryController(new_vehicle, &zmq_socket, &pub_socket, 8);
+						// A vehicle without telemetry isn't usable, so the attempt fails and can be retried
+						if (!new_tele_control->isSubscribed())
+						{
+							delete new_tele_control;
+							new_tele_control = NULL;
+							new_vehicle = NULL;
+							fail_output = "Could not subscribe to the vehicle's telemetry.";
+							cout << "Could not subscribe to telemetry.\n";
+						}
+					}
+
+					return [envelope, new_vehicle, new_tele_control, fail_output, &zmq_socket, &vehicle, &tele_control, &starting_interface]() {
+						starting_interface = false;
+						vehicle = new_vehicle;
+						tele_control = new_tele_control;
+
+						cout << "Sending interface status.\n";
+						if (vehicle == NULL) {
+							sendInterfaceStatus(zmq_socket, envelope, "OFFLINE", "ATTEMPT_FAILURE", fail_output, false);
+						} else {
+							sendInterfaceStatus(zmq_socket, envelope, "ONLINE", "NO_FAILURE", "", false);
+						}
+					};
+				});
+			}
+		}
+		else if (req_vec[0] == "set_rates")
+		{
+			// set_rates <fast package Hz> <velocity package Hz>
+			int fast_hz = req_vec.size() > 2 ? atoi(req_vec[1].c_str()) : 0;
+			int velocity_hz = req_vec.size() > 2 ? atoi(req_vec[2].c_str()) : 0;
+			if (tele_control == NULL) {
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Vehicle is not connected.");
+			} else if (!TelemetryController::isSubscriptionRates(fast_hz, velocity_hz)) {
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Unsupported subscription frequency.");
+			} else if (tele_control->isChangingRates()) {
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "The subscription rates are already changing.");
+			} else {
+				// Resubscribing waits on the vehicle, so it runs off the receive loop like start_interface
+				TelemetryController* rate_control = tele_control;
+				rate_control->beginRateChange();
+				command_runner.run([envelope, rate_control, fast_hz, velocity_hz, &zmq_socket]() -> Completion {
+					bool success = rate_control->applyRates(fast_hz, velocity_hz);
+
+					return [envelope, rate_control, fast_hz, velocity_hz, success, &zmq_socket]() {
+						rate_control->finishRateChange(fast_hz, velocity_hz, success);
+						sendCommandResult(zmq_socket, envelope, "set_rates", success,
+							success ? "Changed the subscription rates." : "Failed to resubscribe to telemetry.");
+					};
+				});
 			}
 		}
 		else if (req_vec[0] == "return_home")
 		{
 			if (vehicle != NULL) {
-				ErrorCode::ErrorCodeType goHomeAck = vehicle->flightController->startGoHomeSync(3);
-				if (goHomeAck != ErrorCode::SysCommonErr::Success) {
-					DERROR("Fail to execute go home action!  Error code: %llx\n",goHomeAck);
-					rep_string = "Fail to execute go home action!";
-				} else {
-					rep_string = "Going home!";
-				}
+				Vehicle* command_vehicle = vehicle;
+				command_runner.run([envelope, command_vehicle, &zmq_socket]() -> Completion {
+					ErrorCode::ErrorCodeType goHomeAck = command_vehicle->flightController->startGoHomeSync(3);
+					bool success = goHomeAck == ErrorCode::SysCommonErr::Success;
+					if (!success) {
+						DERROR("Fail to execute go home action!  Error code: %llx\n",goHomeAck);
+					}
+
+					return [envelope, success, &zmq_socket]() {
+						sendCommandResult(zmq_socket, envelope, "return_home", success, success ? "Going home!" : "Fail to execute go home action!");
+					};
+				});
 			} else {
-				rep_string = "Vehicle is not connected.";
+				sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Vehicle is not connected.");
 			}
 		}
 		else 
 		{
-			rep_string = "Unknown command.";
+			sendCommandResult(zmq_socket, envelope, req_vec[0], false, "Unknown command.");
 		}
-
-		if (rep_string.size() > 0) {
-			zmq_socket.send(zmq::message_t(&rep_string, (int)rep_string.size()), zmq::send_flags::none);
-			cout << "REPLY: " << rep_string << "\n";
-		} 
 	}
 
 	if (tele_control != NULL) {
@@ -2,11 +2,14 @@
 #define DJI_INTERFACE_HPP
 
 #include <string>
+#include <cstdlib>
 #include <iostream>
 #include <cctype>
 #include <sstream>
 #include <vector>
+#include <set>
 #include <iterator>
+#include <unistd.h>
 
 #include <zmq_addon.hpp>
 #include <json.hpp>
@@ -18,5 +21,6 @@
 #include <dji_linux_helpers.hpp>
 
 #include "telemetry.hpp"
+#include "command_runner.hpp"
 
 #endif
\ No newline at end of file
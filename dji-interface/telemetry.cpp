@@ -1,23 +1,55 @@
 #include <dji_telemetry.hpp>
 #include "telemetry.hpp"
 #include <typeinfo>
+#include <cmath>
 
 using namespace DJI::OSDK;
 using namespace DJI::OSDK::Telemetry;
 using namespace std;
 using json = nlohmann::json;
 
+#define TELEMETRY_RING_CAPACITY 256
+#define DEFAULT_VELOCITY_HZ 5
+// The most often each package can be sent, the lowest maxFreq among its topics
+#define FAST_PACKAGE_MAX_HZ 50
+#define VELOCITY_PACKAGE_MAX_HZ 5
+
 uint64_t timeSinceEpochMillisec() {
   using namespace std::chrono;
   return duration_cast<milliseconds>(system_clock::now().time_since_epoch()).count();
 }
 
-TelemetryController::TelemetryController(Vehicle* vehicle, zmq::socket_t* zmq_socket, int hz)
+// steady_clock is CLOCK_MONOTONIC on Linux, the same clock as Python's time.monotonic() on this host
+double monotonicSeconds() {
+  using namespace std::chrono;
+  return duration_cast<duration<double>>(steady_clock::now().time_since_epoch()).count();
+}
+
+TelemetryController::TelemetryController(Vehicle* vehicle, zmq::socket_t* zmq_socket, zmq::socket_t* pub_socket, int hz)
 {
 	this->vehicle = vehicle;
 	this->zmq_socket = zmq_socket;
+	this->pub_socket = pub_socket;
+	this->hz = hz;
+	this->velocity_hz = DEFAULT_VELOCITY_HZ;
+	this->changing_rates = false;
 	this->slow_topic_timer = timeSinceEpochMillisec();
+	this->pub_slow_topic_timer = this->slow_topic_timer;
+	for (PackageTime& package_time : this->package_times)
+	{
+		package_time = { NAN, NAN };
+	}
+	this->fast_time = this->velocity_time = { NAN, NAN };
+	this->auto_mode = false;
+	this->return_to_home = false;
+	this->sample_ring.resize(TELEMETRY_RING_CAPACITY);
+	this->ring_start = 0;
+	this->ring_count = 0;
+	this->dropped_samples = 0;
+	this->latest_velocity = { 0, 0, 0 };
+	this->subscribed = false;
 
+	// Everything above is set first, so a controller that failed to subscribe is still safe to destroy
 	ACK::ErrorCode subscribeStatus;
 	subscribeStatus = this->vehicle->subscribe->verify(1);
 	if (ACK::getError(subscribeStatus) != ACK::SUCCESS)
@@ -26,17 +58,35 @@ TelemetryController::TelemetryController(Vehicle* vehicle, zmq::socket_t* zmq_so
 		return;
 	}
 
+	bool package_subscribed[3];
 	TopicName flightStatusTopic[]  = { TOPIC_STATUS_FLIGHT };
-	this->subscribeToTopics(0, 1, flightStatusTopic, 1, false);
+	package_subscribed[0] = this->subscribeToTopics(0, 1, flightStatusTopic, 1, false);
 
+	// Timestamped, so samples can be placed on the flight controller's clock instead of when they reached AutoCopilot
 	TopicName fast_topics[] = { TOPIC_STATUS_DISPLAYMODE, TOPIC_GPS_FUSED, TOPIC_ACCELERATION_BODY };
-	this->subscribeToTopics(1, hz, fast_topics, 3, false);
+	package_subscribed[1] = this->subscribeToTopics(1, hz, fast_topics, 3, true);
 
 	TopicName vel_topic[] = { TOPIC_GPS_VELOCITY };
-	this->subscribeToTopics(2, 5, vel_topic, 1, false);
+	package_subscribed[2] = this->subscribeToTopics(2, this->velocity_hz, vel_topic, 1, true);
 
-  	this->auto_mode = false;
-  	this->return_to_home = false;
+	this->subscribed = package_subscribed[0] && package_subscribed[1] && package_subscribed[2];
+	if (!this->subscribed)
+	{
+		// The controller is thrown away, so no package may be left calling packageUnpacked with it
+		for (int index = 0; index < 3; index++)
+		{
+			if (package_subscribed[index])
+			{
+				this->vehicle->subscribe->removePackage(index, 1);
+			}
+		}
+	}
+}
+
+// False if the vehicle couldn't be subscribed to, in which case the controller has no telemetry to give
+bool TelemetryController::isSubscribed()
+{
+	return this->subscribed;
 }
 
 bool TelemetryController::subscribeToTopics(int index, int freq, TopicName* topics, int numTopic, bool timestamp)
@@ -54,11 +104,184 @@ bool TelemetryController::subscribeToTopics(int index, int freq, TopicName* topi
 		this->vehicle->subscribe->removePackage(index, 1);
 		return false;
 	}
+	// Subscribing clears the package's callback, so it's registered again every time
+	if (timestamp)
+	{
+		this->vehicle->subscribe->registerUserPackageUnpackCallback(index, TelemetryController::packageUnpacked, this);
+	}
 	return true;
 }
 
-void TelemetryController::sendTelemetry(bool with_accel, bool finish_send)
+// Runs on the OSDK read thread for every message of a timestamped package. The message is the package id followed by
+// the 8 byte timestamp the flight controller sent it at. Its time_ns field wraps every few seconds, so only time_ms is used.
+// The package's topics follow, packed in the order they were subscribed in. Every fast package becomes one sample for
+// retrieve_batch, so the batch holds each message exactly once however often the main loop runs.
+void TelemetryController::packageUnpacked(Vehicle* vehicle, RecvContainer recv_frame, UserData controller)
+{
+	double received = monotonicSeconds();
+	const uint8_t* data = recv_frame.recvData.raw_ack_array;
+	uint8_t package = data[0];
+	TelemetryController* telemetry = static_cast<TelemetryController*>(controller);
+	if (package >= sizeof(telemetry->package_times) / sizeof(PackageTime))
+	{
+		return;
+	}
+
+	Telemetry::TimeStamp timestamp;
+	memcpy(&timestamp, data + 1, sizeof(timestamp));
+	const uint8_t* topics = data + 1 + sizeof(timestamp);
+	PackageTime package_time = { timestamp.time_ms / 1000.0, received };
+
+	lock_guard<mutex> lock(telemetry->package_time_lock);
+	telemetry->package_times[package] = package_time;
+	if (package == 1)
+	{
+		telemetry->pushSample(topics, package_time);
+	}
+	else if (package == 2)
+	{
+		memcpy(&telemetry->latest_velocity, topics, sizeof(telemetry->latest_velocity));
+	}
+}
+
+// Buffers a fast package for retrieve_batch, with the latest velocity package. Called with package_time_lock held.
+// The fast package's topics are the display mode, the fused position and the body acceleration.
+void TelemetryController::pushSample(const uint8_t* topics, const PackageTime& package_time)
+{
+	TypeMap<TOPIC_GPS_FUSED>::type position;
+	TypeMap<TOPIC_ACCELERATION_BODY>::type accel;
+	topics += sizeof(TypeMap<TOPIC_STATUS_DISPLAYMODE>::type);
+	memcpy(&position, topics, sizeof(position));
+	memcpy(&accel, topics + sizeof(position), sizeof(accel));
+
+	TelemetrySample sample;
+	sample.timestamp = package_time.received;
+	sample.fc_time = package_time.fc_time;
+	sample.received = package_time.received;
+	sample.velocity_fc_time = this->package_times[2].fc_time;
+	sample.longitude = position.longitude;
+	sample.latitude = position.latitude;
+	sample.altitude = position.altitude;
+	sample.vel[0] = this->latest_velocity.x * 0.01;
+	sample.vel[1] = this->latest_velocity.y * 0.01;
+	sample.vel[2] = this->latest_velocity.z * 0.01;
+	sample.accel[0] = accel.x;
+	sample.accel[1] = accel.y;
+	sample.accel[2] = accel.z;
+	sample.satellites = position.visibleSatelliteNumber;
+
+	size_t capacity = this->sample_ring.size();
+	if (this->ring_count == capacity)
+	{
+		// Overwrite the oldest sample
+		this->ring_start = (this->ring_start + 1) % capacity;
+		this->ring_count--;
+		this->dropped_samples++;
+	}
+	this->sample_ring[(this->ring_start + this->ring_count) % capacity] = sample;
+	this->ring_count++;
+}
+
+// The package frequencies OSDK accepts
+static bool isSubscriptionFrequency(int hz, int max_hz)
+{
+	return (hz == 1 || hz == 5 || hz == 10 || hz == 50 || hz == 100 || hz == 200 || hz == 400) && hz <= max_hz;
+}
+
+// Whether OSDK accepts the fast and velocity packages at these rates. Neither may go above the maxFreq of any of its topics.
+bool TelemetryController::isSubscriptionRates(int fast_hz, int velocity_hz)
+{
+	return isSubscriptionFrequency(fast_hz, FAST_PACKAGE_MAX_HZ) && isSubscriptionFrequency(velocity_hz, VELOCITY_PACKAGE_MAX_HZ);
+}
+
+bool TelemetryController::isChangingRates()
+{
+	return this->changing_rates;
+}
+
+// Called on the receive loop before applyRates runs off it, so the loop stops reading the packages in the meantime
+void TelemetryController::beginRateChange()
+{
+	this->changing_rates = true;
+}
+
+// Resubscribes the fast and velocity packages at new frequencies. Waits on acknowledgements from the vehicle, so it runs
+// on a command runner thread. Package 0 is left alone.
+bool TelemetryController::applyRates(int fast_hz, int velocity_hz)
+{
+	// Checked before anything is removed, so rates the vehicle would refuse leave the running packages alone
+	if (!isSubscriptionRates(fast_hz, velocity_hz))
+	{
+		return false;
+	}
+
+	this->vehicle->subscribe->removePackage(1, 1);
+	this->vehicle->subscribe->removePackage(2, 1);
+	if (this->subscribeRatePackages(fast_hz, velocity_hz))
+	{
+		return true;
+	}
+
+	// The rates in use before are only changed by finishRateChange, so they can be gone back to
+	this->subscribeRatePackages(this->hz, this->velocity_hz);
+	return false;
+}
+
+// Subscribes the fast and velocity packages. If either fails, the other is removed again, so both can be retried.
+bool TelemetryController::subscribeRatePackages(int fast_hz, int velocity_hz)
+{
+	TopicName fast_topics[] = { TOPIC_STATUS_DISPLAYMODE, TOPIC_GPS_FUSED, TOPIC_ACCELERATION_BODY };
+	bool fast_subscribed = this->subscribeToTopics(1, fast_hz, fast_topics, 3, true);
+
+	TopicName vel_topic[] = { TOPIC_GPS_VELOCITY };
+	bool velocity_subscribed = this->subscribeToTopics(2, velocity_hz, vel_topic, 1, true);
+
+	if (fast_subscribed && !velocity_subscribed)
+	{
+		this->vehicle->subscribe->removePackage(1, 1);
+	}
+	if (velocity_subscribed && !fast_subscribed)
+	{
+		this->vehicle->subscribe->removePackage(2, 1);
+	}
+	return fast_subscribed && velocity_subscribed;
+}
+
+// Called on the receive loop once applyRates is done. The publish interval follows the fast package.
+void TelemetryController::finishRateChange(int fast_hz, int velocity_hz, bool success)
 {
+	if (success)
+	{
+		this->hz = fast_hz;
+		this->velocity_hz = velocity_hz;
+	}
+	this->changing_rates = false;
+}
+
+string TelemetryController::makeTelemetry(bool binary, bool with_accel)
+{
+	if (binary)
+	{
+		WireTelemetry wire;
+		wire.header = makeWireHeader(WIRE_TOPIC_TELEMETRY);
+		wire.longitude = position_data.longitude;
+		wire.latitude = position_data.latitude;
+		wire.altitude = position_data.altitude;
+		wire.satellites = position_data.visibleSatelliteNumber;
+		wire.vel_x = velocity_data.x * 0.01;
+		wire.vel_y = velocity_data.y * 0.01;
+		wire.vel_z = velocity_data.z * 0.01;
+		wire.has_accel = with_accel;
+		wire.accel_x = with_accel ? accel_data.x : 0;
+		wire.accel_y = with_accel ? accel_data.y : 0;
+		wire.accel_z = with_accel ? accel_data.z : 0;
+		wire.has_time = !std::isnan(fast_time.fc_time);
+		wire.fc_time = fast_time.fc_time;
+		wire.received = fast_time.received;
+		wire.velocity_fc_time = velocity_time.fc_time;
+		return wireBytes(wire);
+	}
+
 	json msg;
 	msg["topic"] = "Telemetry";
 	msg["longitude"] = position_data.longitude;
@@ -75,39 +298,106 @@ void TelemetryController::sendTelemetry(bool with_accel, bool finish_send)
 		msg["accel_z"] = accel_data.z;
 	}
 
-	string json_string = msg.dump();
-	int json_length = json_string.length();
+	// JSON has no NaN, so times are left out until the flight controller sent one
+	if (!std::isnan(fast_time.fc_time))
+	{
+		msg["fc_time"] = fast_time.fc_time;
+		msg["received"] = fast_time.received;
+		msg["velocity_fc_time"] = velocity_time.fc_time;
+	}
 
-	zmq::message_t zmq_msg(json_length);
-	memcpy(zmq_msg.data(), json_string.c_str(), json_length);
+	return msg.dump();
+}
 
-	if (finish_send) {
-		this->zmq_socket->send(zmq_msg, zmq::send_flags::none);
-	} else {
-		this->zmq_socket->send(zmq_msg, zmq::send_flags::sndmore);
+template <typename T>
+static void appendColumn(string& frame, const vector<TelemetrySample>& samples, T (*field)(const TelemetrySample&))
+{
+	for (const TelemetrySample& sample : samples)
+	{
+		T value = field(sample);
+		frame.append(reinterpret_cast<const char*>(&value), sizeof(T));
 	}
 }
 
-void TelemetryController::sendFlightStatus(bool finish_send)
+// Columns of the samples, oldest first
+string TelemetryController::makeTelemetryBatch(bool binary, const vector<TelemetrySample>& samples, uint64_t dropped)
 {
-	json msg;
-	msg["topic"] = "FlightStatus";
-	msg["state"] = (int)flight_status_data;
+	size_t count = samples.size();
+
+	if (binary)
+	{
+		WireTelemetryBatch wire;
+		wire.header = makeWireHeader(WIRE_TOPIC_TELEMETRY_BATCH);
+		wire.reserved = 0;
+		wire.count = count;
+		wire.dropped = dropped;
+		string frame = wireBytes(wire);
+		frame.reserve(sizeof(WireTelemetryBatch) + count * (6 * sizeof(double) + 7 * sizeof(float) + sizeof(uint16_t)));
+		appendColumn<double>(frame, samples, [](const TelemetrySample& s) { return s.timestamp; });
+		appendColumn<double>(frame, samples, [](const TelemetrySample& s) { return s.fc_time; });
+		appendColumn<double>(frame, samples, [](const TelemetrySample& s) { return s.received; });
+		appendColumn<double>(frame, samples, [](const TelemetrySample& s) { return s.velocity_fc_time; });
+		appendColumn<double>(frame, samples, [](const TelemetrySample& s) { return s.longitude; });
+		appendColumn<double>(frame, samples, [](const TelemetrySample& s) { return s.latitude; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.altitude; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.vel[0]; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.vel[1]; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.vel[2]; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.accel[0]; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.accel[1]; });
+		appendColumn<float>(frame, samples, [](const TelemetrySample& s) { return s.accel[2]; });
+		appendColumn<uint16_t>(frame, samples, [](const TelemetrySample& s) { return s.satellites; });
+		return frame;
+	}
 
-	string json_string = msg.dump();
-	int json_length = json_string.length();
+	json msg;
+	msg["topic"] = "TelemetryBatch";
+	msg["dropped"] = dropped;
+	const char* names[] = { "timestamp", "fc_time", "received", "velocity_fc_time", "longitude", "latitude", "altitude", "vel_x", "vel_y", "vel_z", "accel_x", "accel_y", "accel_z", "satellites" };
+	for (const char* name : names)
+	{
+		msg[name] = json::array();
+	}
+	for (const TelemetrySample& sample : samples)
+	{
+		msg["timestamp"].push_back(sample.timestamp);
+		// Unknown times are sent as null, since JSON has no NaN
+		msg["fc_time"].push_back(std::isnan(sample.fc_time) ? json() : json(sample.fc_time));
+		msg["received"].push_back(std::isnan(sample.received) ? json() : json(sample.received));
+		msg["velocity_fc_time"].push_back(std::isnan(sample.velocity_fc_time) ? json() : json(sample.velocity_fc_time));
+		msg["longitude"].push_back(sample.longitude);
+		msg["latitude"].push_back(sample.latitude);
+		msg["altitude"].push_back(sample.altitude);
+		msg["vel_x"].push_back(sample.vel[0]);
+		msg["vel_y"].push_back(sample.vel[1]);
+		msg["vel_z"].push_back(sample.vel[2]);
+		msg["accel_x"].push_back(sample.accel[0]);
+		msg["accel_y"].push_back(sample.accel[1]);
+		msg["accel_z"].push_back(sample.accel[2]);
+		msg["satellites"].push_back(sample.satellites);
+	}
 
-	zmq::message_t zmq_msg(json_length);
-	memcpy(zmq_msg.data(), json_string.c_str(), json_length);
+	return msg.dump();
+}
 
-	if (finish_send) {
-		this->zmq_socket->send(zmq_msg, zmq::send_flags::none);
-	} else {
-		this->zmq_socket->send(zmq_msg, zmq::send_flags::sndmore);
+string TelemetryController::makeFlightStatus(bool binary)
+{
+	if (binary)
+	{
+		WireFlightStatus wire;
+		wire.header = makeWireHeader(WIRE_TOPIC_FLIGHT_STATUS);
+		wire.state = (uint8_t)flight_status_data;
+		return wireBytes(wire);
 	}
+
+	json msg;
+	msg["topic"] = "FlightStatus";
+	msg["state"] = (int)flight_status_data;
+
+	return msg.dump();
 }
 
-void TelemetryController::sendControlDevice(bool finish_send)
+string TelemetryController::makeControlDevice(bool binary)
 {
 	int displaymode = (int)displaymode_data;
 
@@ -125,16 +415,26 @@ void TelemetryController::sendControlDevice(bool finish_send)
 		this->return_to_home = displaymode == 12 || displaymode == 15 || displaymode == 33;
 	}
 
+	if (binary)
+	{
+		WireControlDevice wire;
+		wire.header = makeWireHeader(WIRE_TOPIC_CONTROL_DEVICE);
+		wire.auto_mode = this->auto_mode;
+		wire.return_to_home = this->return_to_home;
+		return wireBytes(wire);
+	}
+
 	json msg;
 	msg["topic"] = "ControlDevice";
 	msg["auto_mode"] = this->auto_mode;
 	msg["return_to_home"] = this->return_to_home;
 	
-	string json_string = msg.dump();
-	int json_length = json_string.length();
+	return msg.dump();
+}
 
-	zmq::message_t zmq_msg(json_length);
-	memcpy(zmq_msg.data(), json_string.c_str(), json_length);
+void TelemetryController::sendMessage(const string& payload, bool finish_send)
+{
+	zmq::message_t zmq_msg(payload.data(), payload.size());
 
 	if (finish_send) {
 		this->zmq_socket->send(zmq_msg, zmq::send_flags::none);
@@ -143,33 +443,158 @@ void TelemetryController::sendControlDevice(bool finish_send)
 	}
 }
 
+// Published messages are single frames of "<topic> <payload>" so subscribers can filter on the topic prefix.
+// They can't be multipart because ZMQ_CONFLATE on the subscriber side only supports single frame messages.
+void TelemetryController::publishMessage(const string& topic, const string& payload)
+{
+	zmq::message_t zmq_msg(topic.size() + 1 + payload.size());
+	char* data = static_cast<char*>(zmq_msg.data());
+	memcpy(data, topic.data(), topic.size());
+	data[topic.size()] = ' ';
+	memcpy(data + topic.size() + 1, payload.data(), payload.size());
+
+	// Never block the interface on a slow subscriber, PUB drops the message at the high water mark instead
+	this->pub_socket->send(zmq_msg, zmq::send_flags::dontwait);
+}
+
+// Each format is only encoded and published while something is subscribed to it
+void TelemetryController::publishTopic(const FeedSubscriptions& feed, const string& topic, const function<string(bool)>& make)
+{
+	if (feed.wants(topic))
+	{
+		this->publishMessage(topic, make(false));
+	}
+	string binary_topic = topic + WIRE_BINARY_TOPIC_SUFFIX;
+	if (feed.wants(binary_topic))
+	{
+		this->publishMessage(binary_topic, make(true));
+	}
+}
+
+void FeedSubscriptions::update(const zmq::message_t& message)
+{
+	// Subscription messages are a 1 to subscribe or a 0 to unsubscribe, followed by the prefix
+	if (message.size() == 0)
+	{
+		return;
+	}
+	const char* data = static_cast<const char*>(message.data());
+	string prefix(data + 1, message.size() - 1);
+	if (data[0] == 1)
+	{
+		this->prefixes.insert(prefix);
+	}
+	else if (data[0] == 0)
+	{
+		this->prefixes.erase(prefix);
+	}
+}
+
+// Whether any subscriber would receive a "<topic> " frame
+bool FeedSubscriptions::wants(const string& topic) const
+{
+	string frame_start = topic + " ";
+	for (const string& prefix : this->prefixes)
+	{
+		// A prefix longer than the topic could still match the payload that follows it
+		size_t length = min(prefix.size(), frame_start.size());
+		if (prefix.compare(0, length, frame_start, 0, length) == 0)
+		{
+			return true;
+		}
+	}
+	return false;
+}
+
 /*
 Packages:
 --- PACKAGE 0 - FLIGHT STATUS ---
 Flight Status 			@ 1Hz
 --- PACKAGE 1 - full rate ---
-Display Mode Active 	@ ACTIVE Hz
+Display Mode Active 	@ ACTIVE Hz, 8 until set_rates changes it
 Position 				@ ACTIVE Hz
 Acceleration 			@ ACTIVE Hz
---- PACKAGE 2 - 5Hz ---
-Velocity 				@ 5 Hz
+--- PACKAGE 2 - velocity rate ---
+Velocity 				@ 5 Hz until set_rates changes it
+Packages 1 and 2 are timestamped by the flight controller, see packageUnpacked
 */
 
-bool TelemetryController::retrieveData()
+void TelemetryController::readFastTopics()
+{
+	this->position_data = 		this->vehicle->subscribe->getValue<TOPIC_GPS_FUSED>();
+	this->displaymode_data = 	this->vehicle->subscribe->getValue<TOPIC_STATUS_DISPLAYMODE>();
+	this->accel_data = 			this->vehicle->subscribe->getValue<TOPIC_ACCELERATION_BODY>();
+	this->velocity_data = 		this->vehicle->subscribe->getValue<TOPIC_GPS_VELOCITY>();
+
+	lock_guard<mutex> lock(this->package_time_lock);
+	this->fast_time = this->package_times[1];
+	this->velocity_time = this->package_times[2];
+}
+
+// Replies in the format the requester negotiated
+bool TelemetryController::retrieveData(bool binary)
 {
 	if (timeSinceEpochMillisec() >= this->slow_topic_timer)
 	{
 		this->flight_status_data = 	this->vehicle->subscribe->getValue<TOPIC_STATUS_FLIGHT>();
-		this->sendFlightStatus(false);
+		this->sendMessage(this->makeFlightStatus(binary), false);
 		this->slow_topic_timer = timeSinceEpochMillisec() + 1000;
 	}
 
-	this->position_data = 		this->vehicle->subscribe->getValue<TOPIC_GPS_FUSED>();
-	this->displaymode_data = 	this->vehicle->subscribe->getValue<TOPIC_STATUS_DISPLAYMODE>();
-	this->accel_data = 			this->vehicle->subscribe->getValue<TOPIC_ACCELERATION_BODY>();
-	this->velocity_data = 		this->vehicle->subscribe->getValue<TOPIC_GPS_VELOCITY>();
+	this->readFastTopics();
 
-	this->sendControlDevice(false);
-	this->sendTelemetry(true, true);
+	this->sendMessage(this->makeControlDevice(binary), false);
+	this->sendMessage(this->makeTelemetry(binary, true), true);
 	return true;
-}
\ No newline at end of file
+}
+
+// Drains every sample buffered since the last batch in one reply frame
+bool TelemetryController::retrieveBatch(bool binary)
+{
+	vector<TelemetrySample> samples;
+	uint64_t dropped;
+	{
+		// packageUnpacked keeps adding samples on the OSDK read thread, so they're taken out before being encoded
+		lock_guard<mutex> lock(this->package_time_lock);
+		samples.reserve(this->ring_count);
+		for (size_t i = 0; i < this->ring_count; i++)
+		{
+			samples.push_back(this->sample_ring[(this->ring_start + i) % this->sample_ring.size()]);
+		}
+		dropped = this->dropped_samples;
+		this->ring_start = 0;
+		this->ring_count = 0;
+		this->dropped_samples = 0;
+	}
+
+	this->sendMessage(this->makeTelemetryBatch(binary, samples, dropped), true);
+	return true;
+}
+
+// Publishes the latest fast topics, in whichever formats are subscribed to
+bool TelemetryController::publishData(const FeedSubscriptions& feed)
+{
+	if (this->pub_socket == NULL)
+	{
+		return false;
+	}
+
+	this->readFastTopics();
+
+	if (timeSinceEpochMillisec() >= this->pub_slow_topic_timer)
+	{
+		this->flight_status_data = 	this->vehicle->subscribe->getValue<TOPIC_STATUS_FLIGHT>();
+		this->publishTopic(feed, "FlightStatus", [this](bool binary) { return this->makeFlightStatus(binary); });
+		this->pub_slow_topic_timer = timeSinceEpochMillisec() + 1000;
+	}
+
+	this->publishTopic(feed, "ControlDevice", [this](bool binary) { return this->makeControlDevice(binary); });
+	this->publishTopic(feed, "Telemetry", [this](bool binary) { return this->makeTelemetry(binary, true); });
+	return true;
+}
+
+// Publish at the rate of the fast package
+uint64_t TelemetryController::getPublishInterval()
+{
+	return 1000 / this->hz;
+}
@@ -2,9 +2,13 @@
 #define TELEMETRY_HPP
 
 #include <string>
+#include <vector>
+#include <set>
+#include <functional>
 #include <iostream>
 #include <cctype>
 #include <chrono>
+#include <mutex>
 #include <zmq_addon.hpp>
 #include <json.hpp>
 
@@ -12,25 +16,109 @@
 #include <dji_vehicle.hpp>
 #include <dji_linux_helpers.hpp>
 
+#include "wire_format.hpp"
+
+uint64_t timeSinceEpochMillisec();
+double monotonicSeconds();
+
+// One fast package sample, buffered for retrieve_batch
+struct TelemetrySample
+{
+	double timestamp;
+	double fc_time;
+	double received;
+	double velocity_fc_time;
+	double longitude;
+	double latitude;
+	float altitude;
+	float vel[3];
+	float accel[3];
+	uint16_t satellites;
+};
+
+// When the flight controller sent the last message of a package, in seconds of its own clock, and when it arrived, in
+// seconds of monotonicSeconds(). Both are NaN until the first timestamped message.
+struct PackageTime
+{
+	double fc_time;
+	double received;
+};
+
+// Topic prefixes subscribed to on the telemetry feed. The XPUB socket reports a prefix when its first subscriber
+// arrives and again when its last one leaves.
+class FeedSubscriptions
+{
+public:
+	void update(const zmq::message_t& message);
+	bool wants(const std::string& topic) const;
+private:
+	std::set<std::string> prefixes;
+};
+
 class TelemetryController
 {
 public:
-	TelemetryController(DJI::OSDK::Vehicle* vehicle, zmq::socket_t* zmq_socket, int hz);
-	bool retrieveData();
+	TelemetryController(DJI::OSDK::Vehicle* vehicle, zmq::socket_t* zmq_socket, zmq::socket_t* pub_socket, int hz);
+	bool retrieveData(bool binary);
+	bool retrieveBatch(bool binary);
+	bool publishData(const FeedSubscriptions& feed);
+	uint64_t getPublishInterval();
+	bool isSubscribed();
+	static bool isSubscriptionRates(int fast_hz, int velocity_hz);
+	bool isChangingRates();
+	void beginRateChange();
+	bool applyRates(int fast_hz, int velocity_hz);
+	void finishRateChange(int fast_hz, int velocity_hz, bool success);
+	static void packageUnpacked(DJI::OSDK::Vehicle* vehicle, DJI::OSDK::RecvContainer recv_frame, DJI::OSDK::UserData controller);
 private:
 	Vehicle* vehicle;
 	zmq::socket_t* zmq_socket;
+	zmq::socket_t* pub_socket;
+	int hz;
+	int velocity_hz;
+	// Set while packages 1 and 2 are being resubscribed, when their values can't be read
+	bool changing_rates;
+	// Whether every package was subscribed to when the controller was made
+	bool subscribed;
 	uint64_t slow_topic_timer;
+	uint64_t pub_slow_topic_timer;
 	bool auto_mode;
 	bool return_to_home;
+	// Guards everything packageUnpacked writes on the OSDK read thread
+	std::mutex package_time_lock;
+	// Ring of the fast packages received since the last batch. The oldest are overwritten and counted once it's full.
+	std::vector<TelemetrySample> sample_ring;
+	size_t ring_start;
+	size_t ring_count;
+	uint64_t dropped_samples;
+	// Indexed by package
+	PackageTime package_times[3];
+	// The velocity package last received, for the samples of the fast packages that follow it
+	DJI::OSDK::Telemetry::TypeMap<DJI::OSDK::Telemetry::TOPIC_GPS_VELOCITY>::type latest_velocity;
+	// The times of packages 1 and 2 as of the last readFastTopics
+	PackageTime fast_time;
+	PackageTime velocity_time;
 	
 	bool subscribeToTopics(int index, int freq, DJI::OSDK::Telemetry::TopicName* topics, int numTopic, bool timestamp);
+	bool subscribeRatePackages(int fast_hz, int velocity_hz);
+
+	void readFastTopics();
+
+	void pushSample(const uint8_t* topics, const PackageTime& package_time);
+
+	std::string makeTelemetry(bool binary, bool with_accel);
+
+	std::string makeTelemetryBatch(bool binary, const std::vector<TelemetrySample>& samples, uint64_t dropped);
+
+	std::string makeFlightStatus(bool binary);
+
+	std::string makeControlDevice(bool binary);
 
-	void sendTelemetry(bool with_accel, bool finish_send);
+	void sendMessage(const std::string& payload, bool finish_send);
 
-	void sendFlightStatus(bool finish_send);
+	void publishMessage(const std::string& topic, const std::string& payload);
 
-	void sendControlDevice(bool finish_send);
+	void publishTopic(const FeedSubscriptions& feed, const std::string& topic, const std::function<std::string(bool)>& make);
 
 	DJI::OSDK::Telemetry::TypeMap<DJI::OSDK::Telemetry::TOPIC_STATUS_FLIGHT>::type 		flight_status_data;
 	DJI::OSDK::Telemetry::TypeMap<DJI::OSDK::Telemetry::TOPIC_GPS_FUSED>::type 			position_data;
@@ -0,0 +1,120 @@
+#ifndef WIRE_FORMAT_HPP
+#define WIRE_FORMAT_HPP
+
+#include <string>
+#include <cstring>
+#include <cstdint>
+
+// Fixed layout binary encoding of the interface messages. Replies are negotiated per client with
+// "check_interface binary", and the telemetry feed publishes binary messages under "<topic>.bin".
+// Every message starts with a WireHeader and is little-endian and packed.
+// The layouts must match autocopilot/wire_format.py.
+
+#define WIRE_MAGIC 0xDB
+#define WIRE_SCHEMA_VERSION 2
+#define WIRE_BINARY_TOPIC_SUFFIX ".bin"
+
+enum WireTopic : uint8_t
+{
+	WIRE_TOPIC_INTERFACE_STATUS = 1,
+	WIRE_TOPIC_FLIGHT_STATUS = 2,
+	WIRE_TOPIC_CONTROL_DEVICE = 3,
+	WIRE_TOPIC_TELEMETRY = 4,
+	WIRE_TOPIC_TELEMETRY_BATCH = 5
+};
+
+#pragma pack(push, 1)
+struct WireHeader
+{
+	uint8_t magic;
+	uint8_t version;
+	uint8_t topic;
+};
+
+// Followed by fail_output_length bytes of UTF-8
+struct WireInterfaceStatus
+{
+	WireHeader header;
+	uint8_t state;
+	uint8_t fail_state;
+	uint8_t active_mode;
+	uint16_t fail_output_length;
+};
+
+struct WireFlightStatus
+{
+	WireHeader header;
+	uint8_t state;
+};
+
+struct WireControlDevice
+{
+	WireHeader header;
+	uint8_t auto_mode;
+	uint8_t return_to_home;
+};
+
+struct WireTelemetry
+{
+	WireHeader header;
+	double longitude;
+	double latitude;
+	float altitude;
+	uint16_t satellites;
+	float vel_x;
+	float vel_y;
+	float vel_z;
+	uint8_t has_accel;
+	float accel_x;
+	float accel_y;
+	float accel_z;
+	// fc_time and velocity_fc_time are the flight controller's clock when it sent the fast and velocity packages, and
+	// received the interface host's monotonic clock when the fast package arrived, all in seconds
+	uint8_t has_time;
+	double fc_time;
+	double received;
+	double velocity_fc_time;
+};
+// Followed by one column per field holding all count samples: timestamp, fc_time, received, velocity_fc_time,
+// longitude and latitude as doubles, with NaN for unknown times,
+// altitude, vel_x, vel_y, vel_z, accel_x, accel_y and accel_z as floats, then satellites as uint16_t.
+// The header is 16 bytes so the columns start 8 byte aligned.
+struct WireTelemetryBatch
+{
+	WireHeader header;
+	uint8_t reserved;
+	uint32_t count;
+	uint64_t dropped;
+};
+#pragma pack(pop)
+
+inline WireHeader makeWireHeader(WireTopic topic)
+{
+	WireHeader header;
+	header.magic = WIRE_MAGIC;
+	header.version = WIRE_SCHEMA_VERSION;
+	header.topic = topic;
+	return header;
+}
+
+template <typename T>
+inline std::string wireBytes(const T& wire_struct)
+{
+	return std::string(reinterpret_cast<const char*>(&wire_struct), sizeof(T));
+}
+
+inline uint8_t wireInterfaceState(const std::string& state)
+{
+	if (state == "ATTEMPTING") return 1;
+	if (state == "ONLINE") return 2;
+	return 0;
+}
+
+inline uint8_t wireInterfaceFailState(const std::string& fail_state)
+{
+	if (fail_state == "ATTEMPT_FAILURE") return 1;
+	if (fail_state == "THREAD_TIMEOUT") return 2;
+	return 0;
+}
+
+#endif
@@ -0,0 +1,136 @@
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+from json import dumps, loads
+from unittest import TestCase, main
+
+import zmq
+import zmq.asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+import configure as config
+from zmq_async import AsyncIPCRequestClient
+from zmq_threads import RequestAbortedError
+from drone import InterfaceState
+
+
+class TestAsyncIPCRequestClient(TestCase):
+    def setUp(self):
+        self.context = zmq.asyncio.Context()
+        self.feed_name = "test-async-{}".format(os.getpid())
+
+    def tearDown(self):
+        self.context.term()
+
+    def run_with_router(self, scenario, **kwargs):
+        async def run():
+            # Stands in for the interface, replying in whatever order the scenario chooses
+            router = self.context.socket(zmq.ROUTER)
+            router.bind("ipc:///tmp/feeds/{}.ipc".format(self.feed_name))
+            client = AsyncIPCRequestClient(self.context, lambda message: None, self.feed_name, **kwargs)
+            client.start()
+            try:
+                await asyncio.wait_for(scenario(router, client), 5)
+            finally:
+                client.stop()
+                await asyncio.sleep(0)
+                router.close(linger=0)
+        asyncio.run(run())
+
+    def test_replies_resolve_their_own_requests(self):
+        async def scenario(router, client):
+            futures = [client.send_request("request {}".format(i)) for i in range(2)]
+            received = [await router.recv_multipart() for _ in futures]
+            for identity, request_id, request in reversed(received):
+                await router.send_multipart([identity, request_id, b"reply to " + request])
+            self.assertEqual(await asyncio.gather(*futures), [["reply to request 0"], ["reply to request 1"]])
+        self.run_with_router(scenario)
+
+    def test_unanswered_requests_time_out(self):
+        async def scenario(router, client):
+            future = client.send_request("check_interface", timeout=0.1)
+            await router.recv_multipart()
+            with self.assertRaises(asyncio.TimeoutError):
+                await future
+        self.run_with_router(scenario)
+
+    def test_in_flight_requests_are_aborted_on_stop(self):
+        async def scenario(router, client):
+            future = client.send_request("start_interface")
+            await router.recv_multipart()
+            client.stop()
+            with self.assertRaises(RequestAbortedError):
+                await future
+        self.run_with_router(scenario)
+
+
+class TestAsyncAutoCopilot(TestCase):
+    PORT = 15537
+
+    @classmethod
+    def setUpClass(cls):
+        # ConfigManager keeps Config.ini next to the first entry of sys.path, and autocopilot makes one when imported
+        cls.directory = tempfile.mkdtemp()
+        defaults = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot", "ConfigDefaults.ini")
+        shutil.copyfile(defaults, os.path.join(cls.directory, "ConfigDefaults.ini"))
+        sys.path.insert(0, cls.directory)
+        import autocopilot
+        cls.autocopilot = autocopilot
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.autocopilot.config_manager.stop()
+        sys.path.remove(cls.directory)
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.previous_config = {option: getattr(config, option) for option in (
+            "INTERFACE_COMMAND", "RECORDER_ENABLED", "SHARED_TELEMETRY", "FLEET_VEHICLES")}
+        # The simulator stands in for the interface on the default feeds
+        config.INTERFACE_COMMAND = "{} autocopilot/simulator.py --start-delay 0.05".format(sys.executable)
+        config.RECORDER_ENABLED = False
+        config.SHARED_TELEMETRY = False
+        config.FLEET_VEHICLES = ""
+
+    def tearDown(self):
+        for option, value in self.previous_config.items():
+            setattr(config, option, value)
+
+    async def wait_for(self, condition):
+        while not condition():
+            await asyncio.sleep(0.02)
+
+    def test_commands_and_telemetry_round_trip(self):
+        acp = self.autocopilot.AsyncAutoCopilot()
+        acp.COMMAND_PORT = self.PORT
+
+        async def run():
+            task = asyncio.get_running_loop().create_task(acp.run())
+            client = acp.zmq_context.socket(zmq.REQ)
+            client.connect("tcp://127.0.0.1:{}".format(self.PORT))
+            try:
+                await client.send_string(dumps({"request": "ping", "args": None}))
+                self.assertEqual(loads(await asyncio.wait_for(client.recv_string(), 5)), {"success": True})
+
+                await asyncio.wait_for(self.wait_for(lambda: acp.drone._interface.initialized), 5)
+                acp.drone.start_interface()
+                await asyncio.wait_for(self.wait_for(lambda: acp.drone.interface_status == InterfaceState.ONLINE), 10)
+                await asyncio.wait_for(self.wait_for(lambda: len(acp.drone.telemetry) > 0), 5)
+            finally:
+                client.close(linger=0)
+                task.cancel()
+                if acp.drone is not None:
+                    acp.drone._interface.stop()
+                    if acp.drone._telemetry_subscriber is not None:
+                        acp.drone._telemetry_subscriber.stop()
+                    acp.drone.supervisor.stop()
+                await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(run())
+        acp.zmq_context.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import sys
+import asyncio
+import threading
+import time
+from json import dumps, loads
+from unittest import TestCase, main
+
+import zmq
+import zmq.asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from command_server import CommandRegistry, CommandReceiver, AsyncCommandReceiver
+
+PORT = 15536
+
+
+class TestCommandServer(TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.release = threading.Event()
+        self.registry = CommandRegistry(default_timeout=5)
+        self.registry.register("ping", lambda arguments: (True, None), inline=True)
+        self.registry.register("echo", lambda arguments: (True, arguments))
+        self.registry.register("slow", lambda arguments: (self.release.wait(5), None))
+        self.registry.register("stuck", lambda arguments: (self.release.wait(5), None), timeout=0.1)
+        self.registry.register("fail", lambda arguments: (False, {"error": "failed"}))
+        # Only passes once two commands wait on it at the same time
+        self.barrier = threading.Barrier(2)
+        self.registry.register("together", lambda arguments: (self.barrier.wait(0.5) is not None, arguments))
+        self.server = CommandReceiver(self.context, self.registry, PORT, workers=2, max_pending=2)
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        self.release.set()
+        self.server.stop()
+        self.server.join(2)
+        for client in self.clients:
+            client.close(linger=0)
+        self.context.term()
+
+    def client(self):
+        socket = self.context.socket(zmq.REQ)
+        socket.RCVTIMEO = 2000
+        socket.connect("tcp://127.0.0.1:{}".format(PORT))
+        self.clients.append(socket)
+        return socket
+
+    def command(self, socket, request, args=None):
+        socket.send_string(dumps({"request": request, "args": args}))
+        return loads(socket.recv_string())
+
+    def test_echo_and_unknown(self):
+        client = self.client()
+        self.assertEqual(self.command(client, "echo", {"a": 1}), {"success": True, "args": {"a": 1}})
+        self.assertFalse(self.command(client, "missing")["success"])
+        client.send_string("not json")
+        self.assertFalse(loads(client.recv_string())["success"])
+
+    def test_slow_commands_do_not_block_other_clients(self):
+        slow_clients = [self.client(), self.client()]
+        for client in slow_clients:
+            client.send_string(dumps({"request": "slow", "args": None}))
+
+        deadline = time.time() + 2
+        while self.server.pending_count < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        # Both workers are busy and the pending limit is reached
+        self.assertEqual(self.command(self.client(), "ping"), {"success": True})
+        self.assertIn("busy", self.command(self.client(), "echo")["args"]["error"])
+
+        self.release.set()
+        for client in slow_clients:
+            self.assertEqual(loads(client.recv_string()), {"success": True})
+
+    def batch(self, socket, commands, **options):
+        return self.command(socket, "batch", dict(commands=[{"request": request, "args": args} for request, args in commands], **options))
+
+    def test_ordered_batch(self):
+        client = self.client()
+        response = self.batch(client, [("ping", None), ("echo", {"a": 1}), ("missing", None), ("echo", {"b": 2})])
+        self.assertFalse(response["success"])
+        self.assertEqual([result["success"] for result in response["args"]["results"]], [True, True, False, True])
+        self.assertEqual(response["args"]["results"][3]["args"], {"b": 2})
+
+        response = self.batch(client, [("echo", {"a": 1}), ("fail", None), ("echo", {"b": 2})], stop_on_failure=True)
+        self.assertEqual(response["args"]["results"][1]["args"], {"error": "failed"})
+        self.assertIn("Not run", response["args"]["results"][2]["args"]["error"])
+
+        self.assertEqual(self.batch(client, [("ping", None), ("ping", None)]),
+                         {"success": True, "args": {"results": [{"success": True}, {"success": True}]}})
+        self.assertFalse(self.command(client, "batch", {"commands": "ping"})["success"])
+
+    def test_unordered_batch_runs_commands_together(self):
+        client = self.client()
+        response = self.batch(client, [("together", {"a": 1}), ("ping", None), ("together", {"b": 2})], ordered=False)
+        self.assertEqual(response, {"success": True, "args": {"results": [
+            {"success": True, "args": {"a": 1}}, {"success": True}, {"success": True, "args": {"b": 2}}]}})
+
+        # Run one after the other, the commands never meet
+        self.barrier.reset()
+        response = self.batch(client, [("together", None), ("together", None)], stop_on_failure=True)
+        self.assertFalse(response["args"]["results"][0]["success"])
+        self.assertIn("Not run", response["args"]["results"][1]["args"]["error"])
+
+    def test_unordered_batch_stops_after_inline_failure(self):
+        self.server.max_pending = 3
+        # Both workers are busy with other clients, so the batch's slow command is still queued when its inline one fails
+        slow_clients = [self.client(), self.client()]
+        for client in slow_clients:
+            client.send_string(dumps({"request": "slow", "args": None}))
+        deadline = time.time() + 2
+        while self.server.pending_count < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        client = self.client()
+        client.send_string(dumps({"request": "batch", "args": {"ordered": False, "stop_on_failure": True, "commands": [
+            {"request": "slow", "args": None}, {"request": "missing", "args": None}]}}))
+        results = loads(client.recv_string())["args"]["results"]
+        self.assertEqual([result["success"] for result in results], [False, False])
+        self.assertIn("Not run", results[0]["args"]["error"])
+
+    def test_timeout(self):
+        response = self.command(self.client(), "stuck")
+        self.assertFalse(response["success"])
+        self.assertIn("timed out", response["args"]["error"])
+
+
+
+class TestAsyncCommandReceiver(TestCase):
+    def test_inline_and_worker_replies(self):
+        context = zmq.asyncio.Context()
+        registry = CommandRegistry(default_timeout=5)
+        registry.register("ping", lambda arguments: (True, None), inline=True)
+        registry.register("echo", lambda arguments: (True, arguments))
+        server = AsyncCommandReceiver(context, registry, PORT, workers=1)
+
+        async def run():
+            task = asyncio.get_running_loop().create_task(server.run())
+            client = context.socket(zmq.REQ)
+            client.connect("tcp://127.0.0.1:{}".format(PORT))
+            try:
+                replies = []
+                for request, args in (("ping", None), ("echo", {"a": 1}), ("missing", None)):
+                    await client.send_string(dumps({"request": request, "args": args}))
+                    replies.append(loads(await asyncio.wait_for(client.recv_string(), 2)))
+            finally:
+                client.close(linger=0)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            return replies
+
+        replies = asyncio.run(run())
+        context.term()
+        self.assertEqual(replies[:2], [{"success": True}, {"success": True, "args": {"a": 1}}])
+        self.assertFalse(replies[2]["success"])
+
+if __name__ == "__main__":
+    main()
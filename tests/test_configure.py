@@ -0,0 +1,83 @@
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from configparser import ConfigParser
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+import configure as config
+
+
+class TestConfigManager(TestCase):
+    def setUp(self):
+        # ConfigManager keeps Config.ini next to the first entry of sys.path
+        self.directory = tempfile.mkdtemp()
+        defaults = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot", "ConfigDefaults.ini")
+        shutil.copyfile(defaults, os.path.join(self.directory, "ConfigDefaults.ini"))
+        sys.path.insert(0, self.directory)
+        self.manager = config.ConfigManager(watch=False)
+        self.ids = {entry.option: entry.id for entry in self.manager.entries.values()}
+        self.changes = []
+
+    def tearDown(self):
+        with redirect_stdout(io.StringIO()):
+            self.manager.load_all_defaults()
+        self.manager.stop()
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory)
+
+    def record_change(self, option, value):
+        self.changes.append((option, value))
+
+    def read_file(self):
+        parser = ConfigParser()
+        parser.read(self.manager.config_path)
+        return parser
+
+    def test_changes_are_published_and_written_once(self):
+        config.subscribe("UPDATE_HZ", self.record_change)
+        writes = []
+        write_file = self.manager._write_file
+        self.manager._write_file = lambda: (writes.append(1), write_file())
+        try:
+            for hz in (40, 50, 60):
+                self.manager.set_entry(self.ids["UPDATE_HZ"], str(hz))
+            # Setting the same value again isn't a change
+            self.manager.set_entry(self.ids["UPDATE_HZ"], "60")
+        finally:
+            config.unsubscribe("UPDATE_HZ", self.record_change)
+
+        self.assertEqual(self.changes, [("UPDATE_HZ", 40), ("UPDATE_HZ", 50), ("UPDATE_HZ", 60)])
+        self.assertEqual(config.UPDATE_HZ, 60)
+
+        time.sleep(config.ConfigManager.WRITE_DELAY * 3)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.read_file()["Main"]["UPDATE_HZ"], "60")
+        self.assertFalse(os.path.exists(self.manager.config_path + ".tmp"))
+
+    def test_external_edits_are_applied(self):
+        config.subscribe("INTERFACE_TIMEOUT", self.record_change)
+        try:
+            parser = self.read_file()
+            parser.set("Drone", "INTERFACE_TIMEOUT", "7")
+            with open(self.manager.config_path, "w") as f:
+                parser.write(f)
+            # Makes sure the modification time moves, however coarse the file system's clock is
+            stat = os.stat(self.manager.config_path)
+            os.utime(self.manager.config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            with redirect_stdout(io.StringIO()):
+                self.manager.check_for_edits()
+        finally:
+            config.unsubscribe("INTERFACE_TIMEOUT", self.record_change)
+
+        self.assertEqual(self.changes, [("INTERFACE_TIMEOUT", 7)])
+        self.assertEqual(config.INTERFACE_TIMEOUT, 7)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from unittest import TestCase, main
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+import configure as config
+from drone import DJIMessageTopic, InterfaceState, FlightState, RecoveryTier, TelemetrySubscription
+from fleet import FleetManager
+from simulator import SimulatedInterface
+from shared_telemetry import SharedTelemetryReader
+
+
+class TestFleetManager(TestCase):
+    VEHICLES = 3
+
+    def setUp(self):
+        # ConfigManager keeps Config.ini next to the first entry of sys.path
+        self.directory = tempfile.mkdtemp()
+        defaults = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot", "ConfigDefaults.ini")
+        shutil.copyfile(defaults, os.path.join(self.directory, "ConfigDefaults.ini"))
+        sys.path.insert(0, self.directory)
+        self.manager = config.ConfigManager(watch=False)
+        config.RECORDER_ENABLED = False
+
+        self.context = zmq.Context()
+        self.ids = ["test-{}-{}".format(os.getpid(), i) for i in range(self.VEHICLES)]
+        self.simulators = []
+        for vehicle_id in self.ids:
+            simulator = SimulatedInterface(
+                self.context, hz=50, start_delay=0.05, feed_directory=os.path.join(FleetManager.FEED_DIRECTORY, vehicle_id))
+            thread = threading.Thread(target=simulator.run)
+            thread.start()
+            self.simulators.append((simulator, thread))
+
+        self.messages = []
+        self.threads_before = threading.active_count()
+        self.output = io.StringIO()
+        with redirect_stdout(self.output):
+            self.fleet = FleetManager(self.context)
+            self.fleet.add_listener(lambda vehicle_id, topic, message: self.messages.append((vehicle_id, topic)))
+            for vehicle_id in self.ids:
+                self.fleet.add_vehicle(vehicle_id)
+
+    def tearDown(self):
+        with redirect_stdout(self.output):
+            self.fleet.stop()
+        for simulator, thread in self.simulators:
+            simulator.stop()
+            thread.join(2)
+        self.context.term()
+        for vehicle_id in self.ids:
+            shutil.rmtree(self.fleet.feed_directory(vehicle_id), ignore_errors=True)
+        self.manager.stop()
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory)
+
+    def sockets_per_vehicle(self):
+        # A request socket, plus one subscription or one per streamed topic when conflating
+        subscriptions = len(TelemetrySubscription.STREAMED_TOPICS) if config.TELEMETRY_CONFLATE else 1
+        return 1 + (subscriptions if config.TELEMETRY_STREAM else 0)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out waiting for the fleet.")
+            with redirect_stdout(self.output):
+                self.fleet.update()
+            time.sleep(0.02)
+
+    def test_vehicles_share_one_reactor_thread(self):
+        self.assertEqual(threading.active_count(), self.threads_before + 1)
+        self.wait_for(lambda: all(self.fleet.vehicle(vehicle_id)._interface.initialized for vehicle_id in self.ids))
+        self.wait_for(lambda: self.fleet.reactor.socket_count == self.VEHICLES * self.sockets_per_vehicle())
+
+    def test_messages_are_routed_by_vehicle(self):
+        started, others = self.ids[0], self.ids[1:]
+        self.wait_for(lambda: self.fleet.vehicle(started)._interface.initialized)
+        with redirect_stdout(self.output):
+            self.fleet.vehicle(started).start_interface()
+
+        self.wait_for(lambda: self.fleet.vehicle(started).interface_status == InterfaceState.ONLINE)
+        self.wait_for(lambda: (started, DJIMessageTopic.Telemetry) in self.messages)
+        self.wait_for(lambda: all((vehicle_id, DJIMessageTopic.Heartbeat) in self.messages for vehicle_id in others))
+
+        # Only the started vehicle's simulator publishes telemetry
+        self.assertTrue(all(vehicle_id == started for vehicle_id, topic in self.messages if topic == DJIMessageTopic.Telemetry))
+        self.assertGreater(len(self.fleet.vehicle(started).telemetry), 0)
+        for vehicle_id in others:
+            self.assertEqual(len(self.fleet.vehicle(vehicle_id).telemetry), 0)
+            self.assertEqual(self.fleet.vehicle(vehicle_id).interface_status, InterfaceState.OFFLINE)
+        self.assertEqual(self.fleet.interface_status()[started], "ONLINE")
+
+        with redirect_stdout(self.output):
+            self.fleet.remove_vehicle(started)
+        self.wait_for(lambda: self.fleet.reactor.socket_count == (self.VEHICLES - 1) * self.sockets_per_vehicle())
+        self.assertNotIn(started, self.fleet.vehicle_ids)
+
+    def test_state_snapshots(self):
+        drone = self.fleet.vehicle(self.ids[0])
+        self.wait_for(lambda: drone._interface.initialized)
+        with redirect_stdout(self.output):
+            drone.start_interface()
+        self.wait_for(lambda: drone.state.telemetry is not None and drone.state.flight_state is FlightState.IN_AIR)
+
+        state = drone.state
+        self.assertIs(state.interface.status, InterfaceState.ONLINE)
+        self.assertEqual(state.telemetry["satellites"], 12)
+        self.assertFalse(state.auto_mode)
+        self.assertRaises(AttributeError, setattr, state, "auto_mode", True)
+        self.assertRaises(ValueError, state.telemetry.__setitem__, "satellites", 0)
+        # Newer samples are published as new snapshots, the one held on to stays as it was
+        self.wait_for(lambda: drone.state is not state)
+        self.assertIsNot(drone.state.telemetry, state.telemetry)
+
+        # Local processes read the same samples from shared memory
+        reader = SharedTelemetryReader(drone.shared_telemetry_name)
+        self.assertGreaterEqual(reader.count, 2)
+        self.assertEqual(reader.last(reader.count)["timestamp"][0], drone.telemetry.all()["timestamp"][0])
+        reader.close()
+
+        # The simulated flight controller's clock is fitted from the stream
+        self.assertTrue(drone.clock.ready)
+        self.wait_for(lambda: len(drone.aligned_telemetry(10, 20)) > 0)
+
+    def test_rates_follow_the_flight_state(self):
+        vehicle_id = self.ids[0]
+        simulator = self.simulators[0][0]
+        self.wait_for(lambda: self.fleet.vehicle(vehicle_id)._interface.initialized)
+        with redirect_stdout(self.output):
+            self.fleet.vehicle(vehicle_id).start_interface()
+
+        # The simulated vehicle is in the air until it lands
+        self.wait_for(lambda: (simulator.hz, simulator.velocity_hz) == (config.AIR_HZ, config.AIR_VELOCITY_HZ))
+        simulator._synthesizer.flight_state = 1
+        self.wait_for(lambda: (simulator.hz, simulator.velocity_hz) == (config.GROUND_HZ, config.GROUND_VELOCITY_HZ))
+
+    def test_stalled_interface_recovers_in_tiers(self):
+        config.INTERFACE_TIMEOUT = 0.3
+        vehicle_id = self.ids[0]
+        drone = self.fleet.vehicle(vehicle_id)
+        simulator = self.simulators[0][0]
+        self.wait_for(lambda: drone._interface.initialized)
+
+        # A lost reply only needs a new socket
+        simulator._replies_to_drop = 1
+        with redirect_stdout(self.output):
+            drone.check_interface()
+        self.wait_for(lambda: drone.last_recovery is not None)
+        self.assertIs(drone.last_recovery[0], RecoveryTier.RECONNECT)
+
+        # A process that stopped answering is restarted once a new socket doesn't help
+        simulator._ignoring_requests = True
+        with redirect_stdout(self.output):
+            drone.check_interface()
+        self.wait_for(lambda: drone._recovery is not None and drone._recovery[0] is RecoveryTier.RESTART)
+        self.assertIn("needs restarting", self.output.getvalue())
+
+
+if __name__ == "__main__":
+    main()
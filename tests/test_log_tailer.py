@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from log_tailer import LogTailer
+
+
+class TestLogTailer(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "nohup.out")
+        self.tailer = LogTailer(self.path, max_entries=3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, text, mode="a"):
+        with open(self.path, mode) as f:
+            f.write(text)
+
+    def test_reads_only_new_lines(self):
+        self.assertEqual(self.tailer.poll(), [])
+        self.write("REQUEST: check_interface\nERRORLOG first\nREPLY: ok\nERRORLOG sec")
+        self.assertEqual(self.tailer.poll(), ["ERRORLOG first"])
+        # The incomplete line is finished by the next write
+        self.write("ond\n")
+        self.assertEqual(self.tailer.poll(), ["ERRORLOG second"])
+        self.assertEqual(self.tailer.offset, os.path.getsize(self.path))
+
+        for i in range(3):
+            self.write(f"ERRORLOG {i}\n")
+        self.tailer.poll()
+        self.assertEqual(list(self.tailer.entries), ["ERRORLOG 0", "ERRORLOG 1", "ERRORLOG 2"])
+
+    def test_follows_rotation(self):
+        self.write("ERRORLOG before\n")
+        self.tailer.poll()
+
+        # Copy-truncate, with a line written before the copy that hadn't been read yet
+        self.write("ERRORLOG unread\n")
+        with open(self.path) as f, open(self.path + ".1", "w") as backup:
+            backup.write(f.read())
+        os.truncate(self.path, 0)
+        self.write("ERRORLOG after\n")
+        self.assertEqual(self.tailer.poll(), ["ERRORLOG unread", "ERRORLOG after"])
+
+        # A new file under the same path is read from the start
+        os.remove(self.path)
+        self.write("ERRORLOG replaced\n", mode="w")
+        self.assertEqual(self.tailer.poll(), ["ERRORLOG replaced"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from logger import Logger
+
+
+class TestBackgroundLogger(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "autocopilot.log")
+        self.stdout = io.StringIO()
+        self.redirect = redirect_stdout(self.stdout)
+        self.redirect.__enter__()
+
+    def tearDown(self):
+        self.redirect.__exit__(None, None, None)
+        self.directory.cleanup()
+
+    def read_log(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_records_are_written_in_order(self):
+        logger = Logger(self.path)
+        logger.start_background(fsync_interval=10)
+        for i in range(100):
+            logger.add(f"entry {i}", warn=i == 99)
+        logger.flush()
+
+        lines = self.read_log().splitlines()[1:]
+        self.assertEqual([line.split("\t")[1] for line in lines[:99]], [f"entry {i}" for i in range(99)])
+        self.assertTrue(lines[99].endswith("WARNING: entry 99"))
+        self.assertIn("entry 50", self.stdout.getvalue())
+        logger.stop_background()
+
+    def test_overflow_is_counted(self):
+        logger = Logger(self.path)
+        logger.start_background(queue_size=1, fsync_interval=10)
+        for i in range(1000):
+            logger.add(f"entry {i}")
+        logger.stop_background()
+
+        self.assertGreater(logger.dropped_records, 0)
+        self.assertIn("Dropped", self.read_log())
+
+    def test_rotation(self):
+        logger = Logger(self.path)
+        logger.start_background(max_bytes=1000, backup_count=2)
+        for i in range(200):
+            logger.add(f"entry {i:04}")
+            # Files are rotated between batches
+            if i % 20 == 19:
+                logger.flush()
+        logger.stop_background()
+
+        self.assertTrue(os.path.isfile(self.path + ".1"))
+        self.assertTrue(os.path.isfile(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        self.assertIn("entry 0199", self.read_log())
+
+
+if __name__ == "__main__":
+    main()
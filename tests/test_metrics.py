@@ -0,0 +1,70 @@
+import os
+import sys
+import random
+import urllib.request
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from metrics import MetricsRegistry, MetricsServer, Histogram
+
+
+class TestHistogram(TestCase):
+    def test_quantiles_are_within_bucket_precision(self):
+        histogram = Histogram()
+        samples = sorted(random.Random(1).lognormvariate(-7, 1.5) for _ in range(10000))
+        for sample in samples:
+            histogram.record(sample)
+
+        precision = 1 / 2 ** (Histogram.SUB_BUCKET_BITS - 1)
+        for quantile, value in zip(Histogram.QUANTILES, histogram.quantiles()):
+            exact = samples[int(quantile * len(samples) + 0.5) - 1]
+            # Reported values are bucket upper bounds, in whole microseconds
+            self.assertGreaterEqual(value, exact - 1e-6)
+            self.assertLessEqual(value, exact * (1 + precision) + 1e-6)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 10000)
+        self.assertEqual(snapshot["max"], samples[-1])
+        self.assertAlmostEqual(snapshot["sum"], sum(samples))
+
+    def test_empty(self):
+        self.assertEqual(Histogram().snapshot()["p99"], None)
+
+
+class TestMetricsRegistry(TestCase):
+    def test_metrics_are_shared_by_name_and_labels(self):
+        registry = MetricsRegistry()
+        registry.counter("requests_total", "Requests", request="ping").inc()
+        registry.counter("requests_total", request="ping").inc(2)
+        registry.counter("requests_total", request="stats").inc()
+        self.assertEqual(registry.counter("requests_total", request="ping").value, 3)
+        self.assertRaises(ValueError, registry.gauge, "requests_total")
+
+        queue = [1, 2, 3]
+        registry.gauge("queue_depth").set_function(lambda: len(queue))
+        samples = registry.snapshot()["metrics"]["queue_depth"]["samples"]
+        self.assertEqual(samples, [{"labels": {}, "value": 3}])
+
+    def test_prometheus_endpoint(self):
+        registry = MetricsRegistry()
+        registry.meter("messages_total", "Messages received", topic="Telemetry").inc(5)
+        registry.histogram("decode_seconds", "Decode time", path="stream").record(0.002)
+
+        server = MetricsServer(registry, 0)
+        server.start()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics", timeout=5) as response:
+                text = response.read().decode("utf-8")
+        finally:
+            server.stop()
+
+        self.assertIn("# TYPE autocopilot_messages_total counter", text)
+        self.assertIn('autocopilot_messages_total{topic="Telemetry"} 5', text)
+        self.assertIn("# TYPE autocopilot_decode_seconds summary", text)
+        self.assertIn('autocopilot_decode_seconds{path="stream",quantile="0.5"} 0.002', text)
+        self.assertIn('autocopilot_decode_seconds_count{path="stream"} 1', text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from recorder import FlightRecorder, FlightRecording, RecordTopic, RecordSource
+
+
+class TestFlightRecorder(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, frames, segment_bytes=4096):
+        recorder = FlightRecorder(self.directory.name, segment_bytes=segment_bytes)
+        recorder.start()
+        for topic, source, payload in frames:
+            recorder.record(topic, source, payload)
+        recorder.stop()
+        return recorder
+
+    def test_round_trip_across_segments(self):
+        frames = []
+        for i in range(500):
+            topic = RecordTopic.Telemetry if i % 3 else RecordTopic.InterfaceStatus
+            frames.append((topic, RecordSource.STREAM, f"frame {i}".encode("utf-8")))
+        recorder = self.record(frames)
+        self.assertEqual(recorder.recorded_frames, 500)
+        self.assertGreater(len([name for name in os.listdir(recorder.directory) if name.endswith(".dat")]), 1)
+
+        recording = FlightRecording(recorder.directory)
+        self.assertEqual(len(recording), 500)
+        self.assertTrue((recording.timestamps[1:] >= recording.timestamps[:-1]).all())
+        self.assertEqual([bytes(frame.payload) for frame in recording.frames()], [payload for _, _, payload in frames])
+
+        status = [frame.topic for frame in recording.frames(RecordTopic.InterfaceStatus)]
+        self.assertEqual(status, [RecordTopic.InterfaceStatus] * 167)
+        recording.close()
+
+    def test_seek(self):
+        recorder = self.record([(RecordTopic.Telemetry, RecordSource.REPLY, bytes([i])) for i in range(100)])
+        recording = FlightRecording(recorder.directory)
+        middle = recording.timestamps[50]
+        position = recording.seek(middle)
+        self.assertLessEqual(position, 50)
+        self.assertEqual(recording.timestamps[position], middle)
+        self.assertEqual(recording.seek(recording.timestamps[-1] + 1), 100)
+        self.assertEqual(len(recording.positions(start=middle)), 100 - position)
+        recording.close()
+
+    def test_vehicles_share_a_recording(self):
+        recorder = FlightRecorder(self.directory.name)
+        recorder.start()
+        first, second = recorder.for_vehicle("first"), recorder.for_vehicle("second")
+        for i in range(10):
+            (first if i % 2 == 0 else second).record(RecordTopic.Telemetry, RecordSource.STREAM, bytes([i]))
+        self.assertIs(recorder.for_vehicle("first").number, first.number)
+        recorder.stop()
+
+        recording = FlightRecording(recorder.directory)
+        self.assertEqual(sorted(recording.vehicles.values()), ["first", "second"])
+        self.assertEqual([bytes(frame.payload)[0] for frame in recording.frames(vehicle="second")], [1, 3, 5, 7, 9])
+        self.assertEqual({frame.vehicle for frame in recording.frames()}, {"first", "second"})
+        self.assertRaises(KeyError, recording.positions, vehicle="third")
+        recording.close()
+
+
+if __name__ == "__main__":
+    main()
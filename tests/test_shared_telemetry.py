@@ -0,0 +1,77 @@
+import os
+import sys
+import subprocess
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from telemetry_buffer import TelemetryBuffer
+from shared_telemetry import SharedTelemetryWriter, SharedTelemetryReader, SharedTelemetryError
+
+AUTOCOPILOT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot")
+
+
+class TestSharedTelemetry(TestCase):
+    def setUp(self):
+        self.name = "test-shared-telemetry-{}".format(os.getpid())
+        self.writer = SharedTelemetryWriter(self.name, 4)
+        self.source = TelemetryBuffer(16)
+        for i in range(16):
+            self.source.append(float(i), i, -i, i * 2, (i, 0, 0), (0, 0, i), i % 20)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_reads_wrap_around(self):
+        reader = SharedTelemetryReader(self.name)
+        self.assertIsNone(reader.latest())
+        self.writer.write(self.source.all()[:3])
+        self.writer.write(self.source.all()[3:6])
+        self.assertEqual(list(reader.all()["timestamp"]), [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(reader.latest()["lat"], 5.0)
+        self.assertEqual(list(reader.since(4.0)["timestamp"]), [4.0, 5.0])
+
+        # Samples overwritten before they were polled are counted as lost
+        self.assertEqual(len(reader.poll()[0]), 4)
+        self.writer.write(self.source.all()[6:13])
+        samples, lost = reader.poll()
+        self.assertEqual(list(samples["timestamp"]), [9.0, 10.0, 11.0, 12.0])
+        self.assertEqual(lost, 3)
+        reader.close()
+
+    def test_partial_writes_are_never_read(self):
+        self.writer.write(self.source.all()[:4])
+        reader = SharedTelemetryReader(self.name)
+        reader.MAX_RETRIES = 10
+        self.assertEqual(list(reader.all()["timestamp"]), [0.0, 1.0, 2.0, 3.0])
+
+        # A record whose stores are only partly visible fails its checksum
+        self.writer._slots["record"]["alt"][1] = 99
+        self.assertRaises(SharedTelemetryError, reader.all)
+        self.assertEqual(list(reader.last(2)["timestamp"]), [2.0, 3.0])
+
+        # A count that's visible before the record it counts points at a slot holding an older record
+        self.writer._header["count"] = 5
+        self.assertRaises(SharedTelemetryError, reader.latest)
+        reader.close()
+
+    def test_stale_region_is_replaced(self):
+        reader = SharedTelemetryReader(self.name)
+        replacement = SharedTelemetryWriter(self.name, 8)
+        self.assertTrue(reader.closed)
+        replacement.write(self.source.last(1))
+        self.assertEqual(SharedTelemetryReader(self.name).latest()["timestamp"], 15.0)
+        reader.close()
+        replacement.close()
+
+    def test_other_processes_read_without_removing_the_region(self):
+        self.writer.write(self.source.last(2))
+        script = "from shared_telemetry import SharedTelemetryReader; print(SharedTelemetryReader('{}').latest()['alt'])"
+        output = subprocess.run([sys.executable, "-c", script.format(self.name)], cwd=AUTOCOPILOT_DIRECTORY,
+                                capture_output=True, text=True, timeout=30)
+        self.assertEqual(output.stdout.strip(), "30.0")
+        self.assertEqual(SharedTelemetryReader(self.name).count, 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+from unittest import TestCase, main
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from simulator import SimulatedInterface
+from wire_format import MessageDecoder, is_binary
+
+
+class TestSimulatedInterface(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.context = zmq.Context()
+        self.interface = SimulatedInterface(self.context, hz=200, start_delay=0.05, feed_directory=self.directory.name)
+        self.thread = threading.Thread(target=self.interface.run)
+        self.thread.start()
+
+        self.dealer = self.context.socket(zmq.DEALER)
+        self.dealer.RCVTIMEO = 2000
+        self.dealer.connect("ipc://{}/drone.ipc".format(self.directory.name))
+        self.request_ids = iter(range(1, 1000))
+
+    def tearDown(self):
+        self.interface.stop()
+        self.thread.join(2)
+        self.dealer.close(linger=0)
+        self.context.term()
+        self.directory.cleanup()
+
+    def request(self, request):
+        request_id = str(next(self.request_ids)).encode("utf-8")
+        self.dealer.send_multipart([request_id, request.encode("utf-8")])
+        frames = self.dealer.recv_multipart()
+        self.assertEqual(frames[0], request_id)
+        return [MessageDecoder().decode(frame) for frame in frames[1:]]
+
+    def test_start_interface(self):
+        self.assertEqual(self.request("check_interface")[0]["state"], "OFFLINE")
+        self.assertFalse(self.request("retrieve_data")[0]["success"])
+        self.assertEqual(self.request("start_interface")[0]["state"], "ONLINE")
+
+        topics = [message["topic"] for message in self.request("retrieve_data")]
+        self.assertEqual(topics, ["FlightStatus", "ControlDevice", "Telemetry"])
+        self.assertTrue(self.request("return_home")[0]["success"])
+        self.assertFalse(self.request("fly_away")[0]["success"])
+
+    def receive_published(self, topic):
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.RCVTIMEO = 2000
+        subscriber.setsockopt(zmq.SUBSCRIBE, topic + b" ")
+        subscriber.connect("ipc://{}/telemetry.ipc".format(self.directory.name))
+        try:
+            return subscriber.recv()[len(topic) + 1:]
+        finally:
+            subscriber.close(linger=0)
+
+    def test_binary_format_and_stream(self):
+        self.request("check_interface binary")
+        self.request("start_interface")
+
+        payload = self.receive_published(b"Telemetry.bin")
+        self.assertTrue(is_binary(payload))
+        message = MessageDecoder().decode(payload)
+        self.assertEqual(message["topic"], "Telemetry")
+        self.assertEqual(message["satellites"], 12)
+        # JSON subscribers are still published to
+        self.assertFalse(is_binary(self.receive_published(b"Telemetry")))
+
+    def test_wire_format_is_per_client(self):
+        self.request("check_interface binary")
+        self.request("start_interface")
+
+        other = self.context.socket(zmq.DEALER)
+        other.RCVTIMEO = 2000
+        other.connect("ipc://{}/drone.ipc".format(self.directory.name))
+        try:
+            other.send_multipart([b"1", b"retrieve_data"])
+            frames = other.recv_multipart()
+        finally:
+            other.close(linger=0)
+        # The other client never negotiated, so it's still replied to in JSON
+        self.assertFalse(any(is_binary(frame) for frame in frames[1:]))
+        self.dealer.send_multipart([b"2", b"retrieve_data"])
+        self.assertTrue(all(is_binary(frame) for frame in self.dealer.recv_multipart()[1:]))
+
+    def test_retrieve_batch(self):
+        self.assertFalse(self.request("retrieve_batch")[0]["success"])
+        self.request("check_interface binary")
+        self.request("start_interface")
+        time.sleep(0.2)
+
+        samples = self.request("retrieve_batch")[0]["samples"]
+        self.assertGreater(len(samples), 10)
+        self.assertTrue((samples["timestamp"][1:] > samples["timestamp"][:-1]).all())
+        self.assertAlmostEqual(float(samples["timestamp"][1] - samples["timestamp"][0]), 1 / 200)
+        # The batch drained the buffered samples
+        self.assertLess(len(self.request("retrieve_batch")[0]["samples"]), len(samples))
+
+    def test_set_rates(self):
+        self.request("start_interface")
+        self.assertFalse(self.request("set_rates 7 5")[0]["success"])
+        self.assertFalse(self.request("set_rates 50")[0]["success"])
+        self.assertEqual(self.interface.hz, 200)
+
+        # Each package is held to the maxFreq of its topics
+        self.assertFalse(self.request("set_rates 100 5")[0]["success"])
+        self.assertFalse(self.request("set_rates 50 10")[0]["success"])
+        self.assertEqual(self.interface.hz, 200)
+
+        self.assertTrue(self.request("set_rates 50 5")[0]["success"])
+        self.assertEqual((self.interface.hz, self.interface.velocity_hz), (50, 5))
+
+    def test_injected_faults(self):
+        self.assertTrue(self.request("inject_fault drop_replies 1")[0]["success"])
+        self.assertFalse(self.request("inject_fault melt")[0]["success"])
+        self.dealer.send_multipart([b"lost", b"check_interface"])
+        # The dropped request isn't answered, the next one is
+        self.assertEqual(self.request("check_interface")[0]["state"], "OFFLINE")
+
+
+if __name__ == "__main__":
+    main()
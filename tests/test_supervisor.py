@@ -0,0 +1,183 @@
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, main
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from supervisor import ProcessSupervisor, read_pidfile
+from reactor import IOReactor, ReactorProcessSupervisor
+
+COMMAND = [sys.executable, "-c", "import time; time.sleep(60)  # supervised-test-process"]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestProcessSupervisor(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pidfile = os.path.join(self.directory.name, "test.pid")
+        self.supervisors = []
+
+    def tearDown(self):
+        for supervisor in self.supervisors:
+            supervisor.stop()
+        self.directory.cleanup()
+
+    def supervisor(self, **kwargs):
+        supervisor = ProcessSupervisor("supervised-test-process", COMMAND, self.pidfile, min_backoff=0.05, **kwargs)
+        self.supervisors.append(supervisor)
+        return supervisor
+
+    def test_start_and_stop(self):
+        supervisor = self.supervisor()
+        self.assertTrue(supervisor.ensure_running())
+        self.assertTrue(supervisor.is_running)
+        self.assertEqual(read_pidfile(self.pidfile), supervisor.pid)
+
+        self.assertFalse(supervisor.ensure_running())
+        supervisor.stop()
+        self.assertFalse(supervisor.is_running)
+        self.assertFalse(os.path.exists(self.pidfile))
+
+    def test_restarts_after_crash(self):
+        supervisor = self.supervisor()
+        supervisor.ensure_running()
+        first_pid = supervisor.pid
+
+        os.kill(first_pid, signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: supervisor.restart_count == 1))
+        self.assertTrue(supervisor.is_running)
+        self.assertNotEqual(supervisor.pid, first_pid)
+        self.assertEqual(supervisor.stats.crashes, 1)
+        self.assertIsNotNone(supervisor.stats.last_time_to_detect)
+        self.assertIsNotNone(supervisor.stats.last_time_to_recover)
+
+    def test_kills_process_without_heartbeats(self):
+        supervisor = self.supervisor(heartbeat_timeout=0.2)
+        supervisor.ensure_running()
+        first_pid = supervisor.pid
+
+        self.assertTrue(wait_for(lambda: supervisor.restart_count == 1))
+        self.assertEqual(supervisor.stats.hangs, 1)
+        self.assertNotEqual(supervisor.pid, first_pid)
+
+        supervisor.heartbeat()
+        self.assertEqual(supervisor.stats.recoveries, 1)
+
+    def test_heartbeats_are_not_held_up_by_a_kill(self):
+        supervisor = self.supervisor()
+        supervisor.ensure_running()
+        first_pid = supervisor.pid
+        # Holds the kill up after the process was signalled, as if it took a while to exit
+        waiting = threading.Event()
+        release = threading.Event()
+        wait_for_exit = supervisor._wait_for_exit
+
+        def slow_wait_for_exit(*args):
+            waiting.set()
+            release.wait(5)
+            return wait_for_exit(*args)
+        supervisor._wait_for_exit = slow_wait_for_exit
+
+        restart = threading.Thread(target=supervisor.restart)
+        restart.start()
+        self.assertTrue(waiting.wait(2))
+        heartbeat = threading.Thread(target=supervisor.heartbeat)
+        heartbeat.start()
+        heartbeat.join(1)
+        self.assertFalse(heartbeat.is_alive())
+
+        release.set()
+        restart.join(5)
+        self.assertTrue(supervisor.is_running)
+        self.assertNotEqual(supervisor.pid, first_pid)
+        self.assertEqual(supervisor.restart_count, 1)
+
+    def test_adopts_process_from_pidfile(self):
+        first = self.supervisor(restart_on_exit=False)
+        first.ensure_running()
+
+        second = self.supervisor(restart_on_exit=False)
+        self.assertFalse(second.ensure_running())
+        self.assertEqual(second.pid, first.pid)
+
+        os.kill(first.pid, signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: not second.is_running))
+        self.assertEqual(second.restart_count, 0)
+
+
+    def test_rotates_output(self):
+        output = os.path.join(self.directory.name, "output.log")
+        command = [sys.executable, "-c", "import time\nwhile True:\n    print('x' * 99, flush=True)\n    time.sleep(0.001)"]
+        supervisor = ProcessSupervisor(
+            "rotated-test-process", command, self.pidfile, output_path=output, output_max_bytes=5000, output_backup_count=2)
+        supervisor.OUTPUT_CHECK_INTERVAL = 0.05
+        self.supervisors.append(supervisor)
+        supervisor.ensure_running()
+
+        self.assertTrue(wait_for(lambda: os.path.exists(output + ".2")))
+        self.assertGreaterEqual(os.path.getsize(output + ".1"), 5000)
+        # The process carries on writing from the start of the truncated file
+        self.assertLess(os.path.getsize(output), 50000)
+
+
+class TestReactorProcessSupervisor(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.context = zmq.Context()
+        self.reactor = IOReactor(self.context)
+        self.reactor.start()
+        self.threads_before = threading.active_count()
+        self.supervisors = []
+
+    def tearDown(self):
+        for supervisor in self.supervisors:
+            supervisor.stop()
+        self.reactor.stop()
+        self.reactor.join()
+        self.context.term()
+        self.directory.cleanup()
+
+    def supervisor(self, name, **kwargs):
+        supervisor = ReactorProcessSupervisor(
+            self.reactor, "supervised-test-process", COMMAND, os.path.join(self.directory.name, name + ".pid"),
+            min_backoff=0.05, **kwargs)
+        self.supervisors.append(supervisor)
+        return supervisor
+
+    def test_restarts_without_threads(self):
+        crashing, hanging = self.supervisor("crashing"), self.supervisor("hanging", heartbeat_timeout=0.2)
+        crashing.ensure_running()
+        hanging.ensure_running()
+        first_pid = crashing.pid
+
+        os.kill(first_pid, signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: crashing.restart_count == 1))
+        self.assertNotEqual(crashing.pid, first_pid)
+        self.assertEqual(crashing.stats.crashes, 1)
+        self.assertTrue(wait_for(lambda: hanging.restart_count == 1))
+        self.assertEqual(hanging.stats.hangs, 1)
+        self.assertEqual(threading.active_count(), self.threads_before)
+
+        # Once stopped, the process isn't watched any more
+        crashing.stop()
+        self.assertFalse(crashing.is_running)
+        self.assertTrue(wait_for(lambda: crashing._watched_fd is None))
+        self.assertEqual(crashing.restart_count, 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import os
+import sys
+from unittest import TestCase, main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from telemetry_buffer import TelemetryBuffer
+
+
+class TestTelemetryBuffer(TestCase):
+    def fill(self, buffer, count):
+        for i in range(count):
+            buffer.append(float(i), i, -i, i * 2, (i, 0, 0), (0, 0, i), i % 20)
+
+    def test_last_is_a_view_in_order(self):
+        buffer = TelemetryBuffer(4)
+        self.fill(buffer, 10)
+        samples = buffer.last(3)
+        self.assertEqual(list(samples["timestamp"]), [7.0, 8.0, 9.0])
+        self.assertTrue(samples.base is not None)
+
+    def test_partially_filled(self):
+        buffer = TelemetryBuffer(8)
+        self.fill(buffer, 3)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(list(buffer.last(10)["lat"]), [0.0, 1.0, 2.0])
+        self.assertEqual(len(TelemetryBuffer(2).last(1)), 0)
+
+    def test_time_queries(self):
+        buffer = TelemetryBuffer(5)
+        self.fill(buffer, 12)
+        self.assertEqual(list(buffer.since(9.5)["timestamp"]), [10.0, 11.0])
+        self.assertEqual(list(buffer.window(8.0, 10.0)["timestamp"]), [8.0, 9.0, 10.0])
+        self.assertEqual(list(buffer.since(0.0)["timestamp"]), [7.0, 8.0, 9.0, 10.0, 11.0])
+
+    def test_extend_wraps_around(self):
+        source = TelemetryBuffer(16)
+        self.fill(source, 16)
+        buffer = TelemetryBuffer(5)
+        self.fill(buffer, 3)
+        buffer.extend(source.all()[3:7])
+        self.assertEqual(list(buffer.all()["timestamp"]), [2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertEqual(buffer.total_appended, 7)
+
+        # Only the newest rows of a batch larger than the buffer are kept
+        buffer.extend(source.all())
+        self.assertEqual(list(buffer.all()["timestamp"]), [11.0, 12.0, 13.0, 14.0, 15.0])
+        self.assertEqual(list(buffer.since(13.0)["satellites"]), [13, 14, 15])
+
+    def test_append_message_without_acceleration(self):
+        buffer = TelemetryBuffer(2)
+        buffer.append_message(1.0, {"latitude": 0.5, "longitude": 1.0, "altitude": 10.0, "satellites": 7,
+                                    "vel_x": 1.0, "vel_y": 2.0, "vel_z": 3.0})
+        latest = buffer.latest()
+        self.assertEqual(list(latest["vel"]), [1.0, 2.0, 3.0])
+        self.assertTrue(all(value != value for value in latest["accel"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import sys
+from unittest import TestCase, main
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from simulator import TelemetrySynthesizer
+from telemetry_buffer import TelemetryBuffer
+from time_alignment import ClockEstimator, align_telemetry, resample, uniform_grid
+
+
+class TestClockEstimator(TestCase):
+    def test_follows_the_least_delayed_packages(self):
+        synthesizer = TelemetrySynthesizer(clock_skew=100e-6, seed=1)
+        clock = ClockEstimator()
+        self.assertIsNone(clock.to_host(1.0))
+        for t in np.arange(0, 30, 0.02):
+            message = synthesizer.telemetry(t)
+            clock.add(message["fc_time"], message["received"])
+
+        # The flight controller clock runs fast, so host time falls behind it
+        self.assertAlmostEqual(clock.skew, -100e-6, delta=20e-6)
+        self.assertAlmostEqual(float(clock.to_host(synthesizer.fc_time(29.0))), 29.0, delta=0.002)
+
+    def test_restarted_flight_controller(self):
+        clock = ClockEstimator()
+        clock.add([500.0, 501.0, 502.0], [10.0, 11.0, 12.0])
+        clock.add([503.0, 1.0, 2.0], [13.0, 14.0, 15.0])
+        self.assertEqual(clock.resets, 1)
+        self.assertAlmostEqual(clock.offset, 13.0)
+        clock.add([np.nan], [16.0])
+        self.assertAlmostEqual(float(clock.to_host(3.0)), 16.0)
+
+
+class TestResampling(TestCase):
+    def test_resample_interpolates_every_column(self):
+        grid = uniform_grid(0.05, 1.0, 4)
+        self.assertEqual(list(grid), [0.25, 0.5, 0.75, 1.0])
+        values = np.array([[0.0, 10.0], [1.0, 20.0], [3.0, 40.0]])
+        result = resample([0.0, 0.5, 0.75], values, grid)
+        self.assertEqual(result[:3].tolist(), [[0.5, 15.0], [1.0, 20.0], [3.0, 40.0]])
+        # Never extrapolated
+        self.assertTrue(np.isnan(result[3]).all())
+
+    def test_mixed_rates_are_aligned(self):
+        synthesizer = TelemetrySynthesizer(seed=2)
+        buffer = TelemetryBuffer(1000)
+        clock = ClockEstimator()
+        # Position at 8 Hz and velocity at 5 Hz, arriving with jitter
+        for t in np.arange(0, 20, 1 / 8):
+            message = synthesizer.telemetry(t, velocity_hz=5)
+            buffer.append_message(message["received"], message)
+            clock.add(message["fc_time"], message["received"])
+
+        aligned = align_telemetry(buffer.all(), 10, clock)
+        self.assertGreater(len(aligned), 150)
+        self.assertTrue(np.allclose(np.diff(aligned["time"]), 0.1))
+        truth = np.array([synthesizer.velocity(t) for t in aligned["time"]])
+        self.assertLess(np.abs(aligned["vel"][:, :2] - truth).max(), 0.01)
+        latitudes = np.array([synthesizer.position(t)[0] for t in aligned["time"]])
+        self.assertLess(np.abs(aligned["lat"] - latitudes).max(), 1e-6)
+
+
+if __name__ == "__main__":
+    main()
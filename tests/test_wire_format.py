@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+from unittest import TestCase, main
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+import wire_format
+
+
+class TestWireFormat(TestCase):
+    def setUp(self):
+        self.decoder = wire_format.MessageDecoder()
+
+    def test_binary_round_trip(self):
+        messages = [
+            {"topic": "Telemetry", "longitude": 1.0, "latitude": 0.5, "altitude": 12.5, "satellites": 11,
+             "vel_x": 0.25, "vel_y": -0.5, "vel_z": 0.0, "accel_x": 0.0, "accel_y": 1.0, "accel_z": -9.75,
+             "fc_time": 120.25, "received": 5003.5, "velocity_fc_time": 120.2},
+            {"topic": "ControlDevice", "auto_mode": True, "return_to_home": False},
+            {"topic": "FlightStatus", "state": 2},
+            {"topic": "InterfaceStatus", "state": "ONLINE", "fail_state": "NO_FAILURE", "fail_output": "", "active_mode": False},
+        ]
+        for message in messages:
+            self.assertEqual(self.decoder.decode(memoryview(wire_format.encode(message))), message)
+
+    def test_telemetry_without_acceleration(self):
+        message = {"topic": "Telemetry", "longitude": 1.0, "latitude": 0.5, "altitude": 12.5, "satellites": 11,
+                   "vel_x": 0.25, "vel_y": -0.5, "vel_z": 0.0}
+        self.assertEqual(self.decoder.decode(wire_format.encode(message)), message)
+
+    def test_telemetry_batch(self):
+        batch = {"topic": "TelemetryBatch", "dropped": 3, "timestamp": [10.0, 10.02, 10.04],
+                 "longitude": [1.0, 1.5, 2.0], "latitude": [0.5, 0.25, 0.0], "altitude": [12.5, 13.0, 13.5],
+                 "vel_x": [0.25, 0.5, 0.75], "vel_y": [0.0, 0.0, 0.0], "vel_z": [-1.0, -1.0, -1.0],
+                 "accel_x": [0.0, 0.0, 0.0], "accel_y": [0.0, 0.0, 0.0], "accel_z": [-9.75, -9.75, -9.75],
+                 "satellites": [11, 11, 12]}
+        for frame in (memoryview(wire_format.encode(batch)), json.dumps(batch).encode("utf-8")):
+            message = self.decoder.decode(frame)
+            self.assertEqual(message["dropped"], 3)
+            samples = message["samples"]
+            self.assertEqual(list(samples["timestamp"]), batch["timestamp"])
+            self.assertEqual(list(samples["lon"]), batch["longitude"])
+            self.assertEqual(list(samples["vel"][:, 0]), batch["vel_x"])
+            self.assertEqual(list(samples["accel"][:, 2]), batch["accel_z"])
+            self.assertEqual(list(samples["satellites"]), batch["satellites"])
+
+        empty = dict(batch, **{name: [] for name, _ in wire_format.TELEMETRY_BATCH_COLUMNS})
+        self.assertEqual(len(self.decoder.decode(wire_format.encode(empty))["samples"]), 0)
+
+    def test_batch_times(self):
+        batch = {"topic": "TelemetryBatch", "dropped": 0, "timestamp": [10.0, 10.02], "fc_time": [120.0, 120.02],
+                 "received": [9.99, None], "velocity_fc_time": [119.9, 119.9], "longitude": [1.0, 1.5],
+                 "latitude": [0.5, 0.25], "altitude": [12.5, 13.0], "vel_x": [0.25, 0.5], "vel_y": [0.0, 0.0],
+                 "vel_z": [-1.0, -1.0], "accel_x": [0.0, 0.0], "accel_y": [0.0, 0.0], "accel_z": [-9.75, -9.75],
+                 "satellites": [11, 11]}
+        for frame in (wire_format.encode(batch), json.dumps(batch).encode("utf-8")):
+            samples = self.decoder.decode(frame)["samples"]
+            self.assertEqual(list(samples["fc_time"]), batch["fc_time"])
+            self.assertEqual(samples["received"][0], 9.99)
+            self.assertTrue(np.isnan(samples["received"][1]))
+
+    def test_version_1_telemetry(self):
+        message = {"topic": "Telemetry", "longitude": 1.0, "latitude": 0.5, "altitude": 12.5, "satellites": 11,
+                   "vel_x": 0.25, "vel_y": -0.5, "vel_z": 0.0}
+        frame = wire_format.HEADER.pack(wire_format.WIRE_MAGIC, 1, wire_format.WireTopic.Telemetry) + \
+            wire_format.TELEMETRY_V1.pack(1.0, 0.5, 12.5, 11, 0.25, -0.5, 0.0, False, 0, 0, 0)
+        self.assertEqual(self.decoder.decode(frame), message)
+
+    def test_json_fallback(self):
+        self.assertEqual(self.decoder.decode(b'{"topic": "FlightStatus", "state": 1}'), {"topic": "FlightStatus", "state": 1})
+
+    def test_unsupported_schema_version(self):
+        frame = bytearray(wire_format.encode({"topic": "FlightStatus", "state": 1}))
+        frame[1] = wire_format.SCHEMA_VERSION + 1
+        with self.assertRaises(wire_format.WireFormatError):
+            self.decoder.decode(frame)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,285 @@
+import os
+import sys
+import time
+import select
+from json import dumps
 from unittest import TestCase, main
 from unittest.mock import Mock
 
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autocopilot"))
+
+from zmq_threads import IPCRequestThread, RequestQueueFullError, RequestExpiredError, RequestAbortedError, RequestLane
+from drone import TelemetrySubscriberThread, DJIMessageTopic
+from wire_format import WireFormat, encode
+from utility import UnexpectedStateError
+
+
 class TestIPCThreadStartStop(TestCase):
-    def create_ipc_thread(self):
-        pass
+    def setUp(self):
+        self.context = zmq.Context()
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.stop()
+            thread.join(2)
+        self.context.term()
+
+    def create_ipc_thread(self, event_driven=False):
+        thread = IPCRequestThread(self.context, Mock(), "test-zmqio-{}".format(os.getpid()), event_driven=event_driven)
+        self.threads.append(thread)
+        return thread
+
+    def test_start_twice(self):
+        thread = self.create_ipc_thread()
+        thread.start()
+        self.assertRaises(UnexpectedStateError, thread.start)
+
+    def test_start_after_stop(self):
+        thread = self.create_ipc_thread()
+        thread.start()
+        thread.stop()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertRaises(UnexpectedStateError, thread.start)
+
+    def test_wakeup_is_cleared(self):
+        thread = self.create_ipc_thread(event_driven=True)
+        thread.start()
+        thread.wakeup()
+
+        # A wakeup left raised would keep the thread spinning in its poller
+        deadline = time.monotonic() + 2
+        while select.select([thread._wakeup], [], [], 0)[0] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(select.select([thread._wakeup], [], [], 0)[0], [])
+        thread.stop()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+
+class TestRequestAdmission(TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        # Requests stay outstanding since the thread is never started
+        self.thread = IPCRequestThread(
+            self.context, Mock(), "test-admission-{}".format(os.getpid()), max_pending=3, coalesced_requests=("check_interface",))
+
+    def tearDown(self):
+        self.context.term()
+
+    def test_identical_requests_are_coalesced(self):
+        first = self.thread.send_request("check_interface")
+        self.assertIs(self.thread.send_request("check_interface"), first)
+        self.assertIsNot(self.thread.send_request("check_interface binary"), first)
+        self.assertEqual(self.thread.admission.coalesced_count, 1)
+        self.assertEqual(len(self.thread._request_queue), 2)
+
+        # Once the request is done an identical one is sent again
+        first.cancel()
+        self.assertIsNot(self.thread.send_request("check_interface"), first)
+
+    def test_full_queue_refuses_requests(self):
+        futures = [self.thread.send_request("return_home") for _ in range(3)]
+        self.assertRaises(RequestQueueFullError, self.thread.send_request, "return_home")
+        self.assertEqual(self.thread.admission.overflow_count, 1)
+
+        futures[0].cancel()
+        self.thread.send_request("return_home")
+        self.assertEqual(self.thread.admission.outstanding, 3)
+
+
+class TestRequestLanes(TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        feed_name = "test-lanes-{}".format(os.getpid())
+        # Stands in for the interface, only replying when told to
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.RCVTIMEO = 2000
+        self.router.bind("ipc:///tmp/feeds/{}.ipc".format(feed_name))
+        self.thread = IPCRequestThread(self.context, Mock(), feed_name, event_driven=True, max_in_flight=1)
+        self.thread.start()
+        self.thread.start_update_async()
+
+    def tearDown(self):
+        self.thread.stop()
+        self.thread.join(2)
+        self.router.close(linger=0)
+        self.context.term()
+
+    def receive(self):
+        frames = self.router.recv_multipart()
+        return frames[0], frames[1], frames[2].decode("utf-8")
+
+    def test_safety_lane_skips_the_window_and_late_requests_expire(self):
+        self.thread.send_request("check_interface")
+        identity, request_id, request = self.receive()
+        self.assertEqual(request, "check_interface")
+
+        late = self.thread.send_request("retrieve_data", lane=RequestLane.TELEMETRY, send_deadline=0.1)
+        control = self.thread.send_request("start_interface")
+        safety = self.thread.send_request("return_home", lane=RequestLane.SAFETY)
+        # The window is full, but safety requests are never held back
+        safety_identity, safety_id, request = self.receive()
+        self.assertEqual(request, "return_home")
+        self.assertRaises(RequestExpiredError, late.result, 2)
+
+        # Answering frees the window for the control request, not the expired one
+        self.router.send_multipart([identity, request_id, b"status"])
+        self.router.send_multipart([safety_identity, safety_id, b"returning"])
+        self.assertEqual(safety.result(2), ["returning"])
+        self.assertEqual(self.receive()[2], "start_interface")
+        self.assertFalse(control.done())
+
+
+
+class TestRequestPipelining(TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.feed_name = "test-pipelining-{}".format(os.getpid())
+        # Stands in for the interface, replying in whatever order the test chooses
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.RCVTIMEO = 2000
+        self.router.bind("ipc:///tmp/feeds/{}.ipc".format(self.feed_name))
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join(2)
+        self.router.close(linger=0)
+        self.context.term()
+
+    def start(self, **kwargs):
+        self.thread = IPCRequestThread(self.context, Mock(), self.feed_name, event_driven=True, **kwargs)
+        self.thread.start()
+        self.thread.start_update_async()
+
+    def receive(self):
+        frames = self.router.recv_multipart()
+        return frames[0], frames[1], frames[2].decode("utf-8")
+
+    def test_out_of_order_replies_resolve_their_own_requests(self):
+        self.start()
+        futures = [self.thread.send_request("request {}".format(i)) for i in range(3)]
+        received = [self.receive() for _ in futures]
+        self.assertEqual([request for _, _, request in received], ["request 0", "request 1", "request 2"])
+
+        for identity, request_id, request in reversed(received):
+            self.router.send_multipart([identity, request_id, ("reply to " + request).encode("utf-8")])
+        self.assertEqual([future.result(2) for future in futures],
+                         [["reply to request 0"], ["reply to request 1"], ["reply to request 2"]])
+
+    def test_unanswered_requests_time_out(self):
+        self.start()
+        future = self.thread.send_request("check_interface", timeout=0.1)
+        identity, request_id, _ = self.receive()
+        self.assertIsInstance(future.exception(2), TimeoutError)
+
+        # A reply that arrives too late is dropped, and the next request still gets its own
+        self.router.send_multipart([identity, request_id, b"late"])
+        future = self.thread.send_request("check_interface")
+        identity, request_id, _ = self.receive()
+        self.router.send_multipart([identity, request_id, b"on time"])
+        self.assertEqual(future.result(2), ["on time"])
+
+    def test_in_flight_requests_are_aborted_on_stop(self):
+        self.start()
+        future = self.thread.send_request("start_interface")
+        self.receive()
+
+        self.thread.stop()
+        self.thread.join(2)
+        self.assertIsInstance(future.exception(2), RequestAbortedError)
+
+    def test_window_holds_requests_back_until_a_reply(self):
+        self.start(max_in_flight=2)
+        futures = [self.thread.send_request("request {}".format(i)) for i in range(3)]
+        identity, request_id, _ = self.receive()
+        self.receive()
+        self.assertEqual(self.router.poll(200), 0)
+
+        self.router.send_multipart([identity, request_id, b"done"])
+        self.assertEqual(futures[0].result(2), ["done"])
+        self.assertEqual(self.receive()[2], "request 2")
+
+
+class TestTelemetrySubscriberThread(TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.feed_name = "test-telemetry-{}".format(os.getpid())
+        # Stands in for the interface's telemetry feed
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.bind("ipc:///tmp/feeds/{}.ipc".format(self.feed_name))
+        self.messages = []
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join(2)
+        self.publisher.close(linger=0)
+        self.context.term()
+
+    def subscribe(self, **kwargs):
+        self.thread = TelemetrySubscriberThread(
+            self.context, lambda topic, message, stream: self.messages.append((topic, message)), feed_name=self.feed_name,
+            **kwargs)
+        self.thread.start()
+        # Messages published before the subscription reached the publisher are dropped, so publish until one arrives
+        deadline = time.monotonic() + 2
+        while len(self.messages) == 0 and time.monotonic() < deadline:
+            self.publish("Heartbeat", {"topic": "Heartbeat"})
+            time.sleep(0.01)
+        self.assertGreater(len(self.messages), 0)
+
+    def publish(self, topic, message):
+        self.publisher.send(topic.encode("utf-8") + b" " + dumps(message).encode("utf-8"))
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_streamed_topics_are_delivered(self):
+        self.subscribe(event_driven=True)
+        self.publish("InterfaceStatus", {"topic": "InterfaceStatus", "state": "ONLINE"})
+        self.publish("Telemetry", {"topic": "Telemetry", "satellites": 12})
+        self.assertTrue(self.wait_for(lambda: self.thread.latest(DJIMessageTopic.Telemetry) is not None))
+
+        self.assertEqual(self.thread.latest(DJIMessageTopic.Telemetry)["satellites"], 12)
+        # Only the streamed topics are subscribed to
+        self.assertNotIn(DJIMessageTopic.InterfaceStatus, [topic for topic, _ in self.messages])
+
+    def test_conflated_topics_keep_their_newest_message(self):
+        # Polled once a second, so the whole burst is waiting on the sockets at the next poll
+        self.subscribe(conflate=True, rate=1)
+        self.messages.clear()
+        for i in range(50):
+            self.publish("Telemetry", {"topic": "Telemetry", "satellites": i})
+        self.publish("FlightStatus", {"topic": "FlightStatus", "status": 2})
+        self.assertTrue(self.wait_for(lambda: self.thread.latest(DJIMessageTopic.FlightStatus) is not None))
+        self.assertTrue(self.wait_for(lambda: self.thread.latest(DJIMessageTopic.Telemetry)["satellites"] == 49))
+
+        # Each topic has its own socket, so the telemetry burst didn't replace the flight status
+        telemetry = [message["satellites"] for topic, message in self.messages if topic == DJIMessageTopic.Telemetry]
+        self.assertLess(len(telemetry), 50)
+        self.assertEqual(telemetry[-1], 49)
+
+    def test_binary_subscribers_take_the_binary_topics(self):
+        self.subscribe(event_driven=True, wire_format=WireFormat.BINARY)
+        self.publish("Telemetry", {"topic": "Telemetry", "satellites": 1})
+        self.publisher.send(b"Telemetry.bin " + encode({
+            "topic": "Telemetry", "longitude": 0, "latitude": 0, "altitude": 0, "satellites": 12, "vel_x": 0, "vel_y": 0,
+            "vel_z": 0}))
+        self.assertTrue(self.wait_for(lambda: self.thread.latest(DJIMessageTopic.Telemetry) is not None))
+
+        # The JSON copy isn't subscribed to, and the binary copy arrives under the plain topic
+        self.assertEqual([message["satellites"] for topic, message in self.messages if topic == DJIMessageTopic.Telemetry], [12])
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()